@@ -0,0 +1,291 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+COLUMN = 'highlow_prevalence'
+STATES = ['External', 'High', 'Low']
+DRMS = ['RT:K103N', 'RT:M184V']
+ARV_DATA = [['RT:K103N', 'NNRTI', 'efavirenz', 'EFV', 60, 'High-Level Resistance', 1998],
+            ['RT:K103N', 'NNRTI', 'nevirapine', 'NVP', 60, 'High-Level Resistance', 1996],
+            ['RT:M184V', 'NRTI', 'lamivudine', 'LAMIVUDINE', 60, 'High-Level Resistance', 1995],
+            ['RT:M184V', 'NRTI', 'emtricitabine', 'FTC', 60, 'High-Level Resistance', 2003]]
+ARV_COLUMNS = ['mutation', 'drug class', 'drug full name', 'drug abbreviation', 'score', 'note', 'year']
+NUCLEOTIDES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+ROOT_DATE = 1950.
+MEAN_DIST = 2.
+SWITCH_PROBABILITY = .1
+MULTIPLE_STATE_PROBABILITY = .2
+N_REPLICATES = 3
+ALN_LENGTH = 500
+MUTATION_RATE = .02
+DATA_VERSION = '2'
+
+
+def random_tree(n_tips, rng):
+    """
+    Generates a random binary tree by recursively splitting the tips in two (uniformly at random).
+
+    :return: tuple (parents, ends, dists) of node arrays in preorder,
+        where the subtree of node i consists of the nodes i, ..., ends[i] - 1 (as in ArrayTree)
+    """
+    n_nodes = 2 * n_tips - 1
+    parents = np.full(n_nodes, -1, dtype=np.int64)
+    ends = np.empty(n_nodes, dtype=np.int64)
+    splits = rng.random(n_nodes)
+    i = 0
+    stack = [(-1, n_tips)]
+    while stack:
+        parent, n = stack.pop()
+        parents[i] = parent
+        ends[i] = i + 2 * n - 1
+        if n > 1:
+            left = 1 + int(splits[i] * (n - 1))
+            # the left child is processed first, i.e. gets the next preorder index
+            stack.append((i, n - left))
+            stack.append((i, left))
+        i += 1
+    dists = rng.exponential(MEAN_DIST, n_nodes)
+    dists[0] = 0
+    return parents, ends, dists
+
+
+def get_dates(parents, dists, root_date=ROOT_DATE):
+    dates = np.array(dists)
+    dates[0] += root_date
+    # in preorder the parents come before their children
+    for i in range(1, len(dates)):
+        dates[i] += dates[parents[i]]
+    return dates
+
+
+def simulate_states(parents, rng, n_states=len(STATES), switch_probability=SWITCH_PROBABILITY):
+    """Evolves a discrete character down the tree: each node keeps its parent's state or switches to a random one."""
+    n_nodes = len(parents)
+    states = rng.integers(0, n_states, n_nodes)
+    is_kept = rng.random(n_nodes) >= switch_probability
+    is_kept[0] = False
+    for i in np.flatnonzero(is_kept):
+        states[i] = states[parents[i]]
+    return states
+
+
+def get_marginal_probabilities(states, rng, n_states=len(STATES)):
+    """Draws node x state marginal probabilities concentrated on the given states."""
+    alpha = np.ones((len(states), n_states))
+    alpha[np.arange(len(states)), states] = 10
+    mps = rng.gamma(alpha)
+    return mps / mps.sum(axis=1)[:, np.newaxis]
+
+
+def get_predicted_states(mps, is_tip, rng):
+    """
+    Predicts a unique state for the tips, and, as MPPA might, one or several states for the internal nodes.
+
+    :return: list of lists of state indices
+    """
+    order = np.argsort(-mps, axis=1)
+    n_states = np.where(is_tip | (rng.random(len(mps)) >= MULTIPLE_STATE_PROBABILITY), 1,
+                        rng.integers(2, mps.shape[1] + 1, len(mps)))
+    return [sorted(row[:n]) for row, n in zip(order.tolist(), n_states.tolist())]
+
+
+def write_newick(path, parents, ends, labels):
+    """Writes a tree given by its preorder arrays (see random_tree) in newick, without recursion."""
+    n_nodes = len(parents)
+    tokens = []
+    stack = []
+    for i in range(n_nodes):
+        if ends[i] > i + 1:
+            tokens.append('(')
+            stack.append(i)
+            continue
+        tokens.append(labels[i])
+        # close the subtrees that end with this tip
+        while stack and ends[stack[-1]] == i + 1:
+            tokens.append(')')
+            tokens.append(labels[stack.pop()])
+        if i + 1 < n_nodes:
+            tokens.append(',')
+    tokens.append(';\n')
+    with open(path, 'w+') as f:
+        f.write(''.join(tokens))
+
+
+def get_labels(names, dists, features=None):
+    """Formats the node labels as name:dist[&&NHX:feature=value...]."""
+    features = features if features else {}
+    labels = []
+    for i, (name, dist) in enumerate(zip(names, dists)):
+        nhx = ':'.join('{}={}'.format(feature, values[i]) for feature, values in features.items())
+        labels.append('{}:{:g}{}'.format(name, dist, '[&&NHX:{}]'.format(nhx) if nhx else ''))
+    return labels
+
+
+def write_alignment(path, names, rng, length=ALN_LENGTH, mutation_rate=MUTATION_RATE, batch_size=10000):
+    """Writes a FASTA alignment of random sequences, mutated from a common reference."""
+    reference = rng.choice(NUCLEOTIDES, length)
+    with open(path, 'w+') as f:
+        for start in range(0, len(names), batch_size):
+            batch = names[start: start + batch_size]
+            seqs = np.tile(reference, (len(batch), 1))
+            is_mutated = rng.random(seqs.shape) < mutation_rate
+            seqs[is_mutated] = rng.choice(NUCLEOTIDES, is_mutated.sum())
+            seqs[rng.random(seqs.shape) < mutation_rate / 10] = ord('-')
+            f.write(''.join('>{}\n{}\n'.format(name, seq.tobytes().decode()) for name, seq in zip(batch, seqs)))
+
+
+def write_states(path, names, predicted_states, columns, rng, keep_probability=1.):
+    """
+    Writes a PastML-like combined_ancestral_states table, with a row per node and predicted state,
+    keeping each node with the given probability.
+
+    :return: array of the indices of the kept nodes
+    """
+    keep = np.flatnonzero(rng.random(len(names)) < keep_probability)
+    node_names = np.repeat(names[keep], [len(predicted_states[_]) for _ in keep])
+    values = [STATES[s] for i in keep for s in predicted_states[i]]
+    pd.DataFrame({'node': node_names, **{_: values for _ in columns}}).to_csv(path, sep='\t', index=False)
+    return keep
+
+
+def write_params(path, mps, n_tips, column=COLUMN):
+    """
+    Writes a PastML-like F81 parameter table, with the state frequencies of the marginal probabilities,
+    and the scaling factor of the simulated state switches.
+    """
+    frequencies = np.asarray(mps).mean(axis=0)
+    rows = [('character', column), ('method', 'MPPA'), ('model', 'F81'), ('num_nodes', len(mps)), ('num_tips', n_tips),
+            ('scaling_factor', SWITCH_PROBABILITY / MEAN_DIST), ('smoothing_factor', 0)] \
+        + list(zip(STATES, frequencies / frequencies.sum()))
+    pd.DataFrame(rows, columns=['parameter', 'value']).to_csv(path, sep='\t', index=False)
+
+
+def generate(data_dir, n_tips, seed=None, n_replicates=N_REPLICATES, aln_length=ALN_LENGTH):
+    """
+    Generates a synthetic data set of the given size in the pipeline formats:
+    a tree (as the one to collapse), its dated named version and its highlow_prevalence ACR
+    (with marginal probabilities and state tables), a subsampled ACR tree, DRM metadata and ACRs,
+    an ARV table and a FASTA alignment.
+    The file paths are listed in data.json in the data directory.
+
+    :return: dictionary of file paths (and of the root date and the DRMs)
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+
+    def path(name):
+        return os.path.join(data_dir, name)
+
+    parents, ends, dists = random_tree(n_tips, rng)
+    is_tip = ends == np.arange(1, len(ends) + 1)
+    names = np.empty(len(parents), dtype=object)
+    names[is_tip] = ['t{}'.format(_) for _ in range(n_tips)]
+    names[~is_tip] = ['n{}'.format(_) for _ in range(len(parents) - n_tips)]
+    names[0] = 'root'
+    dates = get_dates(parents, dists)
+
+    mps = get_marginal_probabilities(simulate_states(parents, rng), rng)
+    predicted_states = get_predicted_states(mps, is_tip, rng)
+    acr = np.array(['|'.join(STATES[_] for _ in ss) for ss in predicted_states], dtype=object)
+
+    data = {'n_tips': n_tips, 'seed': seed, 'version': DATA_VERSION, 'root_date': ROOT_DATE, 'drms': DRMS,
+            'tree': path('tree.nwk'), 'named_tree': path('tree.named.nwk'), 'acr_tree': path('acr.nwk'),
+            'mp': path('mp.tab'), 'states': path('states.tab'), 'acr_sub_tree': path('acr.sub.nwk'),
+            'mp_sub': path('mp.sub.tab'), 'params': path('params.tab'), 'params_sub': path('params.sub.tab'),
+            'replicate_states': [path('states.{}.tab'.format(_))
+                                                                for _ in range(n_replicates)],
+            'combined_states': path('combined_ancestral_states.tab'), 'metadata': path('metadata.tab'),
+            'arv_tab': path('arv.tab'), 'drm_acrs': [path('acr.{}.tab'.format(_.replace(':', ''))) for _ in DRMS],
+            'fasta': path('aln.fa')}
+
+    tip_labels = np.array(['{}:{:g}'.format(name, dist) for name, dist in zip(names, dists)], dtype=object)
+    write_newick(data['tree'], parents, ends, np.where(is_tip, tip_labels, [':{:g}'.format(_) for _ in dists]))
+    write_newick(data['named_tree'], parents, ends, get_labels(names, dists, {'date': dates}))
+    write_newick(data['acr_tree'], parents, ends, get_labels(names, dists, {'date': dates, COLUMN: acr}))
+    pd.DataFrame(index=pd.Index(names, name='node'), columns=STATES, data=mps).to_csv(data['mp'], sep='\t')
+    write_params(data['params'], mps, n_tips)
+    write_states(data['states'], names, predicted_states, [COLUMN], rng)
+
+    # a subsampled tree (of a quarter of the tips) to compare the full tree to
+    sub_tips = max(n_tips // 4, 2)
+    sub_parents, sub_ends, sub_dists = random_tree(sub_tips, rng)
+    sub_mps = get_marginal_probabilities(simulate_states(sub_parents, rng), rng)
+    sub_is_tip = sub_ends == np.arange(1, len(sub_ends) + 1)
+    sub_acr = ['|'.join(STATES[_] for _ in ss) for ss in get_predicted_states(sub_mps, sub_is_tip, rng)]
+    sub_node_names = np.empty(len(sub_ends), dtype=object)
+    sub_node_names[~sub_is_tip] = names[~is_tip][: sub_tips - 1]
+    sub_node_names[sub_is_tip] = names[is_tip][: sub_tips]
+    write_newick(data['acr_sub_tree'], sub_parents, sub_ends,
+                 get_labels(sub_node_names, sub_dists, {'date': get_dates(sub_parents, sub_dists), COLUMN: sub_acr}))
+    pd.DataFrame(index=pd.Index(sub_node_names, name='node'), columns=STATES, data=sub_mps)\
+        .to_csv(data['mp_sub'], sep='\t')
+    write_params(data['params_sub'], sub_mps, sub_tips)
+
+    # replicate ACRs, each predicting the states for some of the nodes, and their combined table
+    replicate_states = []
+    for tab in data['replicate_states']:
+        states = get_predicted_states(get_marginal_probabilities([_[0] for _ in predicted_states], rng), is_tip, rng)
+        is_kept = np.zeros(len(names), dtype=bool)
+        is_kept[write_states(tab, names, states, [COLUMN], rng, keep_probability=.5)] = True
+        replicate_states.append([ss if kept else [] for ss, kept in zip(states, is_kept)])
+    n_rows = np.array([max(len(_) for _ in ss) for ss in zip(predicted_states, *replicate_states)])
+    combined_df = pd.DataFrame({'node': np.repeat(names, n_rows)})
+    for column, states in zip([COLUMN] + ['{}_{}'.format(COLUMN, _) for _ in range(n_replicates)],
+                              [predicted_states] + replicate_states):
+        combined_df[column] = [STATES[ss[k]] if k < len(ss) else None
+                               for ss, n in zip(states, n_rows) for k in range(n)]
+    combined_df.to_csv(data['combined_states'], sep='\t', index=False)
+
+    # DRM metadata for the tips, and DRM ACRs for the nodes sampled after the first ARVs
+    metadata_df = pd.DataFrame(index=pd.Index(names[is_tip], name='id'))
+    metadata_df[COLUMN] = acr[is_tip]
+    for drm in DRMS:
+        metadata_df[drm] = np.where(rng.random(n_tips) < .1, 'resistant', 'sensitive')
+    metadata_df.to_csv(data['metadata'], sep='\t')
+    arv_df = pd.DataFrame(ARV_DATA, columns=ARV_COLUMNS)
+    arv_df.to_csv(data['arv_tab'], sep='\t', index=False)
+    for drm, tab in zip(DRMS, data['drm_acrs']):
+        is_cut = dates >= arv_df.loc[arv_df['mutation'] == drm, 'year'].min()
+        pd.DataFrame({'node': names[is_cut], drm.replace(':', ''):
+                      np.where(rng.random(is_cut.sum()) < .1, 'resistant', 'sensitive')})\
+            .to_csv(tab, sep='\t', index=False)
+
+    if aln_length:
+        write_alignment(data['fasta'], names[is_tip], rng, length=aln_length)
+    else:
+        data['fasta'] = None
+
+    with open(path('data.json'), 'w+') as f:
+        json.dump(data, f, indent=2)
+    return data
+
+
+def load_or_generate(data_dir, n_tips, seed=None, **kwargs):
+    """Loads the description of the data set from data_dir/data.json if it matches the parameters, or generates it."""
+    json_path = os.path.join(data_dir, 'data.json')
+    if os.path.exists(json_path):
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        if data['n_tips'] == n_tips and data['seed'] == seed and data['version'] == DATA_VERSION:
+            return data
+    return generate(data_dir, n_tips, seed=seed, **kwargs)
+
+
+if '__main__' == __name__:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generates synthetic benchmark data.")
+    parser.add_argument('--data_dir', required=True, type=str)
+    parser.add_argument('--n_tips', required=True, type=int)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--n_replicates', type=int, default=N_REPLICATES,
+                        help="number of replicate ACR tables to merge")
+    parser.add_argument('--aln_length', type=int, default=ALN_LENGTH,
+                        help="alignment length (0 not to generate an alignment)")
+    params = parser.parse_args()
+
+    generate(params.data_dir, params.n_tips, seed=params.seed, n_replicates=params.n_replicates,
+             aln_length=params.aln_length)
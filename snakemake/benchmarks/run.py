@@ -0,0 +1,453 @@
+import datetime
+import json
+import logging
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from generate import COLUMN, load_or_generate
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PY_DIR = os.path.join(BENCHMARK_DIR, '..', 'py')
+DATA_DIR = os.path.join(BENCHMARK_DIR, 'data')
+HISTORY = os.path.join(BENCHMARK_DIR, 'history.jsonl')
+
+SIZES = [1000, 10000, 100000]
+SEED = 2020
+TOLERANCE = 1.5
+
+
+def collapse_args(data, out_dir):
+    return ['collapse.py', '--input_tree', data['tree'], '--output_tree', os.path.join(out_dir, 'collapsed.nwk'),
+            '--threshold', '0.5', '--feature', 'dist']
+
+
+def cut_by_date_args(data, out_dir):
+    return ['cut_by_date.py', '--input_tree', data['named_tree'], '--arv_tab', data['arv_tab'],
+            '--output_forest', os.path.join(out_dir, 'forest_{}.nwk'), '--root_date', str(data['root_date']),
+            '--arv'] + data['drms']
+
+
+def drm_metadata_args(data, out_dir):
+    return ['drm_metadata.py', '--input_tree', data['named_tree'], '--input_tab', data['metadata'],
+            '--input_acr'] + data['drm_acrs'] \
+        + ['--output_tab'] + [os.path.join(out_dir, 'metadata.{}.tab'.format(_)) for _ in range(len(data['drms']))] \
+        + ['--arv_tab', data['arv_tab'], '--root_date', str(data['root_date']), '--arv'] + data['drms']
+
+
+def merge_tables_args(data, out_dir):
+    tabs = data['replicate_states'] + [data['states']]
+    return ['merge_tables.py', '--input_tabs'] + tabs \
+        + ['--input_names'] + ['{}_{}'.format(COLUMN, _) for _ in range(len(tabs) - 1)] + [COLUMN] \
+        + ['--output_tab', os.path.join(out_dir, 'combined.tab'), '--tree', data['named_tree']]
+
+
+def check_subsampling_args(data, out_dir):
+    return ['check_subsampling.py', '--input_tab', data['combined_states'],
+            '--output_log', os.path.join(out_dir, 'subsampling.log'), '--column', COLUMN]
+
+
+def check_subsampling_replicates_args(data, out_dir):
+    return ['check_subsampling.py', '--full_tab', data['states'], '--replicate_tabs'] + data['replicate_states'] \
+        + ['--tree', data['named_tree'], '--output_log', os.path.join(out_dir, 'subsampling.log'), '--column', COLUMN]
+
+
+def prevalence_args(data, out_dir):
+    return ['prevalence.py', '--input', data['metadata'], '--output', os.path.join(out_dir, 'prevalence.tab'),
+            '--group_by', COLUMN, '--output_tab', os.path.join(out_dir, 'prevalence.groups.tab'), '--seed', str(SEED)]
+
+
+def drm_caller_args(data, out_dir):
+    # the random alignment is taken as covering the HXB2 positions 2000-2499 (the start of PR)
+    return ['drm_caller.py', '--fasta', data['fasta'], '--output', os.path.join(out_dir, 'drms.tab'),
+            '--drms', 'PR:L10F', 'PR:M46IL', 'PR:V82A', '--reference_id', 't0', '--reference_start', '2000']
+
+
+def aln_stats_args(data, out_dir):
+    return ['aln_stats.py', '--fasta', data['fasta'], '--length', os.path.join(out_dir, 'aln.length'),
+            '--output_stats', os.path.join(out_dir, 'aln.stats'), '--output_sites', os.path.join(out_dir, 'aln.sites')]
+
+
+def pastml_columns_args(data, out_dir):
+    return ['pastml_columns.py', '--tree', data['named_tree'], '--data', data['metadata'],
+            '--columns', COLUMN] + data['drms'] + ['--work_dir', os.path.join(out_dir, 'pastml', '{}'),
+                                                   '--resolve_polytomies', '--threads', '2']
+
+
+def subsampling_args(data, out_dir):
+    return ['subsampling.py', '--tree', data['acr_tree'], '--seed', str(SEED),
+            '--subtree'] + [os.path.join(out_dir, 'subtree.{}.nwk'.format(_)) for _ in range(2)]
+
+
+def vis_ltt_args(data, out_dir):
+    return ['vis_LTT.py', '--trees', data['acr_tree'], data['acr_sub_tree'], '--mps', data['mp'], data['mp_sub'],
+            '--time_pdf', os.path.join(out_dir, 'ltt.pdf'), '--png', os.path.join(out_dir, 'ltt.png'),
+            '--column', COLUMN, '--labels', 'full', 'sub']
+
+
+def vis_transmissions_args(data, out_dir):
+    return ['vis_transmissions.py', '--trees', data['acr_tree'], data['acr_sub_tree'],
+            '--mps', data['mp'], data['mp_sub'], '--table', os.path.join(out_dir, 'table.xlsx'),
+            '--column', COLUMN, '--labels', 'full', 'sub', '--out_html', os.path.join(out_dir, 'tr_{}_{}-{}.html'),
+            '--params', data['params'], data['params_sub'], '--seed', str(SEED)]
+
+
+SCRIPTS = {'collapse': collapse_args, 'cut_by_date': cut_by_date_args, 'drm_metadata': drm_metadata_args,
+           'merge_tables': merge_tables_args, 'check_subsampling': check_subsampling_args,
+           'check_subsampling_replicates': check_subsampling_replicates_args,
+           'prevalence': prevalence_args, 'drm_caller': drm_caller_args,
+           'aln_stats': aln_stats_args,
+           'pastml_columns': pastml_columns_args, 'subsampling': subsampling_args, 'vis_LTT': vis_ltt_args,
+           'vis_transmissions': vis_transmissions_args}
+
+
+def setup_read_tree(data):
+    from tree_io import read_tree
+    return read_tree, (data['acr_tree'],), {'columns': [COLUMN], 'use_cache': False}
+
+
+def setup_get_cut_nodes(data):
+    import pandas as pd
+    from cut_by_date import get_arv_year, get_cut_nodes
+    from tree_io import read_tree
+
+    tree = read_tree(data['named_tree'], use_cache=False)
+    arv_df = pd.read_csv(data['arv_tab'], sep='\t')
+    return get_cut_nodes, (tree, tree.root_distances(data['root_date']),
+                           [get_arv_year(arv_df, _)[0] for _ in data['drms']]), {}
+
+
+def setup_annotate_sensitive(data):
+    import pandas as pd
+    from drm_metadata import annotate_sensitive
+    from merge_tables import get_levelorder
+    from tree_io import read_tree
+
+    tree = read_tree(data['named_tree'], use_cache=False)
+    levelorder = get_levelorder(tree)
+    drm = data['drms'][0]
+    df = pd.read_csv(data['metadata'], sep='\t', index_col=0)[[drm]]
+    acr_df = pd.read_csv(data['drm_acrs'][0], sep='\t', index_col=0)
+    return annotate_sensitive, (df, acr_df, drm, tree.names[levelorder],
+                                tree.root_distances(data['root_date'])[levelorder], 2000.), {}
+
+
+def setup_merge_states(data):
+    from merge_tables import get_levelorder, merge_states
+    from tree_io import read_tree
+
+    tree = read_tree(data['named_tree'], use_cache=False)
+    return merge_states, (tree.names[get_levelorder(tree)], data['replicate_states'] + [data['states']]), {}
+
+
+def setup_get_state_counts(data):
+    import pandas as pd
+    from check_subsampling import get_state_counts
+
+    df = pd.read_csv(data['combined_states'], sep='\t', index_col=0)
+    return get_state_counts, (df[[_ for _ in df.columns if _ != COLUMN]],), {}
+
+
+def setup_get_strata(data):
+    from subsampling import get_strata
+    from tree_io import read_tree
+
+    tree = read_tree(data['acr_tree'], columns=[COLUMN], use_cache=False)
+    tree.annotate_dates()
+    return get_strata, (tree,), {}
+
+
+def setup_subsample(data):
+    from subsampling import get_strata, get_stratum_sizes, subsample
+    from tree_io import read_tree
+
+    tree = read_tree(data['acr_tree'], columns=[COLUMN], use_cache=False)
+    tree.annotate_dates()
+    states, strata, tips = get_strata(tree)
+    _, _, stratum_sizes = get_stratum_sizes(states, strata)
+    return subsample, (strata, tips, stratum_sizes, np.random.default_rng(SEED)), {}
+
+
+def setup_get_ltt_summary(data):
+    from vis_LTT import get_ltt_summary
+    return get_ltt_summary, (data['acr_tree'], COLUMN), {'mp_path': data['mp'], 'use_cache': False}
+
+
+def setup_count_windowed_transmissions(data):
+    from mp_store import align_mps, read_mps
+    from tree_io import read_tree
+    from vis_transmissions import count_windowed_transmissions, get_edges
+
+    tree = read_tree(data['acr_tree'], use_cache=False)
+    tree.annotate_dates()
+    nodes, _, mps = read_mps(data['mp'])
+    mps = align_mps(tree, nodes, mps)
+    parent_ids, child_ids = get_edges(tree)
+    return count_windowed_transmissions, (mps, parent_ids, child_ids, tree.dates[parent_ids], tree.tips,
+                                          tree.dates[tree.tips]), {}
+
+
+FUNCTIONS = {'tree_io.read_tree': setup_read_tree, 'cut_by_date.get_cut_nodes': setup_get_cut_nodes,
+             'drm_metadata.annotate_sensitive': setup_annotate_sensitive,
+             'merge_tables.merge_states': setup_merge_states,
+             'check_subsampling.get_state_counts': setup_get_state_counts,
+             'subsampling.get_strata': setup_get_strata, 'subsampling.subsample': setup_subsample,
+             'vis_LTT.get_ltt_summary': setup_get_ltt_summary,
+             'vis_transmissions.count_windowed_transmissions': setup_count_windowed_transmissions}
+
+
+# Runs a command in a fork of this (small) process and writes its wall time and peak RSS (in KB on Linux) to a file:
+# the peak RSS of a process forked from the (large) benchmarking process would start from the latter's.
+LAUNCHER = """
+import os, sys, time
+start = time.perf_counter()
+pid = os.fork()
+if not pid:
+    os.execv(sys.executable, [sys.executable] + sys.argv[2:])
+_, status, usage = os.wait4(pid, 0)
+with open(sys.argv[1], 'w') as f:
+    f.write('{} {}'.format(time.perf_counter() - start, usage.ru_maxrss))
+sys.exit(os.waitstatus_to_exitcode(status))
+"""
+
+
+def run_script(args, timeout=None):
+    """
+    Runs a py/ script in a subprocess (with a fresh tree cache), measuring its wall time and peak memory.
+
+    :return: tuple (seconds, peak RSS in MB, error message or None)
+    """
+    with tempfile.TemporaryDirectory() as temp_dir, tempfile.TemporaryFile() as stderr:
+        env = dict(os.environ, TREE_CACHE_DIR=temp_dir, MPLBACKEND='Agg')
+        usage_path = os.path.join(temp_dir, 'usage')
+        process = subprocess.Popen([sys.executable, '-c', LAUNCHER, usage_path] + args, cwd=PY_DIR, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=stderr, start_new_session=True)
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            return None, None, 'timeout after {}s'.format(timeout)
+        if process.returncode:
+            stderr.seek(0)
+            return None, None, stderr.read().decode(errors='replace').strip().split('\n')[-1]
+        with open(usage_path, 'r') as f:
+            seconds, max_rss = f.read().split()
+    return float(seconds), int(max_rss) / 1024, None
+
+
+def get_startup_commands():
+    """:return: the hivsa subcommands, whose cold start (the time to show their help) is measured"""
+    if PY_DIR not in sys.path:
+        sys.path.insert(0, PY_DIR)
+    from hivsa import COMMANDS
+
+    return list(COMMANDS)
+
+
+def run_function(setup, data):
+    """
+    Calls a py/ function on the prepared inputs, measuring its wall time and peak (traced) memory allocation.
+
+    :return: tuple (seconds, peak allocation in MB, error message or None)
+    """
+    if PY_DIR not in sys.path:
+        sys.path.insert(0, PY_DIR)
+    try:
+        func, args, kwargs = setup(data)
+        tracemalloc.start()
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        return seconds, peak / 1024 / 1024, None
+    except Exception as e:
+        return None, None, '{}: {}'.format(type(e).__name__, e)
+    finally:
+        tracemalloc.stop()
+
+
+def get_commit():
+    """:return: tuple (commit hash, whether the working tree has uncommitted changes)"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARK_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--', PY_DIR], cwd=BENCHMARK_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        return commit, bool(status)
+    except (subprocess.CalledProcessError, OSError):
+        return None, None
+
+
+def run_tasks(tasks, context, n_tips, repeats, history):
+    """
+    Runs the benchmark tasks, and appends the results (the best time and the largest peak memory over the repeats)
+    to the history file.
+
+    :param tasks: list of tuples (kind, name, task), a task returning a tuple (seconds, peak MB, error message or None)
+    :return: list of result records
+    """
+    records = []
+    for kind, name, task in tasks:
+        times, peaks, error = [], [], None
+        for _ in range(repeats):
+            seconds, peak_mb, error = task()
+            if error:
+                break
+            times.append(seconds)
+            peaks.append(peak_mb)
+        record = dict(context, kind=kind, benchmark=name, n_tips=n_tips, repeats=len(times),
+                      seconds=min(times) if times else None,
+                      peak_mb=max(peaks) if peaks and None not in peaks else None, error=error)
+        logging.info('{} {} on {} tips: {}'.format(kind, name, n_tips, error if error else
+                     '{:.3f}s, {:.1f} MB'.format(record['seconds'], record['peak_mb'] or 0)))
+        records.append(record)
+        with open(history, 'a') as f:
+            f.write('{}\n'.format(json.dumps(record)))
+    return records
+
+
+def benchmark(sizes=SIZES, scripts=None, functions=None, startups=None, repeats=1, timeout=None, history=HISTORY,
+              data_dir=DATA_DIR, seed=SEED):
+    """
+    Measures the cold start of the hivsa subcommands (recorded with 0 tips),
+    and runs the script (end-to-end) and function benchmarks on synthetic data sets of the given sizes,
+    appending the results (the best time and the largest peak memory over the repeats) to the history file.
+
+    :return: list of result records
+    """
+    commit, dirty = get_commit()
+    context = {'commit': commit, 'dirty': dirty, 'host': platform.node(), 'python': platform.python_version(),
+               'time': datetime.datetime.now().isoformat(timespec='seconds')}
+    scripts = SCRIPTS if scripts is None else {_: SCRIPTS[_] for _ in scripts}
+    functions = FUNCTIONS if functions is None else {_: FUNCTIONS[_] for _ in functions}
+    startups = get_startup_commands() if startups is None else startups
+
+    records = run_tasks([('startup', name, lambda name=name: run_script(['hivsa.py', name, '--help'], timeout=timeout))
+                         for name in startups], context, 0, repeats, history)
+    for n_tips in sizes:
+        logging.info('Preparing the data for {} tips.'.format(n_tips))
+        data = load_or_generate(os.path.join(data_dir, '{}_{}'.format(n_tips, seed)), n_tips, seed=seed)
+        with tempfile.TemporaryDirectory() as out_dir:
+            tasks = [('script', name, lambda args_fn=args_fn: run_script(args_fn(data, out_dir), timeout=timeout))
+                     for name, args_fn in scripts.items()] \
+                + [('function', name, lambda setup=setup: run_function(setup, data))
+                   for name, setup in functions.items()]
+            records.extend(run_tasks(tasks, context, n_tips, repeats, history))
+    return records
+
+
+def read_history(history=HISTORY):
+    if not os.path.exists(history):
+        return []
+    with open(history, 'r') as f:
+        return [json.loads(_) for _ in f if _.strip()]
+
+
+def get_scaling_exponent(records):
+    """
+    Estimates the exponent k of the time complexity O(n^k) of a benchmark,
+    by a least-squares fit of log(time) against log(number of tips).
+    """
+    records = [_ for _ in records if _['seconds']]
+    if len({_['n_tips'] for _ in records}) < 2:
+        return None
+    x = np.log([_['n_tips'] for _ in records])
+    y = np.log([max(_['seconds'], 1e-6) for _ in records])
+    return np.polyfit(x, y, 1)[0]
+
+
+def compare(history=HISTORY, commit=None, reference=None, tolerance=TOLERANCE):
+    """
+    Compares the latest results of a commit to those of a reference commit
+    (by default the latest one before it in the history).
+
+    :return: list of regression descriptions: the benchmarks that got slower or used more memory
+        by more than the tolerance factor, or whose time scaling exponent grew by more than .25
+    """
+    records = read_history(history)
+    commits = list(dict.fromkeys(_['commit'] for _ in records))
+    if commit is None and commits:
+        commit = commits[-1]
+    if reference is None:
+        older = commits[: commits.index(commit)] if commit in commits else []
+        reference = older[-1] if older else None
+    if commit is None or reference is None:
+        logging.warning('Nothing to compare: there is no result for two different commits in {}.'.format(history))
+        return []
+
+    def latest(c):
+        result = {}
+        for record in records:
+            if record['commit'] == c and not record['error']:
+                result[(record['kind'], record['benchmark'], record['n_tips'])] = record
+        return result
+
+    new, old = latest(commit), latest(reference)
+    print('{} vs {}'.format(commit[:10], reference[:10]))
+    regressions = []
+    for key in sorted(set(new) & set(old), key=lambda _: (_[0], _[1], _[2])):
+        kind, name, n_tips = key
+        time_ratio = new[key]['seconds'] / max(old[key]['seconds'], 1e-6)
+        memory_ratio = new[key]['peak_mb'] / max(old[key]['peak_mb'], 1e-6) \
+            if new[key]['peak_mb'] is not None and old[key]['peak_mb'] is not None else None
+        print('{}\t{}\t{}\ttime x{:.2f}\tmemory {}'.format(kind, name, n_tips, time_ratio,
+                                                       'x{:.2f}'.format(memory_ratio) if memory_ratio else '-'))
+        if time_ratio > tolerance:
+            regressions.append('{} {} on {} tips is {:.2f} times slower'.format(kind, name, n_tips, time_ratio))
+        if memory_ratio and memory_ratio > tolerance:
+            regressions.append('{} {} on {} tips uses {:.2f} times more memory'
+                               .format(kind, name, n_tips, memory_ratio))
+    for kind, name in sorted({_[:2] for _ in set(new) & set(old)}):
+        new_exponent = get_scaling_exponent([v for k, v in new.items() if k[:2] == (kind, name)])
+        old_exponent = get_scaling_exponent([v for k, v in old.items() if k[:2] == (kind, name)])
+        if new_exponent is None or old_exponent is None:
+            continue
+        print('{}\t{}\tscaling n^{:.2f} (was n^{:.2f})'.format(kind, name, new_exponent, old_exponent))
+        if new_exponent > old_exponent + .25:
+            regressions.append('{} {} now scales as n^{:.2f} (was n^{:.2f})'
+                               .format(kind, name, new_exponent, old_exponent))
+    for regression in regressions:
+        logging.warning(regression)
+    return regressions
+
+
+if '__main__' == __name__:
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
+                        filename=None)
+
+    parser = argparse.ArgumentParser(description="Benchmarks the pipeline scripts on synthetic data.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="numbers of tips (e.g. 1000 to 1000000)")
+    parser.add_argument('--scripts', type=str, nargs='*', default=None, choices=list(SCRIPTS.keys()),
+                        help="scripts to run end to end (all by default)")
+    parser.add_argument('--functions', type=str, nargs='*', default=None, choices=list(FUNCTIONS.keys()),
+                        help="functions to run (all by default)")
+    parser.add_argument('--startups', type=str, nargs='*', default=None,
+                        help="hivsa subcommands whose cold start to measure (all by default)")
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=None, help="timeout (in seconds) for each script run")
+    parser.add_argument('--seed', type=int, default=SEED, help="random seed for the data generation")
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR, help="where to keep the generated data")
+    parser.add_argument('--history', type=str, default=HISTORY, help="JSON lines file to append the results to")
+    parser.add_argument('--compare', action='store_true',
+                        help="do not run anything, but compare the latest results to those of a reference commit")
+    parser.add_argument('--commit', type=str, default=None, help="commit to compare (by default the latest one)")
+    parser.add_argument('--reference', type=str, default=None,
+                        help="reference commit (by default the one benchmarked before the compared one)")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help="slowdown (or memory increase) factor from which to report a regression")
+    params = parser.parse_args()
+
+    if params.compare:
+        sys.exit(1 if compare(params.history, params.commit, params.reference, params.tolerance) else 0)
+    benchmark(params.sizes, params.scripts, params.functions, params.startups, repeats=params.repeats, timeout=params.timeout,
+              history=params.history, data_dir=params.data_dir, seed=params.seed)
@@ -0,0 +1,139 @@
+import logging
+import mmap
+
+import numpy as np
+import pandas as pd
+
+import instrument
+from drm_caller import NUCLEOTIDE_MASKS, AlignmentReader, iter_records
+
+# max size of the chunk of sequences processed at once
+CHUNK_BYTES = 1 << 20
+GAPS = b'-.'
+# odd multipliers of the two (mod 2^64) polynomial hashes of the site patterns
+HASH_MULTIPLIERS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F)
+
+IS_GAP = np.zeros(256, dtype=bool)
+IS_GAP[list(GAPS)] = True
+# anything but a gap or a unique nucleotide (e.g. N, R, ?)
+IS_AMBIGUOUS = ~IS_GAP & (np.array([bin(_).count('1') for _ in NUCLEOTIDE_MASKS.tolist()]) != 1)
+# the site pattern codes: case-insensitive, U as T, all the gaps (and unknown characters) the same
+PATTERN_CODES = NUCLEOTIDE_MASKS.astype(np.uint64) + 1
+
+
+def _get_powers(multiplier, n):
+    """:return: uint64 array of multiplier^(n - 1), ..., multiplier^0 (mod 2^64)"""
+    powers = [1] * n
+    for i in range(n - 2, -1, -1):
+        powers[i] = powers[i + 1] * multiplier % (1 << 64)
+    return np.array(powers, dtype=np.uint64)
+
+
+def iter_record_chunks(mm, chunk_bytes=CHUNK_BYTES):
+    """
+    Finds the records of a (memory-mapped) fasta file, by chunks of consecutive records of about chunk_bytes.
+
+    :return: generator of tuples (starts, ends) of arrays of the byte offsets of the record sequences
+    """
+    starts, ends = [], []
+    for _, start, end in iter_records(mm):
+        starts.append(start)
+        ends.append(end)
+        if end - starts[0] >= chunk_bytes:
+            yield np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+            starts, ends = [], []
+    if starts:
+        yield np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+
+def get_alignment_stats(fasta, chunk_bytes=CHUNK_BYTES):
+    """
+    Calculates the alignment statistics in one pass over the memory-mapped alignment,
+    by chunks of consecutive sequences of about chunk_bytes, whose pages are released once processed.
+    The site patterns are hashed (with two 64-bit polynomial hashes, sequence by sequence)
+    instead of being kept, so that the memory only depends on the alignment length.
+
+    :return: tuple (n_sequences, gap_counts, ambiguity_counts, n_patterns), where gap_counts and ambiguity_counts
+        are arrays of the numbers of gaps and of ambiguous characters at each site
+    """
+    reader = AlignmentReader(fasta)
+    n_sequences, released, powers = 0, 0, {}
+    try:
+        with instrument.phase('compute'):
+            for starts, ends in iter_record_chunks(reader.mm, chunk_bytes):
+                if not n_sequences:
+                    reader.set_layout(starts[0], ends[0])
+                    columns = np.arange(reader.length)
+                    gap_counts = np.zeros(reader.length, dtype=np.int64)
+                    ambiguity_counts = np.zeros(reader.length, dtype=np.int64)
+                    hashes = np.zeros((len(HASH_MULTIPLIERS), reader.length), dtype=np.uint64)
+                chunk = reader.gather(starts, ends, columns)
+                n_sequences += len(chunk)
+                gap_counts += np.count_nonzero(IS_GAP[chunk], axis=0)
+                ambiguity_counts += np.count_nonzero(IS_AMBIGUOUS[chunk], axis=0)
+                codes = PATTERN_CODES[chunk]
+                n = len(chunk)
+                if n not in powers:
+                    powers[n] = [_get_powers(_, n + 1) for _ in HASH_MULTIPLIERS]
+                for i, chunk_powers in enumerate(powers[n]):
+                    # h <- h * m^n + sum_k code_k * m^(n - 1 - k)
+                    hashes[i] = hashes[i] * chunk_powers[0] + chunk_powers[1:] @ codes
+
+                # the processed records are not read again
+                done = ends[-1] // mmap.PAGESIZE * mmap.PAGESIZE
+                if done > released and hasattr(mmap, 'MADV_DONTNEED'):
+                    reader.mm.madvise(mmap.MADV_DONTNEED, released, done - released)
+                    released = done
+            if not n_sequences:
+                raise ValueError('Could not find any sequences in {}.'.format(fasta))
+            n_patterns = np.unique(hashes, axis=1).shape[1] if reader.length else 0
+        instrument.count(sequences=n_sequences, sites=reader.length)
+    finally:
+        reader.close()
+    return n_sequences, gap_counts, ambiguity_counts, n_patterns
+
+
+def main(argv=None):
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
+                        filename=None)
+
+    parser = argparse.ArgumentParser(description="Calculates the length, the per-site gap and ambiguity fractions "
+                                                 "and the number of distinct site patterns of a (fasta) alignment.")
+    parser.add_argument('--fasta', required=True, type=str, help="the alignment.")
+    parser.add_argument('--length', required=False, type=str, default=None,
+                        help="(optional) output file for the alignment length (as goalign stats length).")
+    parser.add_argument('--output_stats', required=False, type=str, default=None,
+                        help="(optional) output table of the alignment statistics (parameter, value).")
+    parser.add_argument('--output_sites', required=False, type=str, default=None,
+                        help="(optional) output table of the per-site gap and ambiguity fractions.")
+    parser.add_argument('--chunk_bytes', type=int, default=CHUNK_BYTES,
+                        help="max size of the chunk of sequences processed at once.")
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('aln_stats', params.instrument)
+
+    n_sequences, gap_counts, ambiguity_counts, n_patterns = get_alignment_stats(params.fasta, params.chunk_bytes)
+    length = len(gap_counts)
+    logging.info('The alignment of {} sequences has {} sites and {} distinct site patterns.'
+                 .format(n_sequences, length, n_patterns))
+
+    with instrument.phase('write'):
+        if params.length:
+            with open(params.length, 'w+') as f:
+                f.write('{}\n'.format(length))
+        n_characters = max(1, n_sequences * length)
+        if params.output_stats:
+            pd.Series({'sequences': n_sequences, 'length': length, 'site_patterns': n_patterns,
+                       'gap_fraction': gap_counts.sum() / n_characters,
+                       'ambiguity_fraction': ambiguity_counts.sum() / n_characters}, dtype=object, name='value')\
+                .to_csv(params.output_stats, sep='\t', index_label='parameter')
+        if params.output_sites:
+            pd.DataFrame({'site': np.arange(1, length + 1), 'gap_fraction': gap_counts / n_sequences,
+                          'ambiguity_fraction': ambiguity_counts / n_sequences})\
+                .to_csv(params.output_sites, sep='\t', index=False)
+
+
+if '__main__' == __name__:
+    main()
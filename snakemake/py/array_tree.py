@@ -0,0 +1,398 @@
+import copy
+
+import numpy as np
+
+DATE = 'date'
+
+
+class ArrayTree(object):
+    """
+    Compact array-backed representation of a rooted tree.
+
+    The nodes are numbered in preorder (the root is 0, each parent comes before its children,
+    and each subtree occupies a contiguous index range [i, ends[i])), and are described by arrays:
+    parents (-1 for the root), branch lengths (dists), dates and names.
+    To keep the per-node footprint small, the names are packed into one newline-separated string
+    with an array of offsets, and are unpacked into an array on demand.
+    The children are stored in a CSR-like way: the children of node i are
+    child_indices[child_offsets[i]: child_offsets[i + 1]].
+    Optional per-node features (e.g. PastML states) are stored as object arrays in the features dictionary.
+    """
+
+    def __init__(self, parents, dists, names, dates=None, features=None, ends=None):
+        """
+        :param parents: array of parent indices (-1 for the root), the nodes must be numbered in preorder
+        :param dists: array of branch lengths
+        :param names: array of node names (or a string of newline-separated names)
+        :param dates: (optional) array of node dates (NaN for unknown)
+        :param features: (optional) dictionary feature name -> array of per-node values
+        :param ends: (optional) array of subtree range ends, calculated if not given
+        """
+        self.parents = np.asarray(parents, dtype=np.int32)
+        n = len(self.parents)
+        self.dists = np.asarray(dists, dtype=np.float64)
+        self._names = names if isinstance(names, str) else '\n'.join(map(str, names))
+        name_lengths = np.fromiter((len(_) + 1 for _ in self._names.split('\n')), dtype=np.int64, count=n) \
+            if n else np.zeros(0, dtype=np.int64)
+        self._name_offsets = np.zeros(n + 1, dtype=np.uint32 if len(self._names) < 2 ** 32 - 1 else np.int64)
+        np.cumsum(name_lengths, out=self._name_offsets[1:])
+        self.dates = np.full(n, np.nan) if dates is None else np.asarray(dates, dtype=np.float64)
+        self.features = dict(features) if features else {}
+
+        non_root = np.arange(1, n)
+        if n and (self.parents[0] != -1 or np.any(self.parents[1:] >= non_root) or np.any(self.parents[1:] < 0)):
+            raise ValueError('The tree nodes must be numbered in preorder, starting from the root.')
+        # preorder numbering with stable sorting keeps the children in their original order
+        self.child_indices = non_root[np.argsort(self.parents[1:], kind='stable')].astype(np.int32)
+        self.child_offsets = np.zeros(n + 1, dtype=np.int32)
+        np.cumsum(np.bincount(self.parents[1:], minlength=n), out=self.child_offsets[1:])
+
+        if ends is None:
+            parents_, sizes = self.parents.tolist(), [1] * n
+            for i in range(n - 1, 0, -1):
+                sizes[parents_[i]] += sizes[i]
+            ends = np.arange(n) + np.array(sizes)
+        self.ends = np.asarray(ends, dtype=np.int32)
+        self._name2index = None
+
+    def copy(self):
+        """
+        Copies the tree, sharing the topology and the names with it,
+        but not the branch lengths, the dates or the feature dictionary, which scripts modify.
+        """
+        tree = copy.copy(self)
+        tree.dists, tree.dates, tree.features = self.dists.copy(), self.dates.copy(), dict(self.features)
+        return tree
+
+    def __len__(self):
+        """Returns the number of tips, as len() of an ete3 tree does."""
+        return int(np.count_nonzero(self.is_tip))
+
+    @property
+    def n_nodes(self):
+        return len(self.parents)
+
+    @property
+    def is_tip(self):
+        return self.child_offsets[1:] == self.child_offsets[:-1]
+
+    @property
+    def tips(self):
+        return np.flatnonzero(self.is_tip)
+
+    @property
+    def names(self):
+        return np.array(self._names.split('\n') if self.n_nodes else [], dtype=object)
+
+    def name(self, i):
+        return self._names[self._name_offsets[i]: self._name_offsets[i + 1] - 1]
+
+    def get_names(self, start, stop):
+        """Lists the names of the nodes start, ..., stop - 1, without unpacking the other names."""
+        if start >= stop:
+            return []
+        return self._names[self._name_offsets[start]: self._name_offsets[stop] - 1].split('\n')
+
+    @property
+    def name2index(self):
+        """Hash index of node names to node indices."""
+        if self._name2index is None:
+            self._name2index = dict(zip(self._names.split('\n'), range(self.n_nodes)))
+        return self._name2index
+
+    def index(self, names):
+        """Finds the indices of the given node names."""
+        name2index = self.name2index
+        return np.array([name2index[_] for _ in names], dtype=np.int32)
+
+    def children(self, i):
+        return self.child_indices[self.child_offsets[i]: self.child_offsets[i + 1]]
+
+    def n_children(self):
+        return np.diff(self.child_offsets)
+
+    def preorder(self):
+        return np.arange(self.n_nodes, dtype=np.int32)
+
+    def postorder(self):
+        """Returns the nodes in an order where each child comes before its parent."""
+        return np.arange(self.n_nodes - 1, -1, -1, dtype=np.int32)
+
+    def subtree(self, i):
+        """Returns the indices of the nodes in the subtree rooted at node i (in preorder)."""
+        return np.arange(i, self.ends[i], dtype=np.int32)
+
+    def is_ancestor(self, i, j):
+        """Checks if node i is an ancestor of (or the same as) node j(s)."""
+        return (i <= j) & (j < self.ends[i])
+
+    def depths(self):
+        """Calculates the number of branches between the root and each node."""
+        # a subtree occupies a contiguous index range, so each non-root node increments the depth of its range
+        diff = np.zeros(self.n_nodes + 1, dtype=np.int32)
+        diff[1: self.n_nodes] = 1
+        np.add.at(diff, self.ends[1:], -1)
+        return np.cumsum(diff[:-1], dtype=np.int32)
+
+    def root_distances(self, root_value=0.):
+        """
+        Calculates the distance from the root to each node (the root branch length is not included),
+        adding it up to the root value branch by branch from the root down, level by level.
+        """
+        distances = np.empty(self.n_nodes, dtype=np.float64)
+        if not self.n_nodes:
+            return distances
+        distances[0] = root_value
+        depths = self.depths()
+        order = np.argsort(depths, kind='stable')
+        bounds = np.searchsorted(depths[order], np.arange(1, depths.max() + 2))
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            level = order[start: stop]
+            distances[level] = distances[self.parents[level]] + self.dists[level]
+        return distances
+
+    def annotate_dates(self, root_date=None):
+        """
+        Fills in the unknown node dates as their parent date + branch length,
+        starting from the known root date, or the given root date, or 0 (as pastml.tree.annotate_dates does).
+
+        :return: the array of node dates
+        """
+        if not self.n_nodes:
+            return self.dates
+        if np.isnan(self.dates[0]):
+            self.dates[0] = root_date if root_date else 0
+        unknown = np.isnan(self.dates)
+        if not np.any(unknown):
+            return self.dates
+        if np.all(unknown[1:]):
+            self.dates = self.root_distances(self.dates[0])
+            return self.dates
+        dates, parents, dists = self.dates.tolist(), self.parents.tolist(), self.dists.tolist()
+        for i in np.flatnonzero(unknown).tolist():
+            dates[i] = dates[parents[i]] + dists[i]
+        self.dates = np.array(dates, dtype=np.float64)
+        return self.dates
+
+    def nbytes(self):
+        """Estimates the memory used by the tree (features excluded)."""
+        arrays = (self.parents, self.dists, self._name_offsets, self.dates, self.child_indices, self.child_offsets,
+                  self.ends)
+        return sum(_.nbytes for _ in arrays) + len(self._names)
+
+    def to_arrays(self, prefix=''):
+        """
+        Lists the arrays describing the tree (e.g. to be saved with numpy.savez).
+        The feature values must be strings (or None).
+        """
+        arrays = {'parents': self.parents, 'dists': self.dists, 'dates': self.dates, 'ends': self.ends,
+                  'names': np.frombuffer(self._names.encode(), dtype=np.uint8)}
+        for feature, values in self.features.items():
+            arrays['feature.{}.mask'.format(feature)] = np.array([_ is not None for _ in values], dtype=bool)
+            arrays['feature.{}'.format(feature)] = \
+                np.frombuffer('\n'.join(_ for _ in values if _ is not None).encode(), dtype=np.uint8)
+        return {prefix + key: value for key, value in arrays.items()}
+
+    @staticmethod
+    def from_arrays(arrays, prefix=''):
+        """Reconstructs a tree from the arrays listed by ArrayTree.to_arrays (e.g. loaded with numpy.load)."""
+        features = {}
+        feature_prefix = prefix + 'feature.'
+        for key in arrays.keys():
+            if key.startswith(feature_prefix) and not key.endswith('.mask'):
+                mask = arrays['{}.mask'.format(key)]
+                values = np.full(len(mask), None, dtype=object)
+                if np.any(mask):
+                    values[mask] = arrays[key].tobytes().decode().split('\n')
+                features[key[len(feature_prefix):]] = values
+        return ArrayTree(arrays[prefix + 'parents'], arrays[prefix + 'dists'],
+                         arrays[prefix + 'names'].tobytes().decode(), arrays[prefix + 'dates'],
+                         features, arrays[prefix + 'ends'])
+
+    def save(self, path):
+        """Saves the tree into a binary .npz file."""
+        np.savez(path, **self.to_arrays())
+
+    @staticmethod
+    def load(path):
+        """Loads a tree saved with ArrayTree.save."""
+        with np.load(path) as npz:
+            return ArrayTree.from_arrays(npz)
+
+    @staticmethod
+    def from_ete3(tree, features=None):
+        """
+        Converts an ete3 (or pastml) tree into an ArrayTree.
+
+        :param tree: ete3.TreeNode
+        :param features: (optional) list of node features to keep (the date feature is always kept if present)
+        """
+        parents, dists, names, dates = [], [], [], []
+        feature2values = {_: [] for _ in (features or [])}
+        node2index = {}
+        for i, n in enumerate(tree.traverse('preorder')):
+            node2index[n] = i
+            parents.append(node2index[n.up] if i else -1)
+            dists.append(n.dist)
+            names.append(n.name)
+            date = getattr(n, DATE, None)
+            dates.append(np.nan if date is None else float(date))
+            for feature, values in feature2values.items():
+                values.append(getattr(n, feature, None))
+        feature2array = {}
+        for feature, values in feature2values.items():
+            feature2array[feature] = np.empty(len(values), dtype=object)
+            feature2array[feature][:] = values
+        return ArrayTree(parents, dists, names, dates, feature2array)
+
+    def prune(self, keep_tips):
+        """
+        Builds the subtree induced by the given tips: the other tips are removed,
+        and the internal nodes left with one child are merged with it (their branch lengths are summed up),
+        as pastml.tree.remove_certain_leaves does.
+        As there, the merged node child moves to the end of its new parent's children.
+
+        :param keep_tips: indices of the tips to keep
+        :return: pruned ArrayTree (or None if no tip is kept)
+        """
+        kept_tips = np.zeros(self.n_nodes + 1, dtype=np.int64)
+        kept_tips[np.asarray(keep_tips, dtype=np.int64) + 1] = 1
+        kept_tips = np.cumsum(kept_tips)
+        n_kept_tips = kept_tips[self.ends] - kept_tips[:-1]
+        kept = n_kept_tips > 0
+        if not kept[0]:
+            return None
+        n_kept_children = np.bincount(self.parents[1:][kept[1:]], minlength=self.n_nodes)
+        # a kept node with one kept child gets merged into it
+        retained = np.flatnonzero(kept & (n_kept_children != 1))
+
+        new_parents = np.full(len(retained), -1, dtype=np.int32)
+        stack = []
+        ends = self.ends.tolist()
+        for new_i, i in enumerate(retained.tolist()):
+            while stack and ends[retained[stack[-1]]] <= i:
+                stack.pop()
+            if stack:
+                new_parents[new_i] = stack[-1]
+            stack.append(new_i)
+
+        # pastml removes the tips in preorder, and a node gets merged when the last removed tip
+        # of its subtree outside of its kept child is removed: the kept child then moves to the end of the children
+        # of the merged node's parent. Each retained node therefore comes after its original siblings,
+        # in the order of the last merge between it and its new parent (if any).
+        last_removed = np.full(self.n_nodes + 1, -1, dtype=np.int64)
+        last_removed[1:] = np.maximum.accumulate(np.where(self.is_tip & ~kept, np.arange(self.n_nodes), -1))
+        is_merged = kept & (n_kept_children == 1)
+        merged_ids = np.flatnonzero(is_merged)
+        kept_child_ids = np.zeros(self.n_nodes, dtype=np.int64)
+        kept_ids = np.flatnonzero(kept[1:]) + 1
+        kept_child_ids[self.parents[kept_ids]] = kept_ids
+        merged_child_ids = kept_child_ids[merged_ids]
+        merge_times = np.full(self.n_nodes, -1, dtype=np.int64)
+        after = last_removed[self.ends[merged_ids]]
+        before = last_removed[merged_child_ids]
+        merge_times[merged_ids] = np.where(after >= self.ends[merged_child_ids], after,
+                                           np.where(before >= merged_ids, before, -1))
+
+        # When merging a node, pastml adds its branch length to the one of its child at that moment
+        # (the closest node below it that is not merged yet), so the branch lengths are summed up in the merge order
+        # to get exactly the same values.
+        dists = self.dists.tolist()
+        merged_into = {}
+        for i in merged_ids[np.argsort(merge_times[merged_ids], kind='stable')].tolist():
+            j = int(kept_child_ids[i])
+            while j in merged_into:
+                j = merged_into[j]
+            dists[j] += dists[i]
+            merged_into[i] = j
+        new_dists = np.array(dists, dtype=self.dists.dtype)[retained]
+        move_times = np.full(self.n_nodes, -1, dtype=np.int64)
+        depths = self.depths()
+        order = np.argsort(depths, kind='stable')
+        bounds = np.searchsorted(depths[order], np.arange(1, depths.max() + 2))
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            level = order[start: stop]
+            parents = self.parents[level]
+            move_times[level] = np.where(is_merged[parents], np.maximum(move_times[parents], merge_times[parents]), -1)
+        move_times = move_times[retained]
+
+        names = self.names[retained]
+        dates, features = self.dates[retained], {f: v[retained] for f, v in self.features.items()}
+        if np.any(move_times[1:] >= 0):
+            n_retained = np.zeros(self.n_nodes + 1, dtype=np.int64)
+            n_retained[retained + 1] = 1
+            n_retained = np.cumsum(n_retained)
+            positions = _get_preorder_positions(new_parents, n_retained[self.ends[retained]] - n_retained[retained],
+                                                move_times)
+            order = np.argsort(positions)
+            new_parents = np.where(new_parents[order] >= 0, positions[new_parents[order]], -1)
+            new_dists, names, dates = new_dists[order], names[order], dates[order]
+            features = {f: v[order] for f, v in features.items()}
+        return ArrayTree(new_parents, new_dists, names, dates, features)
+
+    def to_ete3(self, i=0, features=None):
+        """
+        Converts the subtree rooted at node i into an ete3 tree.
+
+        :param i: the index of the subtree root
+        :param features: (optional) list of features to be added to the nodes ('date' for dates)
+        """
+        from ete3 import TreeNode
+
+        features = features or []
+        i2node = {}
+        for j in range(i, int(self.ends[i])):
+            node = TreeNode(dist=float(self.dists[j]), name=self.name(j))
+            for feature in features:
+                value = self.dates[j] if DATE == feature else self.features[feature][j]
+                if value is not None and not (DATE == feature and np.isnan(value)):
+                    node.add_feature(feature, value)
+            i2node[j] = node
+            if j != i:
+                i2node[int(self.parents[j])].add_child(node)
+        return i2node[i]
+
+
+def _get_preorder_positions(parents, sizes, keys):
+    """
+    Calculates the preorder positions of the nodes of a tree whose children get reordered:
+    the children of each node are sorted by their keys (and then by their current order).
+
+    :param parents: array of parent indices (-1 for the root), in preorder
+    :param sizes: array of subtree sizes (in nodes)
+    :param keys: array of node sort keys
+    :return: array of new node positions
+    """
+    n = len(parents)
+    children = np.arange(1, n)
+    children = children[np.lexsort((children, keys[children], parents[children]))]
+    child_parents, child_sizes = parents[children], sizes[children]
+    offsets = np.cumsum(child_sizes) - child_sizes
+    starts = np.flatnonzero(np.r_[True, child_parents[1:] != child_parents[:-1]]) if len(children) \
+        else np.zeros(0, dtype=np.int64)
+    offsets -= np.repeat(offsets[starts], np.diff(np.r_[starts, len(children)]))
+    shifts = np.zeros(n, dtype=np.int64)
+    shifts[children] = offsets + 1
+
+    # the parents come before their children in the current preorder
+    positions = np.zeros(n, dtype=np.int64)
+    depths = np.zeros(n, dtype=np.int64)
+    for i in range(1, n):
+        depths[i] = depths[parents[i]] + 1
+    order = np.argsort(depths, kind='stable')
+    bounds = np.searchsorted(depths[order], np.arange(1, depths.max() + 2))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        level = order[start: stop]
+        positions[level] = positions[parents[level]] + shifts[level]
+    return positions
+
+
+def read_array_tree(nwk, columns=None, features=None):
+    """
+    Reads a tree with pastml.tree.read_tree and converts it into an ArrayTree.
+
+    :param columns: PastML columns to be kept as features (their values are parsed into sets of states)
+    :param features: other node features to be kept as they are
+    """
+    from pastml.tree import read_tree
+    return ArrayTree.from_ete3(read_tree(nwk, columns=columns), features=(columns or []) + (features or []))
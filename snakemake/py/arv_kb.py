@@ -0,0 +1,218 @@
+import json
+import logging
+import os
+import re
+
+import pandas as pd
+
+KB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'arv_kb')
+DRUG_TAB = os.path.join(KB_DIR, 'drugs.tab')
+MUTATION_TAB = os.path.join(KB_DIR, 'mutations.tab')
+CACHE_ENV = 'ARV_KB_CACHE'
+HIVDB_VERSION = '# hivdb version:'
+
+MUTATION = 'mutation'
+DRUG_ABBR = 'drug abbreviation'
+YEAR = 'year'
+COLUMNS = [MUTATION, 'drug class', 'drug full name', DRUG_ABBR, 'score', 'note']
+
+QUERY = '''
+name,
+drugResistance {
+    gene { name },
+    drugScores {
+        drugClass { name },
+        drug { displayAbbr, fullName },
+        score,
+        text,
+        partialScores {
+            mutations {
+                text,
+            },
+        },
+    }
+}
+'''
+
+
+def normalize_drm(drm):
+    return drm.replace('PR_', 'PR:').replace('RT_', 'RT:').replace('IN_', 'IN:')
+
+
+def read_kb_tab(path):
+    """
+    Reads a knowledge base table, whose first line contains its version (# version: ...).
+
+    :return: tuple (version, DataFrame)
+    """
+    with open(path, 'r') as f:
+        first_line = f.readline()
+    version = first_line.split(':', 1)[1].strip() if first_line.startswith('# version:') else None
+    return version, pd.read_csv(path, sep='\t', comment='#', dtype={'score': float})
+
+
+def read_hivdb_version(path=MUTATION_TAB):
+    """:return: the HIVdb version the knowledge base table was built with (# hivdb version: ...), or None"""
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            if line.startswith(HIVDB_VERSION):
+                return line[len(HIVDB_VERSION):].strip()
+    return None
+
+
+def get_sierra_version():
+    """Returns the current HIVdb version of Sierra (needs network access)."""
+    from sierrapy import SierraClient
+
+    return SierraClient().current_version()[0]['text']
+
+
+def query_sierra(drms):
+    """
+    Queries Sierra (HIVdb) for the drugs to which the given DRMs confer resistance,
+    analysing each DRM separately, but sending them all in one batch.
+
+    :return: DataFrame with COLUMNS
+    """
+    from sierrapy import SierraClient
+
+    data = []
+    patterns = [(drm, [drm]) for drm in drms]
+    for drm, result in zip(drms, SierraClient().pattern_analysis(patterns, QUERY, step=max(len(drms), 1))):
+        for dr in result['drugResistance']:
+            gene = dr['gene']['name']
+            for ds in dr['drugScores']:
+                text = ds['text']
+                if 'Resistance' not in text:
+                    continue
+                drug_class = ds['drugClass']['name']
+                drug_abbr = ds['drug']['displayAbbr'].replace('/r', '')
+                drug_name = ds['drug']['fullName'].replace('/r', '')
+                for ps in ds['partialScores']:
+                    for _ in ps['mutations']:
+                        data.append(['{}:{}'.format(gene, _['text']), drug_class, drug_name, drug_abbr, ds['score'],
+                                     text])
+    return pd.DataFrame(data, columns=COLUMNS)
+
+
+def get_local_backend(path=MUTATION_TAB):
+    """
+    Creates a backend resolving DRMs from a local mutation table (e.g. the knowledge base, or a test stub).
+    A DRM present in the table with no drug is known to confer no resistance.
+    """
+    _, kb_df = read_kb_tab(path)
+    known = set(kb_df[MUTATION])
+
+    def resolve(drms):
+        df = kb_df[kb_df[MUTATION].isin(drms) & ~kb_df[DRUG_ABBR].isna()]
+        return df[COLUMNS], [_ for _ in drms if _ in known]
+
+    return resolve
+
+
+def get_sierra_backend():
+    """Creates a backend resolving DRMs by querying Sierra (needs network access)."""
+
+    def resolve(drms):
+        return query_sierra(drms), list(drms)
+
+    return resolve
+
+
+BACKENDS = {'local': get_local_backend, 'sierra': get_sierra_backend}
+
+
+def get_drug_year(drug):
+    """Scrapes the drug approval year from Wikipedia (needs network access)."""
+    import wikipedia
+
+    summary = wikipedia.page(wikipedia.search('{} HIV'.format(drug))[0]).summary
+    dates = set()
+    for date in re.findall(r'\s[12][901][8901]\d[^\d]', summary):
+        index = summary.find(date)
+        prev_sentence = summary[max(0, index - 50): index]
+        if 'approv' in prev_sentence or 'sold ' in prev_sentence:
+            dates.add(date[1:-1])
+    return min(dates) if dates else None
+
+
+def get_cache_path(backend_names, hivdb_version=None):
+    """
+    Returns the path of the persistent DRM cache for the given backends, knowledge base version and HIVdb version
+    (by default the one the knowledge base was built with).
+    """
+    version, _ = read_kb_tab(MUTATION_TAB)
+    if hivdb_version is None:
+        hivdb_version = read_hivdb_version(MUTATION_TAB)
+    cache_dir = os.environ.get(CACHE_ENV, os.path.join(KB_DIR, '.cache'))
+    return os.path.join(cache_dir, 'drms.{}.{}.{}.json'
+                        .format('_'.join(backend_names), version, re.sub(r'[^\w.-]', '_', str(hivdb_version))))
+
+
+def resolve_drms(drms, backends, cache_path=None):
+    """
+    Resolves the DRMs into the drugs they confer resistance to:
+    first from the cache, then from each backend in turn (in one batch for all the DRMs still unresolved).
+    The newly resolved DRMs are added to the cache.
+
+    :param backends: list of backend functions, taking a list of DRMs and returning a tuple (DataFrame, resolved DRMs)
+    :return: DataFrame with COLUMNS
+    """
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    dfs = [pd.DataFrame(cache[_], columns=COLUMNS) for _ in drms if _ in cache]
+    todo = [_ for _ in drms if _ not in cache]
+    for backend in backends:
+        if not todo:
+            break
+        df, resolved = backend(todo)
+        for drm in resolved:
+            cache[drm] = df[df[MUTATION] == drm].values.tolist()
+        dfs.append(df)
+        todo = [_ for _ in todo if _ not in set(resolved)]
+    if todo:
+        logging.warning('Could not resolve DRMs {}.'.format(', '.join(todo)))
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path + '.tmp', 'w+') as f:
+            json.dump(cache, f)
+        os.replace(cache_path + '.tmp', cache_path)
+    df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame(columns=COLUMNS)
+    return df.astype({'score': float})
+
+
+def add_years(df, drug_tab=DRUG_TAB, scrape=False):
+    """
+    Adds the drug approval years (from the knowledge base, or scraped from Wikipedia if not found there).
+    """
+    _, drug_df = read_kb_tab(drug_tab)
+    abbr2year = dict(zip(drug_df[DRUG_ABBR].str.upper(), drug_df[YEAR]))
+    df[YEAR] = df[DRUG_ABBR].str.upper().map(abbr2year)
+    for drug in df.loc[df[YEAR].isna(), 'drug full name'].unique():
+        year = get_drug_year(drug) if scrape else None
+        if year is None:
+            logging.warning('Could not find the approval year of {}.'.format(drug))
+        df.loc[df['drug full name'] == drug, YEAR] = year
+    return df
+
+
+def get_arv_metadata(drms, backend_names=('local', 'sierra'), scrape=False, use_cache=True, hivdb_version=None):
+    """
+    Finds the drugs (with their class, score and approval year) to which the given DRMs confer resistance.
+
+    :param drms: list of DRMs, e.g. RT:K103N
+    :param backend_names: names of the backends to try in turn (see BACKENDS)
+    :param scrape: whether to scrape the years missing from the knowledge base from Wikipedia
+    :param hivdb_version: HIVdb version of Sierra (by default the one the knowledge base was built with),
+        the DRMs cached for another version are not reused
+    :return: DataFrame with COLUMNS and year
+    """
+    drms = list(dict.fromkeys(normalize_drm(_) for _ in drms))
+    backends = [BACKENDS[_]() for _ in backend_names]
+    df = resolve_drms(drms, backends,
+                      cache_path=get_cache_path(backend_names, hivdb_version) if use_cache else None)
+    return add_years(df, scrape=scrape)
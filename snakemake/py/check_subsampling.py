@@ -1,73 +1,236 @@
+import multiprocessing
 from collections import Counter
 
+import numpy as np
 import pandas as pd
 
-if '__main__' == __name__:
+import instrument
+import memo
+from merge_tables import get_levelorder, read_states
+from tree_io import read_tree
+
+COUNTS_SUFFIX = '.npz'
+
+
+class StateCounter(object):
+    """
+    Running per-node counts of the ACRs predicting each state (the majority tallies),
+    and of the ACRs predicting any state for the node. The ACRs are added one at a time
+    into fixed-size node arrays, so that the memory does not depend on the number of ACRs.
+    The states are indexed in the order they are first seen.
+    """
+
+    def __init__(self, ids):
+        self.ids = pd.Index(ids)
+        self.states = []
+        self._state2index = {}
+        self.counts = np.zeros((len(self.ids), 0), dtype=np.int32)
+        self.n = np.zeros(len(self.ids), dtype=np.int32)
+
+    def _get_state_indices(self, states):
+        for state in states:
+            if state not in self._state2index:
+                self._state2index[state] = len(self.states)
+                self.states.append(state)
+        if len(self.states) > self.counts.shape[1]:
+            self.counts = np.hstack([self.counts, np.zeros((len(self.ids), len(self.states) - self.counts.shape[1]),
+                                                           dtype=self.counts.dtype)])
+        return np.array([self._state2index[_] for _ in states], dtype=np.int64)
+
+    def add(self, names, value_codes, values):
+        """
+        Adds an ACR: the nodes that are not counted are skipped, and so are the repeated predictions.
+
+        :param names: array of node names, one per predicted state (see merge_tables.read_states)
+        :param value_codes: parallel array of the predicted state codes (-1 for none), indexing values
+        :param values: array of states
+        """
+        self.add_codes(self.ids.get_indexer(names), value_codes, values)
+
+    def add_codes(self, codes, value_codes, values):
+        """Adds an ACR (see add), whose node names are given as their indices in the ids (-1 for the others)."""
+        value_codes = np.asarray(value_codes)
+        mask = (codes >= 0) & (value_codes >= 0)
+        state_indices = self._get_state_indices(values)[value_codes[mask]]
+        present = np.zeros(self.counts.shape, dtype=bool)
+        present[codes[mask], state_indices] = True
+        self.counts += present
+        self.n += present.any(axis=1)
+
+    def merge(self, other):
+        """Adds the counts of another counter (e.g. of another batch of ACRs), for the nodes counted here."""
+        codes = self.ids.get_indexer(other.ids)
+        mask = codes >= 0
+        state_indices = self._get_state_indices(other.states)
+        self.counts[codes[mask][:, np.newaxis], state_indices] += other.counts[mask]
+        self.n[codes[mask]] += other.n[mask]
+
+    def save(self, path):
+        np.savez(path, ids=self.ids.to_numpy(dtype=str), states=np.array(self.states, dtype=str), counts=self.counts,
+                 n=self.n)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as npz:
+            counter = StateCounter(npz['ids'])
+            counter._get_state_indices(npz['states'].tolist())
+            counter.counts[:], counter.n[:] = npz['counts'], npz['n']
+        return counter
+
+    def to_frames(self):
+        """
+        :return: tuple (counts, n): node x state DataFrame of ACR counts (states are sorted),
+            and Series of the number of ACRs with at least one state predicted, for each node.
+        """
+        states = sorted(self.states)
+        return pd.DataFrame(index=self.ids, columns=states, data=self.counts[:, self._get_state_indices(states)]), \
+            pd.Series(index=self.ids, data=self.n)
+
+
+def get_state_counts(df):
+    """
+    Counts in how many of the table columns each node has each state.
+
+    :param df: table with (possibly repeated) node ids as index, and a column per (sub)tree ACR.
+    :return: tuple (counts, n): node x state DataFrame of column counts (states are sorted),
+        and Series of the number of columns with at least one state predicted, for each node.
+    """
+    id_codes, ids = pd.factorize(df.index)
+    counter = StateCounter(ids)
+    for column in df.columns:
+        counter.add_codes(id_codes, *pd.factorize(df[column]))
+    return counter.to_frames()
+
+
+def count_replicate_states(ids, tabs, threads=1):
+    """
+    Counts the states predicted by the replicate ACRs, adding them one at a time as they are read
+    (by up to threads processes, in whichever order they finish).
+
+    :param ids: node ids to count the states for
+    :param tabs: PastML combined_ancestral_states tables (whose first column is counted),
+        or counts saved before (.npz, see StateCounter.save)
+    :return: StateCounter
+    """
+    counter = StateCounter(ids)
+    for tab in tabs:
+        if tab.endswith(COUNTS_SUFFIX):
+            counter.merge(StateCounter.load(tab))
+    tabs = [_ for _ in tabs if not _.endswith(COUNTS_SUFFIX)]
+    if threads > 1 and len(tabs) > 1:
+        with multiprocessing.get_context('fork').Pool(processes=min(threads, len(tabs))) as pool:
+            for acr in pool.imap_unordered(read_states, tabs):
+                counter.add(*acr)
+    else:
+        for tab in tabs:
+            counter.add(*read_states(tab))
+    return counter
+
+
+def join_states(mask):
+    """Joins the states (columns) where the mask is True into a comma-separated string, for each node (row)."""
+    if not len(mask.columns):
+        return pd.Series('', index=mask.index)
+    return mask.dot(mask.columns.astype(str) + ', ').str[:-2]
+
+
+def main(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('--input_tab', required=True, type=str)
+    parser.add_argument('--input_tab', required=False, type=str, default=None,
+                        help="the merged ACR table, with a column per (sub)tree (see merge_tables.py).")
+    parser.add_argument('--full_tab', required=False, type=str, default=None,
+                        help="the full tree ACR (PastML combined_ancestral_states table), "
+                             "to compare to the replicate ACRs instead of the merged table columns.")
+    parser.add_argument('--replicate_tabs', nargs='*', type=str, default=[],
+                        help="the replicate ACRs (PastML combined_ancestral_states tables), "
+                             "or their counts saved before with --output_counts (.npz).")
+    parser.add_argument('--tree', required=False, type=str, default=None,
+                        help="(optional) the full tree, to list the nodes in its level order (as in the merged table, "
+                             "see merge_tables.py) instead of the --full_tab order.")
+    parser.add_argument('--output_counts', required=False, type=str, default=None,
+                        help="(optional) where to save the replicate state counts (.npz), "
+                             "to add more replicates to them later.")
     parser.add_argument('--output_log', required=True, type=str)
     parser.add_argument('--column', required=True, type=str)
-    params = parser.parse_args()
-
-    df = pd.read_csv(params.input_tab, sep='\t', header=0, index_col=0)
-    interesting_columns = [c for c in df.columns if params.column in c]
-    df = df[interesting_columns]
-    values = sorted([_ for _ in df[params.column].unique() if not pd.isna(_)])
-    ids = df.index.unique()
-    stats_df = pd.DataFrame(index=ids,
-                            columns=['state_union', 'state_intersection', 'number_subtrees', 'full_tree_state']
-                                    + values)
-
-    def get_value_set(id, column=params.column, many_values=True):
-        id_df = df.loc[id, column]
-        return {_ for _ in id_df.unique() if not pd.isna(_)} \
-            if many_values else ({id_df} if not pd.isna(id_df) else set())
-
-    agreed = 0
-    majority = 0
-    seen = 0
-    different = 0
-    total = 0
-    for id in ids:
-        many_values = len(df.loc[id, :].shape) > 1
-        ref_values = get_value_set(id, many_values=many_values)
-        value_intersection = set(values)
-        value_union = set()
-        value_counter = Counter()
-        n = 0
-        for col in df.columns:
-            if col != params.column:
-                col_values = get_value_set(id, column=col, many_values=many_values)
-                if col_values:
-                    value_counter.update(col_values)
-                    value_intersection &= col_values
-                    value_union |= col_values
-                    n += 1
-        stats_df.loc[id, :] = ', '.join(sorted(value_union)), ', '.join(sorted(value_intersection) if n else []), n, \
-                              ', '.join(sorted(ref_values)), *[value_counter[v] for v in values]
-        is_internal_id = id.startswith('n') or id == 'root'
-        if not n:
-            continue
-        if is_internal_id:
-            total += 1
-        if not value_intersection & ref_values:
-            most_common_count = value_counter.most_common(1)[0][1]
-            most_common_values = set(_ for _ in values if value_counter[_] == most_common_count)
-            if not most_common_values & ref_values:
-                if value_union & ref_values:
-                    seen += 1
-                else:
-                    different += 1
-                    print(id, n, value_counter, ref_values)
-            elif is_internal_id:
-                majority += 1
-        elif is_internal_id:
-            agreed += 1
-
-    stats_df.to_csv(params.output_log, sep='\t', index_label='id')
+    parser.add_argument('--threads', type=int, default=1, help="the number of processes to read the replicates.")
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('check_subsampling', params.instrument)
+    if (params.input_tab is None) == (params.full_tab is None):
+        parser.error('Either --input_tab or --full_tab (with --replicate_tabs) should be given.')
+
+    if params.input_tab:
+        with instrument.phase('parse'):
+            df = memo.read_csv(params.input_tab, sep='\t', header=0, index_col=0)
+        interesting_columns = [c for c in df.columns if params.column in c]
+        df = df[interesting_columns]
+        values = sorted([_ for _ in df[params.column].unique() if not pd.isna(_)])
+        instrument.count(rows=len(df), columns=len(interesting_columns))
+
+        with instrument.phase('compute'):
+            ref_counts, _ = get_state_counts(df[[params.column]])
+            counts, n = get_state_counts(df[[c for c in interesting_columns if c != params.column]])
+    else:
+        with instrument.phase('parse'):
+            names, value_codes, states = read_states(params.full_tab)
+        ref_counter = StateCounter(pd.unique(names))
+        ref_counter.add(names, value_codes, states)
+        ref_counts, _ = ref_counter.to_frames()
+        values = sorted(states)
+        with instrument.phase('compute'):
+            counter = count_replicate_states(ref_counter.ids, params.replicate_tabs, params.threads)
+        instrument.count(rows=len(counter.ids), columns=len(params.replicate_tabs))
+        if params.output_counts:
+            counter.save(params.output_counts)
+        counts, n = counter.to_frames()
+        if params.tree:
+            with instrument.phase('parse'):
+                tree = read_tree(params.tree)
+            order = pd.Index(pd.unique(tree.names[get_levelorder(tree)])).intersection(counts.index, sort=False)
+            order = order.append(counts.index.difference(order, sort=False))
+            ref_counts, counts, n = ref_counts.reindex(order), counts.reindex(order), n.reindex(order)
+
+    with instrument.phase('compute'):
+        ref_mask = ref_counts.reindex(columns=values, fill_value=0) > 0
+        ref_mask = ref_mask.reindex(columns=counts.columns.union(values), fill_value=False)
+        counts = counts.reindex(columns=ref_mask.columns, fill_value=0)
+        is_value = ref_mask.columns.isin(values)
+
+        union_mask = counts > 0
+        # the intersection is only looked for among the full tree values
+        intersection_mask = counts.eq(n, axis=0) & (n > 0).to_numpy()[:, np.newaxis] & is_value
+        majority_mask = counts.eq(counts.max(axis=1), axis=0) & is_value
+
+    with instrument.phase('write'):
+        stats_df = pd.DataFrame(index=counts.index)
+        stats_df['state_union'] = join_states(union_mask)
+        stats_df['state_intersection'] = join_states(intersection_mask)
+        stats_df['number_subtrees'] = n
+        stats_df['full_tree_state'] = join_states(ref_mask)
+        stats_df[values] = counts[values]
+        stats_df.to_csv(params.output_log, sep='\t', index_label='id')
+
+    ids = counts.index.astype(str)
+    is_predicted = (n > 0).to_numpy()
+    is_internal = (ids.str.startswith('n') | (ids == 'root')) & is_predicted
+    is_agreed = (intersection_mask & ref_mask).any(axis=1).to_numpy() & is_predicted
+    is_majority = (majority_mask & ref_mask).any(axis=1).to_numpy() & is_predicted & ~is_agreed
+    is_seen = (union_mask & ref_mask).any(axis=1).to_numpy() & is_predicted & ~is_agreed & ~is_majority
+    is_different = is_predicted & ~is_agreed & ~is_majority & ~is_seen
+
+    for id in counts.index[is_different]:
+        id_counts = counts.loc[id]
+        print(id, n[id], Counter({s: int(c) for s, c in id_counts[id_counts > 0].items()}),
+              set(ref_mask.columns[ref_mask.loc[id]]))
+
+    total = is_internal.sum()
+    agreed = (is_agreed & is_internal).sum()
+    majority = (is_majority & is_internal).sum()
+    seen = is_seen.sum()
+    different = is_different.sum()
 
     print('Out of {} internal nodes:'
           '\t{} ({:.1f}%) have a common prediction in (sub)trees'
@@ -80,3 +243,7 @@ if '__main__' == __name__:
                   seen, 100 * seen / total,
                   different, 100 * different / total,
                   ))
+
+
+if '__main__' == __name__:
+    main()
@@ -1,48 +1,106 @@
 import logging
-from ete3.parser.newick import write_newick
-from ete3 import Tree
-from pastml.tree import read_tree
 
-if '__main__' == __name__:
-    import argparse
+import numpy as np
 
-    parser = argparse.ArgumentParser()
-
-    parser.add_argument('--input_tree', required=True, type=str)
-    parser.add_argument('--output_tree', required=True, type=str)
-    parser.add_argument('--threshold', required=True, type=str)
-    parser.add_argument('--feature', required=True, type=str)
-    parser.add_argument('--strict', action='store_true', default=False)
-    params = parser.parse_args()
+import instrument
+from array_tree import ArrayTree
+from tree_io import read_tree, write_newick
 
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
+DIST = 'dist'
 
-    tr = read_tree(params.input_tree)
 
+def parse_threshold(threshold):
     try:
-        threshold = float(params.threshold)
-    except:
+        return float(threshold)
+    except ValueError:
         # may be it's a string threshold then
-        threshold = params.threshold
-
-    num_collapsed, num_set_zero_tip, num_set_zero_root = 0, 0, 0
-    for n in list(tr.traverse('postorder')):
-        children = list(n.children)
-        for child in children:
-            if getattr(child, params.feature) < threshold \
-                    or not params.strict and getattr(child, params.feature) == threshold:
-                if child.is_leaf():
-                    child.dist = 0
-                    num_set_zero_tip += 1
-                elif n.is_root() and len(n.children) == 2:
-                    child.dist = 0
-                    num_set_zero_root += 1
-                else:
-                    n.remove_child(child)
-                    for grandchild in child.children:
-                        n.add_child(grandchild)
-                    num_collapsed += 1
+        return threshold
+
+
+def get_matches(tree, feature, threshold, strict=False):
+    """
+    Checks which nodes have their feature value (their branch length for dist) below the threshold
+    (or equal to it if not strict). The nodes without the feature never match.
+
+    :return: boolean array of node matches
+    """
+    if DIST == feature:
+        values = tree.dists
+    else:
+        values = tree.features.get(feature, np.full(tree.n_nodes, None, dtype=object))
+        if isinstance(threshold, str):
+            return np.array([_ is not None and (_ < threshold or not strict and _ == threshold) for _ in values],
+                            dtype=bool)
+        values = np.array([np.nan if _ is None else float(_) for _ in values], dtype=np.float64)
+    return (values < threshold) | (not strict) & (values == threshold)
+
+
+def get_collapsed(tree, matches):
+    """
+    Decides which branches to collapse and which ones to set to zero, in one bottom-up pass:
+    a matching internal branch is collapsed (its children become the children of its parent,
+    and are put after the parent's kept children, as ete3 remove_child + add_child do), a matching external branch
+    is set to zero. If a matching root child branch would leave the root with one child, it is set to zero instead
+    (to keep the tree rooted), checking the root children in order.
+
+    :return: tuple (collapsed, zero_tip, zero_root) of boolean arrays
+    """
+    is_tip = tree.is_tip
+    collapsed = matches & ~is_tip
+    collapsed[0] = False
+    zero_tip = matches & is_tip
+    zero_tip[0] = False
+    zero_root = np.zeros(tree.n_nodes, dtype=bool)
+
+    # the number of children each node ends up with, once its collapsed children are replaced by their own
+    n_children = [0] * tree.n_nodes
+    parents, is_collapsed = tree.parents.tolist(), collapsed.tolist()
+    for i in range(tree.n_nodes - 1, 0, -1):
+        n_children[parents[i]] += n_children[i] if is_collapsed[i] else 1
+
+    n_root_children = len(tree.children(0))
+    for i in tree.children(0).tolist():
+        if is_collapsed[i]:
+            if 2 == n_root_children:
+                collapsed[i], zero_root[i] = False, True
+            else:
+                n_root_children += n_children[i] - 1
+    return collapsed, zero_tip, zero_root
+
+
+def collapse(tree, collapsed, zero_dists):
+    """
+    Builds the collapsed tree in one preorder sweep: the children of each kept node are its kept children,
+    followed by the children of its collapsed children (recursively).
+
+    :param collapsed: boolean array of the nodes to be removed
+    :param zero_dists: boolean array of the nodes whose branch lengths are to be set to zero
+    :return: collapsed ArrayTree
+    """
+    child_offsets, child_indices = tree.child_offsets.tolist(), tree.child_indices.tolist()
+    is_collapsed = collapsed.tolist()
+    order, new_parents = [], []
+    stack = [(0, -1)]
+    while stack:
+        i, parent = stack.pop()
+        new_i = len(order)
+        order.append(i)
+        new_parents.append(parent)
+        children, todo = [], [i]
+        while todo:
+            j = todo.pop()
+            js = child_indices[child_offsets[j]: child_offsets[j + 1]]
+            children.extend(_ for _ in js if not is_collapsed[_])
+            todo.extend(_ for _ in reversed(js) if is_collapsed[_])
+        stack.extend((_, new_i) for _ in reversed(children))
+
+    order = np.array(order, dtype=np.int64)
+    dists = np.where(zero_dists, 0., tree.dists)
+    return ArrayTree(new_parents, dists[order], tree.names[order], tree.dates[order],
+                     {f: v[order] for f, v in tree.features.items()})
 
+
+def get_message(num_collapsed, num_set_zero_tip, num_set_zero_root):
     msg = ''
     if num_collapsed:
         msg = 'Collapsed {} internal branch{}'.format(num_collapsed, 'es' if num_collapsed > 1 else '')
@@ -58,8 +116,73 @@ if '__main__' == __name__:
             msg += 'Set {} root child branch{} to zero'.format(num_set_zero_root, 'es' if num_set_zero_root > 1 else '')
     if not msg:
         msg = 'Did not find any branches to modify'
-    logging.info('{} (criterion: {} <{} {}).'
-                 .format(msg, params.feature, '' if params.strict else '=', threshold))
-    nwk = write_newick(tr, format_root_node=True, format=1)
-    with open(params.output_tree, 'w+') as f:
-        f.write('%s\n' % nwk)
+    return msg
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--input_tree', required=True, type=str)
+    parser.add_argument('--output_tree', required=True, type=str, nargs='+',
+                        help="output tree(s): one per threshold, "
+                             "or a template with {} to be replaced by the threshold (e.g. collapsed_{}.nwk).")
+    parser.add_argument('--threshold', required=True, type=str, nargs='+')
+    parser.add_argument('--feature', required=True, type=str, nargs='+',
+                        help="feature to compare to the threshold(s) (dist for branch lengths): "
+                             "one for all the thresholds, or one per threshold.")
+    parser.add_argument('--strict', action='store_true', default=False)
+    parser.add_argument('--output_stats', required=False, type=str, default=None,
+                        help="(optional) tab-separated file with the numbers of modified branches per threshold.")
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('collapse', params.instrument)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
+
+    thresholds = [parse_threshold(_) for _ in params.threshold]
+    features = params.feature * len(thresholds) if 1 == len(params.feature) else params.feature
+    if len(features) != len(thresholds):
+        raise ValueError('Expected either one feature or {} features (one per threshold).'.format(len(thresholds)))
+    if len(params.output_tree) == len(thresholds):
+        output_trees = params.output_tree
+    elif 1 == len(params.output_tree) and '{}' in params.output_tree[0]:
+        output_trees = [params.output_tree[0].format(_) for _ in params.threshold]
+    else:
+        raise ValueError('Expected either {} output trees or one output tree template containing {{}}.'
+                         .format(len(thresholds)))
+
+    with instrument.phase('parse'):
+        tree = read_tree(params.input_tree)
+    instrument.count(nodes=tree.n_nodes, tips=len(tree.tips), thresholds=len(thresholds))
+
+    stats = []
+    for feature, threshold, output_tree in zip(features, thresholds, output_trees):
+        with instrument.phase('compute'):
+            collapsed, zero_tip, zero_root = get_collapsed(tree, get_matches(tree, feature, threshold, params.strict))
+            collapsed_tree = collapse(tree, collapsed, zero_tip | zero_root)
+        num_collapsed, num_set_zero_tip, num_set_zero_root = \
+            (int(np.count_nonzero(_)) for _ in (collapsed, zero_tip, zero_root))
+        instrument.count(collapsed=num_collapsed, set_zero_tip=num_set_zero_tip, set_zero_root=num_set_zero_root)
+        stats.append((feature, threshold, num_collapsed, num_set_zero_tip, num_set_zero_root,
+                      collapsed_tree.n_nodes - len(collapsed_tree)))
+
+        logging.info('{} (criterion: {} <{} {}).'
+                     .format(get_message(num_collapsed, num_set_zero_tip, num_set_zero_root),
+                             feature, '' if params.strict else '=', threshold))
+        with instrument.phase('write'):
+            with open(output_tree, 'w+') as f:
+                write_newick(collapsed_tree, f, format=1)
+                f.write('\n')
+
+    if params.output_stats:
+        with open(params.output_stats, 'w+') as f:
+            f.write('feature\tthreshold\tstrict\tcollapsed\tset_zero_tip\tset_zero_root\tinternal_nodes\n')
+            for feature, threshold, num_collapsed, num_set_zero_tip, num_set_zero_root, n_internal in stats:
+                f.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(feature, threshold, params.strict, num_collapsed,
+                                                              num_set_zero_tip, num_set_zero_root, n_internal))
+
+
+if '__main__' == __name__:
+    main()
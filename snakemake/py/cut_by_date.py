@@ -1,52 +1,108 @@
+import numpy as np
 import pandas as pd
-from ete3 import Tree, TreeNode
 
+import instrument
+import memo
+from tree_io import iter_newick, read_tree
 
-def read_tree(nwk):
-    tree = None
-    for format in range(10):
-        try:
-            tree = Tree(nwk, format=format)
-            break
-        except:
-            continue
-    return tree
 
+def get_arv_year(arv_df, arv):
+    """
+    Finds the year when the ARV (or the first ARV provoking the given mutation) was accepted.
 
-if '__main__' == __name__:
+    :return: tuple (year, message)
+    """
+    if arv in arv_df['mutation'].unique():
+        return float(arv_df.loc[arv_df['mutation'] == arv, 'year'].min()), 'First {}-provoking ARV'.format(arv)
+    return float(arv_df.loc[arv_df['drug abbreviation'] == arv, 'year'].min()), arv
+
+
+def get_cut_nodes(tree, dates, years):
+    """
+    Finds where to cut the tree for each of the given years,
+    sweeping the sorted years over the node date intervals [parent date, date] in one pass.
+
+    :param tree: ArrayTree
+    :param dates: array of node dates
+    :param years: array of cut years
+    :return: list (in the order of years) of arrays of the top-most nodes of date >= year
+    """
+    years = np.asarray(years, dtype=float)
+    order = np.argsort(years, kind='stable')
+    sorted_years = years[order]
+    parent_dates = np.append(-np.inf, dates[tree.parents[1:]])
+    # node i is cut for the (sorted) years lo[i] <= k < hi[i], i.e. parent_dates[i] < year <= dates[i]
+    lo = np.searchsorted(sorted_years, parent_dates, side='right')
+    hi = np.searchsorted(sorted_years, dates, side='right')
+    n_cuts = np.maximum(hi - lo, 0)
+    node_ids = np.repeat(np.arange(tree.n_nodes), n_cuts)
+    year_ids = np.repeat(lo - np.cumsum(n_cuts) + n_cuts, n_cuts) + np.arange(len(node_ids))
+    # group by year, keeping the nodes in preorder
+    year_order = np.argsort(year_ids, kind='stable')
+    node_ids, year_ids = node_ids[year_order], year_ids[year_order]
+    bounds = np.searchsorted(year_ids, np.arange(len(years) + 1))
+
+    result = [None] * len(years)
+    for k, i in enumerate(order):
+        nodes = node_ids[bounds[k]: bounds[k + 1]]
+        # with negative branches a cut node might be inside another cut subtree: keep the top-most ones only
+        result[i] = nodes[nodes >= np.maximum.accumulate(np.append(0, tree.ends[nodes][:-1]))]
+    return result
+
+
+def main(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--input_tree', required=True, type=str)
-    parser.add_argument('--output_forest', required=True, type=str)
+    parser.add_argument('--output_forest', required=True, type=str, nargs='+',
+                        help="output forest file(s): one per ARV, "
+                             "or a template with {} to be replaced by the ARV (e.g. forest_{}.nwk).")
     parser.add_argument('--root_date', required=True, type=float)
-    parser.add_argument('--arv_tab', required=True, type=str)
-    parser.add_argument('--arv', required=False, type=str, default=None)
-    params = parser.parse_args()
-
-    tree = read_tree(params.input_tree)
-    arv_df = pd.read_csv(params.arv_tab, index_col=None, sep='\t')
-    if params.arv in arv_df['mutation'].unique():
-        arv_df = arv_df[arv_df['mutation'] == params.arv]
-        message = 'First {}-provoking ARV'.format(params.arv)
+    parser.add_argument('--arv_tab', required=True, type=str, nargs='+')
+    parser.add_argument('--arv', required=False, type=str, default=None, nargs='*',
+                        help="DRM(s) or ARV abbreviation(s) to cut the tree for, "
+                             "by default all the mutations of the ARV table(s).")
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('cut_by_date', params.instrument)
+
+    arv_df = pd.concat([memo.read_csv(_, index_col=None, sep='\t') for _ in params.arv_tab])
+    arvs = params.arv if params.arv else list(arv_df['mutation'].unique())
+    if len(params.output_forest) == len(arvs):
+        output_forests = params.output_forest
+    elif len(params.output_forest) == 1 and '{}' in params.output_forest[0]:
+        output_forests = [params.output_forest[0].format(_) for _ in arvs]
     else:
-        arv_df = arv_df[arv_df['drug abbreviation'] == params.arv]
-        message = params.arv
-    arv_year = float(arv_df['year'].min())
-    print('{} was accepted in {}.'.format(message, arv_year))
+        raise ValueError('Expected either {} output forests or one output forest template containing {{}}.'
+                         .format(len(arvs)))
+
+    years = []
+    for arv in arvs:
+        arv_year, message = get_arv_year(arv_df, arv)
+        print('{} was accepted in {}.'.format(message, arv_year))
+        years.append(arv_year)
     print('Root year is {}.'.format(params.root_date))
 
-    nwks = []
-    todo = [(tree, params.root_date)]
-    while todo:
-        node, date = todo.pop()
-        if date < arv_year:
-            for child in node.children:
-                todo.append((child, date + child.dist))
-        else:
-            fake_root = TreeNode(dist=0, name='sensitive')
-            fake_root.add_child(node, dist=date - arv_year)
-            nwks.append(fake_root.write(format=3, format_root_node=True))
-    with open(params.output_forest, 'w+') as f:
-        f.write('\n'.join(nwks))
+    with instrument.phase('parse'):
+        tree = read_tree(params.input_tree)
+    instrument.count(nodes=tree.n_nodes, tips=len(tree.tips), arvs=len(arvs))
+    with instrument.phase('annotate'):
+        dates = tree.root_distances(params.root_date)
+    with instrument.phase('compute'):
+        cut_nodes_by_year = get_cut_nodes(tree, dates, years)
+
+    for arv_year, cut_nodes, output_forest in zip(years, cut_nodes_by_year, output_forests):
+        instrument.count(cut_nodes=len(cut_nodes))
+        # each cut subtree is streamed to the forest file under a fake root, one tree per line
+        with instrument.phase('write'), open(output_forest, 'w+') as f:
+            for k, i in enumerate(cut_nodes[::-1]):
+                f.write('\n(' if k else '(')
+                for chunk in iter_newick(tree, i, format=3, root_dist=dates[i] - arv_year):
+                    f.write(chunk)
+                f.write(')sensitive:0;')
+
+
+if '__main__' == __name__:
+    main()
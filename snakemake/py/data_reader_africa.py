@@ -1,14 +1,12 @@
-import datetime
 import logging
-import os
 import re
+from itertools import compress
 
-import pandas as pd
 import numpy as np
-from Bio import SeqIO
-from Bio.Alphabet import generic_dna
-from Bio.Seq import Seq
-from pastml import numeric2datetime, datetime2numeric
+import pandas as pd
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+import instrument
 
 EXTERNAL = 'External'
 
@@ -25,25 +23,63 @@ PREVALENCE = 'prevalence'
 HLE = 'highlow_prevalence'
 HLME = 'highmedlow_prevalence'
 
-
-def format_id(id):
-    dot_year = '\.\d\d\d\d$'
-    underscore_date = '_\d\d\d\d-\d\d-\d\d$'
-    date = re.findall(dot_year, id)
-    if date:
-        id = re.sub(dot_year, '', id)
-        date = int(date[0][1:])
-    else:
-        date = re.findall(underscore_date, id)
-        if date:
-            date = datetime.datetime.strptime(date[0][1:], '%Y-%m-%d')
-            id = re.sub(underscore_date, '', id)
-        else:
-            date = None
-    return id.replace('.', '_'), date
-
-
-if '__main__' == __name__:
+UNKNOWN_LSDATE = 'u(2016)'
+BATCH_SIZE = 10000
+
+# ids might end with a sampling year (.2010) or date (_2010-05-21)
+ID_REGEX = re.compile(r'^(?P<id>.*?)(?:\.(?P<year>\d{4})|_(?P<date>\d{4}-\d\d-\d\d))?$', re.DOTALL)
+
+
+def format_ids(ids):
+    """
+    Removes the sampling years or dates from the ends of the ids, and replaces dots with underscores.
+
+    :param ids: list of ids
+    :return: tuple (formatted ids, years, dates): a Series of ids,
+        a Series of sampling years (NaN if unknown), and a Series of sampling dates (NaT if unknown)
+    """
+    df = pd.Series(ids, dtype=str).str.extract(ID_REGEX)
+    return df['id'].str.replace('.', '_', regex=False), pd.to_numeric(df['year']), \
+        pd.to_datetime(df['date'], format='%Y-%m-%d')
+
+
+def dates2numeric(dates):
+    """Converts dates to numeric format (e.g. 2016-12-31 -> 2016.9972677595629), as pastml.datetime2numeric does."""
+    dates = pd.DatetimeIndex(dates)
+    first_jan_this_year = pd.to_datetime(pd.DataFrame({'year': dates.year, 'month': 1, 'day': 1}))
+    first_jan_next_year = pd.to_datetime(pd.DataFrame({'year': dates.year + 1, 'month': 1, 'day': 1}))
+    return dates.year + (dates - pd.DatetimeIndex(first_jan_this_year)) \
+        / (pd.DatetimeIndex(first_jan_next_year) - pd.DatetimeIndex(first_jan_this_year))
+
+
+def get_lsdates(dates, years):
+    """
+    Formats the sampling dates for LSD2: as numbers for the known dates,
+    as year intervals b(year,year+1) for the known years, and as u(2016) otherwise.
+    """
+    lsdates = np.full(len(dates), UNKNOWN_LSDATE, dtype=object)
+    is_year = ~np.isnan(years)
+    lsdates[is_year] = ['b({0},{1})'.format(int(_), int(_) + 1) for _ in years[is_year]]
+    is_date = ~pd.isna(dates)
+    lsdates[is_date] = dates2numeric(dates[is_date])
+    return lsdates
+
+
+def read_fasta_batches(fasta, batch_size=BATCH_SIZE):
+    """Reads a fasta file record by record, yielding them in batches of (ids, sequences)."""
+    ids, seqs = [], []
+    with open(fasta, 'r') as f:
+        for title, seq in SimpleFastaParser(f):
+            ids.append(title.split(None, 1)[0] if title else '')
+            seqs.append(seq)
+            if len(ids) >= batch_size:
+                yield ids, seqs
+                ids, seqs = [], []
+    if ids:
+        yield ids, seqs
+
+
+def main(argv=None):
     logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
                         filename=None)
 
@@ -57,20 +93,21 @@ if '__main__' == __name__:
     parser.add_argument('--to_remove', required=True, type=str, help="the sequences to skip.")
     parser.add_argument('--data_out', required=True, type=str, help="the sequence annotation file.")
     parser.add_argument('--dates', required=True, type=str, help="the date annotation file.")
-    params = parser.parse_args()
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('data_reader_africa', params.instrument)
 
     # Read and fix metadata
-    df = pd.io.stata.read_stata(params.data_in)
-    df.index = df['id'].apply(lambda _: format_id(_)[0])
-    df.drop(labels=['id'], axis=1, inplace=True)
-    df[DATE] = pd.to_datetime(df[DATE], yearfirst=False, format="%d/%m/%Y")
-    for cat in (HLE, HLME):
-        df[cat].replace('LastVisit', EXTERNAL, inplace=True)
-    df[HLME] = df[HLME].apply(lambda _: '' if _ not in {HIGH, LOW, MEDIUM, EXTERNAL} else _)
-    df[HLE] = df[HLE].apply(lambda _: '' if _ not in {HIGH, LOW, EXTERNAL} else _)
-    df[LOCATION].replace('.', '', inplace=True)
-
-    df[DATE] = pd.to_datetime(df[DATE], dayfirst=True, yearfirst=False, infer_datetime_format=True)
+    with instrument.phase('parse'):
+        df = pd.io.stata.read_stata(params.data_in)
+        df.index = format_ids(df['id'].astype(str))[0].to_numpy()
+        df.drop(labels=['id'], axis=1, inplace=True)
+        df[DATE] = pd.to_datetime(df[DATE], format="%d/%m/%Y")
+        for cat in (HLE, HLME):
+            df[cat] = df[cat].astype(object).replace('LastVisit', EXTERNAL)
+        df[HLME] = df[HLME].where(df[HLME].isin({HIGH, LOW, MEDIUM, EXTERNAL}), '')
+        df[HLE] = df[HLE].where(df[HLE].isin({HIGH, LOW, EXTERNAL}), '')
+        df[LOCATION] = df[LOCATION].astype(object).replace('.', '')
     logging.info(df.head())
 
     to_remove = set()
@@ -78,22 +115,44 @@ if '__main__' == __name__:
         with open(params.to_remove, 'r') as f:
             to_remove = set(f.read().strip().strip('\n').split('\n'))
 
-    ids = []
-    with open(params.sequences_out, 'w+') as f:
-        for rec in SeqIO.parse(params.sequences_in, 'fasta', alphabet=generic_dna):
-            rec.id, date = format_id(rec.id)
-            if rec.id in to_remove:
-                continue
-            if rec.id not in df.index:
-                df.loc[rec.id, [DATE, HLE, HLME]] = date, EXTERNAL, EXTERNAL
-            ids.append(rec.id)
-            f.write('>{}\n{}\n'.format(rec.id, str(rec.seq).replace('_', '-')))
-
-    df = df.loc[ids, :]
-    df['lsdate'] = df[DATE].apply(lambda _: datetime2numeric(_) if isinstance(_, datetime.datetime)
-        else ('b({},{})'.format(_, _ + 1) if isinstance(_, int) else 'u(2016)'))
-    with open(params.dates, 'w+') as f:
-        f.write('{}\n'.format(len(df)))
-    df['lsdate'].to_csv(params.dates, sep='\t', header=False, mode='a')
-    df[DATE] = df[DATE].apply(lambda _: _.strftime('%Y-%m-%d') if isinstance(_, datetime.datetime) else _)
-    df.to_csv(params.data_out, sep='\t', index_label='id')
+    known_ids = set(df.index)
+    ids, external_dfs = [], []
+    # the sequences are read, renamed and written batch by batch
+    with instrument.phase('sequences'), open(params.sequences_out, 'w+', buffering=1 << 20) as f:
+        for batch_ids, seqs in read_fasta_batches(params.sequences_in):
+            batch_ids, years, dates = format_ids(batch_ids)
+            keep = ~batch_ids.isin(to_remove).to_numpy()
+            batch_ids, years, dates = batch_ids[keep], years[keep], dates[keep]
+            is_external = ~batch_ids.isin(known_ids).to_numpy()
+            external_dfs.append(pd.DataFrame({'id': batch_ids[is_external], DATE: dates[is_external],
+                                              'year': years[is_external]}))
+            ids.extend(batch_ids)
+            f.write(''.join('>{}\n{}\n'.format(id, seq.replace('_', '-'))
+                            for id, seq in zip(batch_ids, compress(seqs, keep))))
+            instrument.count(sequences=len(batch_ids), external_sequences=is_external.sum())
+
+    with instrument.phase('annotate'):
+        df['year'] = np.nan
+        if external_dfs:
+            external_df = pd.concat(external_dfs, ignore_index=True).drop_duplicates('id').set_index('id')
+            external_df[HLE] = EXTERNAL
+            external_df[HLME] = EXTERNAL
+            df = pd.concat([df, external_df])
+        df = df.loc[ids, :]
+        df['lsdate'] = get_lsdates(df[DATE], df['year'].to_numpy(dtype=float))
+
+    with instrument.phase('write'):
+        with open(params.dates, 'w+') as f:
+            f.write('{}\n'.format(len(df)))
+        df['lsdate'].to_csv(params.dates, sep='\t', header=False, mode='a')
+
+        # the dates are written as 2010-05-21, or as 2010 if only the year is known
+        date_strs = df[DATE].dt.strftime('%Y-%m-%d').astype(object)
+        is_year = df[DATE].isna() & ~df['year'].isna()
+        date_strs[is_year] = df.loc[is_year, 'year'].astype(int)
+        df[DATE] = date_strs
+        df.drop(columns=['year']).to_csv(params.data_out, sep='\t', index_label='id')
+
+
+if '__main__' == __name__:
+    main()
@@ -1,73 +1,81 @@
+import datetime
 import logging
-import re
 
 import pandas as pd
-import wikipedia
 
-from sierrapy import SierraClient
+import instrument
+from arv_kb import BACKENDS, COLUMNS, HIVDB_VERSION, MUTATION, MUTATION_TAB, get_arv_metadata, get_sierra_version, \
+    normalize_drm, read_hivdb_version, read_kb_tab, resolve_drms
 
-QUERY = '''
-drugResistance {
-    gene { name },
-    drugScores {
-        drugClass { name },
-        drug { displayAbbr, fullName },
-        score,
-        text,
-        partialScores {
-            mutations {
-                text,
-            },
-        },
-    }
-}
-'''
 
+def update_kb(drms, backend_names, kb_path=MUTATION_TAB):
+    """
+    Adds the DRMs missing from the local knowledge base (resolved with the given backends) to it,
+    and updates its version (and its HIVdb version, if resolved with Sierra).
+    """
+    version, kb_df = read_kb_tab(kb_path)
+    drms = [_ for _ in dict.fromkeys(normalize_drm(_) for _ in drms) if _ not in set(kb_df[MUTATION])]
+    if not drms:
+        return
+    df = resolve_drms(drms, [BACKENDS[_]() for _ in backend_names if 'local' != _])
+    hivdb_version = get_sierra_version() if 'sierra' in backend_names else read_hivdb_version(kb_path)
+    # DRMs conferring no resistance are listed without drugs
+    df = pd.concat([kb_df, df, pd.DataFrame({MUTATION: [_ for _ in drms if _ not in set(df[MUTATION])]})],
+                   ignore_index=True)[COLUMNS]
+    with open(kb_path, 'r') as f:
+        comments = [_ for _ in f.readlines() if _.startswith('#') and not _.startswith('# version:')
+                    and not _.startswith(HIVDB_VERSION)]
+    with open(kb_path, 'w+') as f:
+        f.write('# version: {}\n'.format(datetime.date.today().isoformat()))
+        if hivdb_version:
+            f.write('{} {}\n'.format(HIVDB_VERSION, hivdb_version))
+        f.writelines(comments)
+        df.to_csv(f, sep='\t', index=False)
+    logging.info('Added {} to the knowledge base {} (version {} -> {}).'
+                 .format(', '.join(drms), kb_path, version, datetime.date.today().isoformat()))
 
-def get_date(drug):
-    summary = wikipedia.page(wikipedia.search('{} HIV'.format(drug))[0]).summary
-    dates = set()
-    for date in re.findall(r'\s[12][901][8901]\d[^\d]', summary):
-        index = summary.find(date)
-        prev_sentence = summary[max(0, index - 50): index]
-        if 'approv' in prev_sentence or 'sold ' in prev_sentence:
-            dates.add(date[1:-1])
-    return min(dates) if dates else None
 
-
-if '__main__' == __name__:
+def main(argv=None):
     import argparse
     parser = argparse.ArgumentParser(description="Extracts SDRM drug resistance information.")
     parser.add_argument('--drms', nargs='+', type=str, help="SDRMs of interest")
-    parser.add_argument('--output', required=True, type=str, help="output file in tab-delimited format.")
-    params = parser.parse_args()
+    parser.add_argument('--output', required=True, type=str, nargs='+',
+                        help="output file(s) in tab-delimited format: "
+                             "either one for all the DRMs, or one per DRM.")
+    parser.add_argument('--backends', nargs='+', type=str, choices=list(BACKENDS.keys()), default=['local', 'sierra'],
+                        help="where to look the DRMs up, in this order "
+                             "(the local knowledge base does not need network access, Sierra does).")
+    parser.add_argument('--scrape_years', action='store_true',
+                        help="scrape the ARV approval years missing from the local knowledge base from Wikipedia.")
+    parser.add_argument('--update_kb', action='store_true',
+                        help="add the DRMs missing from the local knowledge base to it.")
+    parser.add_argument('--hivdb_version', type=str, default=None,
+                        help="HIVdb version of Sierra (by default the one the local knowledge base was built with), "
+                             "the DRMs cached for another version are not reused.")
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('drm2arv', params.instrument)
 
     logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
                         filename=None)
 
-    params.drm = [_.replace('PR_', 'PR:').replace('RT_', 'RT:') for _ in params.drms]
+    if params.update_kb:
+        with instrument.phase('update_kb'):
+            update_kb(params.drms, params.backends)
 
-    data = []
-
-    for dr in SierraClient().mutations_analysis(params.drms, QUERY)['drugResistance']:
-        gene = dr['gene']['name']
-        drug_scores = dr['drugScores']
-        for ds in drug_scores:
-            text = ds['text']
-            if 'Resistance' not in text:
-                continue
-            drug_class = ds['drugClass']['name']
-            drug_abbr = ds['drug']['displayAbbr'].replace('/r', '')
-            drug_name = ds['drug']['fullName'].replace('/r', '')
-            score = ds['score']
-            partial_scores = ds['partialScores']
-            for ps in partial_scores:
-                for _ in ps['mutations']:
-                    drm = _['text']
-                    data.append(['{}:{}'.format(gene, drm), drug_class, drug_name, drug_abbr, score, text])
-    df = pd.DataFrame(data, columns=['mutation', 'drug class', 'drug full name', 'drug abbreviation', 'score', 'note'])
-    for drug in df['drug full name'].unique():
-        df.loc[df['drug full name'] == drug, 'year'] = get_date(drug)
-    df.to_csv(params.output, sep='\t', index=False)
+    with instrument.phase('compute'):
+        df = get_arv_metadata(params.drms, params.backends, scrape=params.scrape_years,
+                              hivdb_version=params.hivdb_version)
+    instrument.count(drms=len(params.drms), rows=len(df))
+    with instrument.phase('write'):
+        if len(params.output) == 1:
+            df.to_csv(params.output[0], sep='\t', index=False)
+        elif len(params.output) == len(params.drms):
+            for drm, output in zip(params.drms, params.output):
+                df[df[MUTATION] == normalize_drm(drm)].to_csv(output, sep='\t', index=False)
+        else:
+            raise ValueError('Expected either one output file or one per DRM ({}).'.format(len(params.drms)))
 
 
+if '__main__' == __name__:
+    main()
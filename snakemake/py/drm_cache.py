@@ -0,0 +1,304 @@
+import hashlib
+import logging
+import os
+import shlex
+import subprocess
+import tempfile
+
+import numpy as np
+import pandas as pd
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+import instrument
+import memo
+from drm_caller import DRM_REGEX
+
+CACHE_DIR_ENV = 'DRM_CACHE_DIR'
+CALLER = 'sdrmhunter --fasta {fasta} --output {output}'
+# bump it when the cache format changes, to start new caches
+CACHE_VERSION = '2'
+HASH, COLUMN, VALUE = 'hash', 'column', 'value'
+# reserved cache columns: whether the caller reported the sequence at all (it skips the ones it cannot analyse),
+# and the caller's index name
+REPORTED = '_reported'
+ID_LABEL = '_id_label'
+RESISTANT = 'resistant'
+
+
+def hash_sequence(seq):
+    """:return: hex digest identifying the aligned sequence (ignoring the case and line breaks)"""
+    return hashlib.sha1(seq.replace('\n', '').strip().upper().encode()).hexdigest()
+
+
+def read_sequences(fasta):
+    """:return: tuple (ids, sequences) in the order of the fasta file"""
+    ids, seqs = [], []
+    with open(fasta, 'r') as f:
+        for title, seq in SimpleFastaParser(f):
+            ids.append(title.split(None, 1)[0] if title else '')
+            seqs.append(seq)
+    return ids, seqs
+
+
+def get_cache_path(cache_dir, key):
+    """
+    :param key: a string identifying the DRM caller and its database (e.g. their versions),
+        the sequences called with another key are not reused
+    :return: path of the cache table for the given key
+    """
+    return os.path.join(cache_dir, '{}.tab'.format(hashlib.sha1(key.encode()).hexdigest()))
+
+
+def read_cache(cache_path):
+    """
+    Reads the cached DRM calls: a long table of (HASH, COLUMN, VALUE) rows, one per sequence (see hash_sequence)
+    and caller's column (as strings, empty if the caller gave no value), plus a REPORTED row per sequence
+    and an ID_LABEL row for the caller's index name.
+    """
+    if not os.path.exists(cache_path):
+        return None
+    return memo.read_csv(cache_path, sep='\t', dtype=str, keep_default_na=False)
+
+
+def write_cache(cache, cache_path):
+    # write to a temporary file first, as several jobs might be updating the same cache at the same time
+    temp = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        cache.to_csv(temp, sep='\t', index=False)
+        os.replace(temp, cache_path)
+    except OSError as e:
+        logging.warning('Could not update the DRM cache {}: {}'.format(cache_path, e))
+
+
+def call_drms(ids, seqs, caller=CALLER):
+    """
+    Runs the DRM caller on the given sequences.
+
+    :param caller: command template with {fasta} (input) and {output} (tab-separated output) placeholders
+    :return: the caller's table (as strings), indexed by the sequence ids
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fasta, output = os.path.join(temp_dir, 'unseen.fa'), os.path.join(temp_dir, 'unseen.tab')
+        with open(fasta, 'w+') as f:
+            for _id, seq in zip(ids, seqs):
+                f.write('>{}\n{}\n'.format(_id, seq))
+        command = [_.format(fasta=fasta, output=output) for _ in shlex.split(caller)]
+        logging.info('Running {}'.format(' '.join(command)))
+        subprocess.run(command, check=True)
+        return pd.read_csv(output, sep='\t', index_col=0, dtype=str, keep_default_na=False, na_values=[''])
+
+
+def parse_codon(column):
+    """:return: tuple (gene, position) of the codon of a DRM column (e.g. ('RT', 103) for RT:K103N), or None"""
+    m = DRM_REGEX.match(column)
+    return (m.group('gene'), int(m.group('pos'))) if m else None
+
+
+def update_cache(cache, hashes, df):
+    """
+    Adds the calls of the newly called sequences to the cache (keeping the cached ones).
+
+    :param hashes: hashes of the sequences sent to the caller, indexed by their ids
+    :param df: the caller's table for them
+    :return: the updated cache
+    """
+    df = df[~df.index.duplicated()]
+    reported = hashes.index.isin(df.index)
+    calls = df.loc[hashes.index[reported]].fillna('').astype(str)
+    calls.insert(0, HASH, hashes.to_numpy()[reported])
+    rows = [cache,
+            pd.DataFrame({HASH: [''], COLUMN: [ID_LABEL], VALUE: [df.index.name or '']}),
+            pd.DataFrame({HASH: hashes.to_numpy(), COLUMN: REPORTED, VALUE: np.where(reported, 'True', 'False')}),
+            calls.melt(id_vars=HASH, var_name=COLUMN, value_name=VALUE)]
+    return pd.concat([_ for _ in rows if _ is not None], ignore_index=True)\
+        .drop_duplicates(subset=[HASH, COLUMN], keep='first')
+
+
+def get_span(seq):
+    """:return: tuple (first, last) of the alignment columns covered by the aligned sequence (its gapless part)"""
+    return len(seq) - len(seq.lstrip('-')), len(seq.rstrip('-')) - 1
+
+
+def infer_calls(calls, drm, spans=None):
+    """
+    Infers the calls of a DRM that the caller did not report for the given sequences
+    (as it only reports the DRMs found in the sequences it analyses together, they do not carry it):
+    sensitive if the DRM codon is covered, empty if not.
+    The codon coverage comes from the calls of the other DRMs at the same codon (empty if not covered),
+    or, as the coverage of each gene is contiguous, from the calls around it:
+    a codon between two covered ones is covered, and a codon beyond an uncovered one (with respect to the covered ones)
+    is not.
+    Otherwise, if the sequences' spans in their alignment are given, the alignment column of the DRM codon
+    is bounded by the known calls of all the sequences (the codons follow the alignment columns),
+    and the codon is covered by the sequences whose span includes all its possible columns,
+    and not covered by those whose span excludes them.
+
+    :param calls: table sequence x column of the known calls (NaN where unknown)
+    :param spans: table sequence x ['first', 'last'] of the sequence spans in the alignment (see get_span)
+    :return: Series of the inferred calls (NaN where the coverage is unknown)
+    """
+    gene, position = parse_codon(drm)
+    columns, positions = [], []
+    for column in calls.columns:
+        codon = parse_codon(column)
+        if codon and codon[0] == gene:
+            columns.append(column)
+            positions.append(codon[1])
+    values, positions = calls[columns].to_numpy(dtype=object), np.array(positions, dtype=float)
+    is_known = ~pd.isna(values)
+    is_covered = is_known & (values != '')
+    is_uncovered = is_known & (values == '')
+    first = np.where(is_covered, positions, np.inf).min(axis=1, initial=np.inf)[:, np.newaxis]
+    last = np.where(is_covered, positions, -np.inf).max(axis=1, initial=-np.inf)[:, np.newaxis]
+    is_above = is_uncovered & (positions > last) & np.isfinite(last)
+    is_below = is_uncovered & (positions < first) & np.isfinite(first)
+    covered = (first[:, 0] <= position) & (position <= last[:, 0])
+    uncovered = (is_uncovered & (positions == position)).any(axis=1) \
+        | (is_above & (positions <= position)).any(axis=1) | (is_below & (positions >= position)).any(axis=1)
+
+    if spans is not None:
+        span_starts, span_ends = (spans.reindex(calls.index)[_].to_numpy(dtype=float) for _ in ('first', 'last'))
+        starts, ends = (np.broadcast_to(_[:, np.newaxis], values.shape) for _ in (span_starts, span_ends))
+        # bounds of the DRM codon column: at or after the spans' starts of the sequences covering a codon before it,
+        # and after the spans' ends of the sequences not covering a codon before it (on their end side), etc.
+        lower = max(np.max(starts, where=is_covered & (positions <= position), initial=-np.inf),
+                    np.max(ends + 1, where=is_above & (positions <= position), initial=-np.inf))
+        upper = min(np.min(ends, where=is_covered & (positions >= position), initial=np.inf),
+                    np.min(starts - 1, where=is_below & (positions >= position), initial=np.inf))
+        if lower <= upper:
+            unknown = ~covered & ~uncovered
+            covered |= unknown & (span_starts <= lower) & (upper <= span_ends)
+            uncovered |= unknown & ((upper < span_starts) | (span_ends < lower))
+
+    result = np.where(covered, 'sensitive', np.where(uncovered, '', None))
+    return pd.Series(result, index=calls.index).where(covered | uncovered)
+
+
+def get_drms(hashes, cache, spans=None):
+    """
+    Assembles the DRM table of the given sequences from the cache, as the caller would report them all together:
+    with the columns of the DRMs found in them, and the sequences that the caller did not report skipped.
+
+    :param hashes: array of the sequence hashes (see hash_sequence)
+    :param spans: table of the sequence spans in their alignment, indexed by the hashes (see infer_calls)
+    :return: tuple (df, label), where df is the table indexed by the hashes of the reported cached sequences
+        (with NaN for the calls that could not be inferred, see infer_calls) and label is the caller's index name
+    """
+    if cache is None:
+        return pd.DataFrame(), ''
+    rows = cache[cache[HASH].isin(set(hashes))]
+    labels = cache.loc[cache[COLUMN] == ID_LABEL, VALUE]
+    reported = rows.loc[(rows[COLUMN] == REPORTED) & (rows[VALUE] == 'True'), HASH]
+    rows = rows[rows[COLUMN] != REPORTED]
+    columns = pd.unique(rows[COLUMN])
+    calls = rows.pivot(index=HASH, columns=COLUMN, values=VALUE)\
+        .reindex(index=pd.unique(reported), columns=columns)
+    found = [_ for _ in columns if not parse_codon(_) or (calls[_] == RESISTANT).any()]
+    df = calls[found].copy()
+    for drm in found:
+        missing = df[drm].isna().to_numpy()
+        if parse_codon(drm) and missing.any():
+            df.loc[missing, drm] = infer_calls(calls, drm, spans)[missing]
+    return df, labels.iloc[0] if len(labels) else ''
+
+
+def get_witnesses(df, drms):
+    """
+    Picks a sequence resistant to each of the given DRMs, to be called together with other sequences,
+    so that the caller reports these DRMs for them.
+
+    :param df: DRM table indexed by the sequence hashes (see get_drms)
+    :return: list of hashes
+    """
+    return list(dict.fromkeys(df.index[(df[drm] == RESISTANT).to_numpy()][0] for drm in drms))
+
+
+def main(argv=None):
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
+                        filename=None)
+
+    parser = argparse.ArgumentParser(description="Calls the DRMs of the aligned sequences, "
+                                                 "only running the DRM caller on the ones that are not cached yet.")
+    parser.add_argument('--fasta', required=True, type=str)
+    parser.add_argument('--output', required=True, type=str)
+    parser.add_argument('--cache_dir', required=False, type=str, default=None,
+                        help="directory where the DRM calls are kept between the runs "
+                             "(by default ${} or .drm_cache next to the output).".format(CACHE_DIR_ENV))
+    parser.add_argument('--caller', required=False, type=str, default=CALLER,
+                        help="DRM caller command, with {fasta} and {output} placeholders.")
+    parser.add_argument('--caller_version', required=True, type=str,
+                        help="version of the DRM caller, the calls of another version are not reused.")
+    parser.add_argument('--db_version', required=True, type=str,
+                        help="version of the DRM database (e.g. HIVdb), the calls of another version are not reused.")
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('drm_cache', params.instrument)
+
+    cache_dir = params.cache_dir if params.cache_dir \
+        else os.environ.get(CACHE_DIR_ENV, os.path.join(os.path.dirname(os.path.abspath(params.output)), '.drm_cache'))
+    cache_path = get_cache_path(cache_dir, '\t'.join([CACHE_VERSION, params.caller, params.caller_version,
+                                                       params.db_version]))
+
+    with instrument.phase('parse'):
+        ids, seqs = read_sequences(params.fasta)
+        if not ids:
+            raise ValueError('Could not find any sequences in {}.'.format(params.fasta))
+        cache = read_cache(cache_path)
+    with instrument.phase('compute'):
+        hashes = pd.Series([hash_sequence(_) for _ in seqs], index=ids)
+        distinct = hashes[~hashes.duplicated().to_numpy()]
+        hash2seq = dict(zip(hashes.to_numpy()[::-1], seqs[::-1]))
+        spans = pd.DataFrame([get_span(_) for _ in hash2seq.values()], index=list(hash2seq.keys()),
+                             columns=['first', 'last'])
+        hash2id = pd.Series(distinct.index, index=distinct.to_numpy())
+        cached = set(cache.loc[cache[COLUMN] == REPORTED, HASH]) if cache is not None else set()
+        to_call = distinct[~distinct.isin(cached).to_numpy()]
+        df, label = get_drms(hashes.to_numpy(), cache, spans)
+    n_unseen = int(hashes.isin(set(to_call)).sum())
+    instrument.count(sequences=len(ids), cached=len(ids) - n_unseen)
+    logging.info('{} out of {} sequences are cached, calling the DRMs of {}.'
+                 .format(len(ids) - n_unseen, len(ids), len(to_call)))
+
+    # The new sequences are called together with a sequence resistant to each DRM found in the cached ones,
+    # so that the caller reports these DRMs for them. The cached sequences whose calls of the DRMs found
+    # in the new ones cannot be inferred from their codon coverage (see infer_calls) are then called again,
+    # together with a sequence resistant to each of these DRMs.
+    drms = [_ for _ in df.columns if parse_codon(_)]
+    called = False
+    for _ in range(2):
+        if not len(to_call):
+            break
+        witnesses = [_ for _ in get_witnesses(df, drms) if _ not in set(to_call)]
+        batch = pd.concat([to_call, pd.Series(witnesses, index=hash2id[witnesses].to_numpy(), dtype=str)])
+        instrument.count(called=len(batch))
+        with instrument.phase('call'):
+            calls = call_drms(batch.index, [hash2seq[_] for _ in batch], params.caller)
+        with instrument.phase('compute'):
+            cache = update_cache(cache, batch, calls)
+            df, label = get_drms(hashes.to_numpy(), cache, spans)
+            is_unknown = df[[_ for _ in df.columns if parse_codon(_)]].isna()
+            drms = is_unknown.columns[is_unknown.any(axis=0).to_numpy()]
+            to_call = distinct[distinct.isin(set(df.index[is_unknown.any(axis=1).to_numpy()])).to_numpy()]
+        if len(to_call):
+            logging.info('Calling the DRMs {} again for {} cached sequences, whose codon coverage is unknown.'
+                         .format(', '.join(drms), len(to_call)))
+        called = True
+    if len(to_call):
+        logging.warning('Could not call the DRMs {} for {} sequences.'.format(', '.join(drms), len(to_call)))
+    if called:
+        with instrument.phase('write'):
+            write_cache(cache, cache_path)
+
+    with instrument.phase('compute'):
+        is_reported = hashes.isin(set(df.index)).to_numpy()
+        df = df.loc[hashes.to_numpy()[is_reported]]
+        df.index = pd.Index(ids, name=label or None)[is_reported]
+    with instrument.phase('write'):
+        df.to_csv(params.output, sep='\t', index=True)
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,324 @@
+import logging
+import mmap
+import re
+from itertools import product
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+import instrument
+
+# HXB2 (K03455) positions of the first nucleotides of the genes
+GENE_STARTS = {'PR': 2253, 'RT': 2550, 'IN': 4230}
+DRM_REGEX = re.compile(r'^(?P<gene>PR|RT|IN):(?P<wt>[A-Z])(?P<pos>\d+)(?P<mut>[A-Z*]+)$')
+
+# codons translating to more amino acids than that (e.g. NNN) are considered as not sequenced (X), as in HIVdb
+MAX_AMINO_ACIDS = 4
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY*'
+# the standard genetic code, for the codons in TCAG order (TTT, TTC, TTA, TTG, TCT, ...)
+GENETIC_CODE = 'FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG'
+IUPAC = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T', 'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT',
+         'M': 'AC', 'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'}
+UNKNOWN, SENSITIVE, RESISTANT = 0, 1, 2
+VALUES = np.array([np.nan, 'sensitive', 'resistant'], dtype=object)
+CHUNK_SIZE = 50000
+
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[list(b' \t\r\n')] = True
+
+
+def _get_nucleotide_masks():
+    """:return: array mapping the nucleotide characters (as bytes) to 4-bit masks of A, C, G, T (0 for gaps)"""
+    masks = np.zeros(256, dtype=np.uint16)
+    for code, nucs in IUPAC.items():
+        mask = sum(1 << 'ACGT'.index(_) for _ in nucs)
+        masks[ord(code)] = masks[ord(code.lower())] = mask
+    return masks
+
+
+def _get_codon_amino_acids():
+    """:return: arrays mapping the codon masks (m1 << 8 | m2 << 4 | m3) to amino acid bit masks and numbers"""
+    aa_masks = np.zeros(1 << 12, dtype=np.uint32)
+    for masks in product(range(16), repeat=3):
+        aa_mask = 0
+        for codon in product(*[[i for i in range(4) if m & (1 << i)] for m in masks]):
+            # ACGT -> TCAG order
+            i, j, k = ('ACGT'[_] for _ in codon)
+            aa_mask |= 1 << AMINO_ACIDS.index(GENETIC_CODE['TCAG'.index(i) * 16 + 'TCAG'.index(j) * 4
+                                                           + 'TCAG'.index(k)])
+        aa_masks[masks[0] << 8 | masks[1] << 4 | masks[2]] = aa_mask
+    n_aas = np.array([bin(_).count('1') for _ in aa_masks.tolist()], dtype=np.uint8)
+    return aa_masks, n_aas
+
+
+NUCLEOTIDE_MASKS = _get_nucleotide_masks()
+CODON_AMINO_ACIDS, CODON_N_AMINO_ACIDS = _get_codon_amino_acids()
+
+
+def parse_drms(drms):
+    """
+    Parses the DRMs, e.g. RT:K103N (or RT:K103NS for several mutant amino acids).
+
+    :return: tuple (HXB2 positions of the first nucleotides of their codons, wild-type amino acids,
+        bit masks of their mutant amino acids)
+    """
+    positions, wts, mut_masks = [], [], []
+    for drm in drms:
+        m = DRM_REGEX.match(drm)
+        if not m:
+            raise ValueError('Could not parse the DRM {}, expected a gene (PR, RT or IN), a wild-type amino acid, '
+                             'a position and mutant amino acid(s), e.g. RT:K103N.'.format(drm))
+        positions.append(GENE_STARTS[m.group('gene')] + 3 * (int(m.group('pos')) - 1))
+        wts.append(m.group('wt'))
+        mut_masks.append(sum(1 << AMINO_ACIDS.index(_) for _ in m.group('mut')))
+    return np.array(positions, dtype=np.int64), wts, np.array(mut_masks, dtype=np.uint32)
+
+
+def get_codon_columns(reference, positions, reference_start=1):
+    """
+    Locates the codons in the alignment.
+
+    :param reference: uint8 array of the aligned HXB2 reference (with gaps)
+    :param positions: HXB2 positions of the first nucleotides of the codons
+    :param reference_start: HXB2 position of the first reference nucleotide
+    :return: matrix codon x 3 of the alignment columns
+    """
+    columns = np.flatnonzero(NUCLEOTIDE_MASKS[reference] > 0)
+    indices = positions[:, np.newaxis] - reference_start + np.arange(3)
+    if len(positions) and (indices.min() < 0 or indices.max() >= len(columns)):
+        raise ValueError('The reference (covering the HXB2 positions {}-{}) does not cover all the DRM codons.'
+                         .format(reference_start, reference_start + len(columns) - 1))
+    return columns[indices]
+
+
+def translate(codons):
+    """
+    :param codons: uint8 array ... x 3 of the codon nucleotides
+    :return: tuple (amino acid bit masks, numbers of amino acids) of the codons
+    """
+    masks = NUCLEOTIDE_MASKS[codons]
+    indices = masks[..., 0] << 8 | masks[..., 1] << 4 | masks[..., 2]
+    return CODON_AMINO_ACIDS[indices], CODON_N_AMINO_ACIDS[indices]
+
+
+def call(codons, mut_masks):
+    """
+    Calls the DRMs: a DRM is resistant if its codon might translate to one of its mutant amino acids
+    (e.g. AAY, AAN, or the mixture AAM of K and N for RT:K103N), and sensitive otherwise.
+    Codons with gaps or translating to more than MAX_AMINO_ACIDS amino acids are not called.
+
+    :param codons: uint8 array sequence x DRM x 3 of the codon nucleotides
+    :param mut_masks: bit masks of the DRM mutant amino acids
+    :return: uint8 matrix sequence x DRM of UNKNOWN, SENSITIVE or RESISTANT
+    """
+    aa_masks, n_aas = translate(codons)
+    result = np.where((aa_masks & mut_masks) > 0, RESISTANT, SENSITIVE).astype(np.uint8)
+    result[(n_aas == 0) | (n_aas > MAX_AMINO_ACIDS)] = UNKNOWN
+    return result
+
+
+def iter_records(mm):
+    """
+    Iterates over the records of a (memory-mapped) fasta file, in the file order.
+
+    :return: generator of tuples (header_start, start, end), where header_start is the byte offset of the record '>',
+        and start and end are the byte offsets of the record sequence
+    """
+    start = 0 if mm[:1] == b'>' else mm.find(b'\n>')
+    while start >= 0:
+        if mm[start: start + 1] == b'\n':
+            start += 1
+        header_end = mm.find(b'\n', start)
+        if header_end < 0:
+            header_end = len(mm)
+        next_start = mm.find(b'\n>', header_end)
+        yield start, header_end + 1, next_start + 1 if next_start >= 0 else len(mm)
+        start = next_start
+
+
+def index_fasta(mm):
+    """
+    Finds the records of a (memory-mapped) fasta file.
+
+    :return: tuple (ids, starts, ends) where starts and ends are the byte offsets of the record sequences
+    """
+    ids, starts, ends = [], [], []
+    for header_start, start, end in iter_records(mm):
+        title = mm[header_start + 1: start - 1].split(None, 1)
+        ids.append(title[0].decode() if title else '')
+        starts.append(start)
+        ends.append(end)
+    return ids, np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64)
+
+
+def get_residues(mm, start, end):
+    """:return: uint8 array of the sequence between the given byte offsets, without the line breaks"""
+    body = np.frombuffer(mm[start: end], dtype=np.uint8)
+    return body[~WHITESPACE[body]]
+
+
+class AlignmentReader(object):
+    """
+    Gathers given alignment columns from a memory-mapped fasta file.
+    The records laid out as the first one (same sequence length, line breaks at the same places) are accessed
+    directly by their byte offsets, the others are read one by one.
+    """
+
+    def __init__(self, fasta):
+        self.file = open(fasta, 'rb')
+        try:
+            self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError('Could not find any sequences in {}.'.format(fasta))
+        self.data = np.frombuffer(self.mm, dtype=np.uint8)
+
+    def close(self):
+        del self.data
+        self.mm.close()
+        self.file.close()
+
+    def set_layout(self, start, end):
+        """Sets the layout of the regular records from the record at the given byte offsets."""
+        body = self.data[start: end]
+        self.body_length = end - start
+        self.offsets = np.flatnonzero(~WHITESPACE[body])
+        self.breaks = np.flatnonzero(WHITESPACE[body])
+
+    @property
+    def length(self):
+        return len(self.offsets)
+
+    def gather(self, starts, ends, columns):
+        """
+        :param starts: byte offsets of the record sequences
+        :param ends: byte offsets of the record ends
+        :param columns: array of alignment columns
+        :return: uint8 array record x columns.shape
+        """
+        result = np.empty((len(starts),) + columns.shape, dtype=np.uint8)
+        is_regular = ends - starts == self.body_length
+        if len(self.breaks):
+            is_regular[is_regular] = WHITESPACE[self.data[starts[is_regular][:, np.newaxis] + self.breaks]].all(axis=1)
+        offsets = self.offsets[columns]
+        result[is_regular] = self.data[starts[is_regular].reshape((-1,) + (1,) * columns.ndim) + offsets]
+        for i in np.flatnonzero(~is_regular):
+            residues = get_residues(self.mm, starts[i], ends[i])
+            if len(residues) != self.length:
+                raise ValueError('The sequences are not aligned: found sequences of length {} and {}.'
+                                 .format(self.length, len(residues)))
+            result[i] = residues[columns]
+        return result
+
+
+_reader, _columns, _mut_masks = None, None, None
+
+
+def _init_worker(fasta, layout, columns, mut_masks):
+    global _reader, _columns, _mut_masks
+    _reader = AlignmentReader(fasta)
+    _reader.set_layout(*layout)
+    _columns, _mut_masks = columns, mut_masks
+
+
+def _call_chunk(args):
+    starts, ends = args
+    return call(_reader.gather(starts, ends, _columns), _mut_masks)
+
+
+def call_drms(fasta, drms, reference=None, reference_id=None, reference_start=1, threads=1, chunk_size=CHUNK_SIZE):
+    """
+    Calls the DRMs for all the sequences of an alignment, by chunks of sequences (possibly in parallel).
+
+    :param drms: list of DRMs, e.g. RT:K103N
+    :param reference: uint8 array of the aligned HXB2 reference
+        (or None to take the sequence reference_id from the alignment)
+    :param reference_start: HXB2 position of the first reference nucleotide
+    :return: tuple (ids, matrix sequence x DRM of UNKNOWN, SENSITIVE or RESISTANT)
+    """
+    positions, wts, mut_masks = parse_drms(drms)
+    reader = AlignmentReader(fasta)
+    try:
+        with instrument.phase('parse'):
+            ids, starts, ends = index_fasta(reader.mm)
+        if not ids:
+            raise ValueError('Could not find any sequences in {}.'.format(fasta))
+        instrument.count(sequences=len(ids), drms=len(drms))
+        layout = starts[0], ends[0]
+        reader.set_layout(*layout)
+        if reference is None:
+            if reference_id not in ids:
+                raise ValueError('The reference {} is not found in {}.'.format(reference_id, fasta))
+            i = ids.index(reference_id)
+            reference = get_residues(reader.mm, starts[i], ends[i])
+            # the reference itself is not called
+            ids, starts, ends = ids[:i] + ids[i + 1:], np.delete(starts, i), np.delete(ends, i)
+        if len(reference) != reader.length:
+            raise ValueError('The reference is of length {}, while the alignment is of length {}.'
+                             .format(len(reference), reader.length))
+        columns = get_codon_columns(reference, positions, reference_start)
+        aa_masks, _ = translate(reference[columns])
+        for drm, wt, aa_mask in zip(drms, wts, aa_masks):
+            if not aa_mask & (1 << AMINO_ACIDS.index(wt)):
+                logging.warning('The reference codon of {} does not translate to {}, check the reference start.'
+                                .format(drm, wt))
+
+        tasks = [(starts[_: _ + chunk_size], ends[_: _ + chunk_size]) for _ in range(0, len(ids), chunk_size)]
+        with instrument.phase('compute'):
+            if threads > 1 and len(tasks) > 1:
+                with Pool(processes=min(threads, len(tasks)), initializer=_init_worker,
+                          initargs=(fasta, layout, columns, mut_masks)) as pool:
+                    results = pool.map(_call_chunk, tasks)
+            else:
+                results = [call(reader.gather(s, e, columns), mut_masks) for (s, e) in tasks]
+    finally:
+        reader.close()
+    return ids, np.concatenate(results) if results else np.zeros((0, len(drms)), dtype=np.uint8)
+
+
+def main(argv=None):
+    import argparse
+
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
+                        filename=None)
+
+    parser = argparse.ArgumentParser(description="Calls the given DRMs in all the sequences of a nucleotide "
+                                                 "alignment, into a table like the sdrmhunter one "
+                                                 "(resistant, sensitive, or empty for not sequenced codons).")
+    parser.add_argument('--fasta', required=True, type=str, help="the alignment.")
+    parser.add_argument('--output', required=True, type=str)
+    parser.add_argument('--drms', required=True, type=str, nargs='+', help="DRMs, e.g. RT:K103N RT:M184V")
+    reference_group = parser.add_mutually_exclusive_group(required=True)
+    reference_group.add_argument('--reference', type=str,
+                                 help="fasta file with the HXB2 sequence aligned to the alignment "
+                                      "(e.g. with mafft --add --keeplength), as its first record.")
+    reference_group.add_argument('--reference_id', type=str,
+                                 help="id of the HXB2 sequence in the alignment.")
+    parser.add_argument('--reference_start', required=False, type=int, default=1,
+                        help="HXB2 position of the first reference nucleotide (e.g. 2085 for a pol reference).")
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='number of sequences to call at once.')
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('drm_caller', params.instrument)
+
+    reference = None
+    if params.reference:
+        with open(params.reference, 'r') as f:
+            _, seq = next(SimpleFastaParser(f))
+        reference = np.frombuffer(seq.encode(), dtype=np.uint8)
+
+    ids, result = call_drms(params.fasta, params.drms, reference, params.reference_id, params.reference_start,
+                            params.threads, params.chunk_size)
+    logging.info('Found {} resistant sequences out of {} (for at least one DRM).'
+                 .format(np.count_nonzero((result == RESISTANT).any(axis=1)), len(ids)))
+    with instrument.phase('write'):
+        df = pd.DataFrame(VALUES[result], index=pd.Index(ids, name='id'), columns=params.drms)
+        df.to_csv(params.output, sep='\t', index=True)
+
+
+if '__main__' == __name__:
+    main()
@@ -1,58 +1,75 @@
 import pandas as pd
-from ete3 import Tree
 
+import instrument
+import memo
+from cut_by_date import get_arv_year
+from merge_tables import get_levelorder
+from tree_io import read_tree
 
-def read_tree(nwk):
-    tree = None
-    for format in range(10):
-        try:
-            tree = Tree(nwk, format=format)
-            break
-        except:
-            continue
-    return tree
 
+def annotate_sensitive(df, acr_df, arv, names, dates, drm_date):
+    """
+    Combines the tip metadata for the given DRM with its ACR on the forest cut at the DRM date:
+    the ACR predictions replace the metadata, and all the nodes older than the DRM date are sensitive.
 
-if '__main__' == __name__:
+    :param df: tip metadata table containing the arv column
+    :param acr_df: ACR table (with one column) for the cut forest
+    :param names: array of tree node names, in level order (the new sensitive rows come in this order)
+    :param dates: array of tree node dates, in the same order
+    :return: the combined table
+    """
+    df = df.loc[~df.index.isin(acr_df.index), [arv]].copy()
+    acr_df = acr_df.set_axis([arv], axis=1)
+
+    sensitive = pd.unique(names[dates < drm_date])
+    is_known = pd.Index(sensitive).isin(df.index)
+    df.loc[sensitive[is_known], arv] = 'sensitive'
+    new_df = pd.DataFrame(index=sensitive[~is_known], columns=[arv], data='sensitive')
+    return pd.concat([df, new_df, acr_df])
+
+
+def main(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--input_tab', required=True, type=str)
-    parser.add_argument('--input_acr', required=True, type=str)
+    parser.add_argument('--input_acr', required=True, type=str, nargs='+', help="ACR table(s), one per ARV")
     parser.add_argument('--input_tree', required=True, type=str)
-    parser.add_argument('--output_tab', required=True, type=str)
-    parser.add_argument('--arv_tab', required=True, type=str)
+    parser.add_argument('--output_tab', required=True, type=str, nargs='+', help="output table(s), one per ARV")
+    parser.add_argument('--arv_tab', required=True, type=str, nargs='+')
     parser.add_argument('--root_date', required=True, type=float)
-    parser.add_argument('--arv', required=True, type=str)
-    params = parser.parse_args()
+    parser.add_argument('--arv', required=True, type=str, nargs='+')
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('drm_metadata', params.instrument)
 
-    tree = read_tree(params.input_tree)
-    for n in tree.traverse('preorder'):
-        n.add_feature('date', params.root_date if n.is_root() else (getattr(n.up, 'date') + n.dist))
+    if not len(params.arv) == len(params.input_acr) == len(params.output_tab):
+        raise ValueError('Expected as many ACR tables and output tables as ARVs ({}).'.format(len(params.arv)))
 
-    df = pd.read_csv(params.input_tab, index_col=0, sep='\t')
-    df = df[[params.arv]]
-    df.index = df.index.map(str)
-    df = df.loc[[_.name for _ in tree], :]
+    with instrument.phase('parse'):
+        tree = read_tree(params.input_tree)
+        df = memo.read_csv(params.input_tab, index_col=0, sep='\t')[params.arv]
+        arv_df = pd.concat([memo.read_csv(_, sep='\t') for _ in params.arv_tab])
+    instrument.count(nodes=tree.n_nodes, tips=len(tree.tips), columns=len(params.arv))
+    with instrument.phase('annotate'):
+        levelorder = get_levelorder(tree)
+        dates = tree.root_distances(params.root_date)[levelorder]
+        names = tree.names[levelorder]
+        df.index = df.index.map(str)
+        df = df.loc[tree.names[tree.tips], :]
 
-    acr_df = pd.read_csv(params.input_acr, index_col=0, sep='\t')
-    acr_df.columns = df.columns
-    acr_df.index = acr_df.index.map(str)
+    for arv, input_acr, output_tab in zip(params.arv, params.input_acr, params.output_tab):
+        with instrument.phase('parse'):
+            acr_df = memo.read_csv(input_acr, index_col=0, sep='\t')
+            acr_df.index = acr_df.index.map(str)
+        with instrument.phase('compute'):
+            drm_date, _ = get_arv_year(arv_df, arv)
+            out_df = annotate_sensitive(df, acr_df, arv, names, dates, drm_date)
+        instrument.count(rows=len(out_df))
+        with instrument.phase('write'):
+            out_df.to_csv(output_tab, sep='\t', index_label='node id')
 
-    df.drop(set(acr_df.index) & set(df.index), axis=0, inplace=True)
-
-    arv_df = pd.read_csv(params.arv_tab, sep='\t')
-    if params.arv in arv_df['mutation'].unique():
-        arv_df = arv_df[arv_df['mutation'] == params.arv]
-    else:
-        arv_df = arv_df[arv_df['drug abbreviation'] == params.arv]
-    drm_date = float(arv_df['year'].min())
-
-    for n in tree.traverse():
-        date = getattr(n, 'date')
-        if date < drm_date:
-            df.loc[n.name, params.arv] = 'sensitive'
-
-    pd.concat([df, acr_df]).to_csv(params.output_tab, sep='\t', index_label='node id')
 
+if '__main__' == __name__:
+    main()
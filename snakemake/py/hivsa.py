@@ -0,0 +1,157 @@
+import importlib
+import logging
+import shlex
+import sys
+import time
+
+import instrument
+import memo
+
+# subcommand -> (module, description), the modules are only imported when their subcommand is run
+COMMANDS = {
+    'data_reader_africa': ('data_reader_africa', 'extracts the metadata and the DRMs of the sequences'),
+    'drm_cache': ('drm_cache', 'calls the DRMs of the new sequences, reusing the cached calls'),
+    'drm_caller': ('drm_caller', 'calls the given DRMs in all the sequences of an alignment'),
+    'aln_stats': ('aln_stats', 'calculates the alignment length, gap and ambiguity fractions and site patterns'),
+    'drm2arv': ('drm2arv', 'updates the DRM knowledge base and lists the ARVs per DRM'),
+    'prevalence': ('prevalence', 'calculates the DRM prevalence'),
+    'collapse': ('collapse', 'collapses the tree branches with a low feature value'),
+    'name_tree': ('name_tree', 'names the internal nodes of a tree'),
+    'cut_by_date': ('cut_by_date', 'cuts a tree into the forest(s) before the ARV introduction dates'),
+    'drm_metadata': ('drm_metadata', 'combines the DRM ACRs before and after the ARV introduction'),
+    'subsampling': ('subsampling', 'subsamples a tree by state and year'),
+    'check_subsampling': ('check_subsampling', 'compares the ACRs of the subsampled trees'),
+    'merge_tables': ('merge_tables', 'merges the ACR tables'),
+    'mp_store': ('mp_store', 'converts the marginal probabilities into binary stores'),
+    'vis_LTT': ('vis_LTT', 'plots the lineages through time'),
+    'vis_transmissions': ('vis_transmissions', 'counts and visualises the transmissions between states'),
+    'summary': ('instrument', 'summarises where the time went across a pipeline run'),
+    'pastml': ('pastml.acr', 'runs PastML'),
+    'pastml_columns': ('pastml_columns', 'runs PastML for several columns on one tree load'),
+}
+
+
+def get_command(name):
+    """Finds the subcommand by its name, or by the path of its script (e.g. py/cut_by_date.py)."""
+    if name not in COMMANDS and name.endswith('.py'):
+        name = name.replace('\\', '/').split('/')[-1][:-len('.py')]
+    if name not in COMMANDS:
+        raise ValueError('Unknown command {}, choose among {}.'.format(name, ', '.join(COMMANDS)))
+    return name
+
+
+def run(command, args):
+    """
+    Runs the subcommand with the given arguments in this interpreter.
+
+    :param command: subcommand name (see COMMANDS)
+    :param args: list of its command-line arguments
+    :return: exit code (0 for success)
+    """
+    command = get_command(command)
+    start = time.perf_counter()
+    module = importlib.import_module(COMMANDS[command][0])
+    imported = time.perf_counter()
+    argv, sys.argv = sys.argv, [command] + list(args)
+    code = 0
+    try:
+        # PastML parses sys.argv itself
+        module.main() if 'pastml' == command else module.main(list(args))
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    finally:
+        instrument.finish()
+        sys.argv = argv
+        if 'matplotlib.pyplot' in sys.modules:
+            sys.modules['matplotlib.pyplot'].close('all')
+    logging.info('{}: imported in {:.2f}s, ran in {:.2f}s{}.'
+                 .format(command, imported - start, time.perf_counter() - imported,
+                         ', exit code {}'.format(code) if code else ''))
+    return code
+
+
+def read_batch(batch):
+    """
+    Reads the invocations from a batch file (- for stdin): one per line, the subcommand (or its script path)
+    followed by its arguments, quoted as in a shell. Empty lines and lines starting with # are skipped.
+
+    :return: list of argument lists
+    """
+    f = sys.stdin if '-' == batch else open(batch, 'r')
+    try:
+        invocations = [shlex.split(line) for line in f if line.strip() and not line.lstrip().startswith('#')]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    # the lines copied from a shell (python3 py/cut_by_date.py ...) are accepted as well
+    return [_[1:] if _[0].startswith('python') and len(_) > 1 else _ for _ in invocations]
+
+
+def run_batch(invocations, keep_going=False, memo_size=memo.MAX_ENTRIES):
+    """
+    Runs the invocations one after another in this (warm) interpreter,
+    reusing the parsed input trees and tables between them (see memo.py).
+
+    :param memo_size: the maximal number of parsed inputs kept in memory
+    :return: exit code: 0 if all the invocations succeeded, otherwise that of the first failed one
+    """
+    memo.enable(memo_size)
+    result = 0
+    for i, invocation in enumerate(invocations):
+        try:
+            code = run(invocation[0], invocation[1:])
+        except Exception:
+            logging.exception('Invocation {} ({}) failed.'.format(i + 1, ' '.join(invocation)))
+            code = 1
+        if code and not result:
+            result = code
+        if code and not keep_going:
+            break
+    memo.disable()
+    return result
+
+
+def main(argv=None):
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
+                        filename=None)
+
+    argv = sys.argv[1:] if argv is None else argv
+    commands = '\n'.join('  {:<20}{}'.format(name, description) for (name, (_, description)) in COMMANDS.items())
+    parser = argparse.ArgumentParser(
+        prog='hivsa', formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Runs the pipeline scripts as subcommands (hivsa <command> [arguments], "
+                    "see hivsa <command> -h), or several of them in one interpreter (hivsa batch).",
+        epilog='commands:\n{}\n  {:<20}{}'.format(commands, 'batch',
+                                                  'runs a list of invocations (see hivsa batch -h)'))
+    parser.add_argument('command', type=str, help="the subcommand")
+    parser.add_argument('args', nargs=argparse.REMAINDER, help="its arguments")
+    params = parser.parse_args(argv[:1])
+
+    if 'batch' != params.command:
+        try:
+            command = get_command(params.command)
+        except ValueError as e:
+            parser.error(str(e))
+        return run(command, argv[1:])
+
+    batch_parser = argparse.ArgumentParser(prog='hivsa batch',
+                                           description="Runs the invocations one after another in one interpreter, "
+                                                       "reusing the parsed input trees and tables between them.")
+    batch_parser.add_argument('batch', type=str,
+                              help="file with one invocation per line (- for stdin): "
+                                   "the subcommand (or its script path) followed by its arguments, e.g. "
+                                   "prevalence --input metadata.tab --output prevalence.tab")
+    batch_parser.add_argument('--keep_going', action='store_true', default=False,
+                              help="run the next invocations even if one fails.")
+    batch_parser.add_argument('--memo_size', type=int, default=memo.MAX_ENTRIES,
+                              help="the maximal number of parsed inputs kept in memory between the invocations "
+                                   "(the least recently used ones are dropped first).")
+    batch_params = batch_parser.parse_args(argv[1:])
+    return run_batch(read_batch(batch_params.batch), keep_going=batch_params.keep_going,
+                     memo_size=batch_params.memo_size)
+
+
+if '__main__' == __name__:
+    sys.exit(main())
@@ -0,0 +1,218 @@
+import atexit
+import datetime
+import glob
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+INSTRUMENT_ENV = 'INSTRUMENT_JSON'
+
+
+class Instrument(object):
+    """
+    Records the phase timings, the peak memory and some counts (e.g. of nodes, tips or columns) of a script run,
+    to be written as a JSON record.
+    """
+
+    def __init__(self, script=None, output=None):
+        self.script = script
+        self.output = output
+        self.start_time = time.perf_counter()
+        self.started = datetime.datetime.now().isoformat(timespec='seconds')
+        self.phases = {}
+        self.counts = {}
+
+    @property
+    def enabled(self):
+        return bool(self.output)
+
+    @contextmanager
+    def phase(self, name):
+        """Times the enclosed code, adding its duration (and call) to the given phase."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {'seconds': 0., 'calls': 0})
+            phase['seconds'] += time.perf_counter() - start
+            phase['calls'] += 1
+
+    def count(self, **counts):
+        """Records the given counts, adding them to the previous ones with the same names."""
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + int(value)
+
+    def to_dict(self):
+        return {'script': self.script, 'argv': sys.argv[1:], 'started': self.started, 'host': platform.node(),
+                'pid': os.getpid(), 'seconds': time.perf_counter() - self.start_time, 'peak_rss_mb': get_peak_rss(),
+                'phases': self.phases, 'counts': self.counts}
+
+    def write(self):
+        """
+        Writes the record as JSON: to stderr if the output is -, as a new file in the output directory
+        if it exists (or ends with /), otherwise appending a line to the output file.
+        """
+        if not self.enabled:
+            return
+        line = json.dumps(self.to_dict())
+        if '-' == self.output:
+            sys.stderr.write('{}\n'.format(line))
+            return
+        if os.path.isdir(self.output) or self.output.endswith(os.sep):
+            os.makedirs(self.output, exist_ok=True)
+            path = os.path.join(self.output, '{}.{}.{}.json'.format(self.script, platform.node(), os.getpid()))
+        else:
+            path = self.output
+        with open(path, 'a') as f:
+            f.write('{}\n'.format(line))
+
+
+def get_peak_rss():
+    """:return: peak resident set size of this process in MB"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in KB on Linux
+    return max_rss / 1024 / 1024 if 'darwin' == sys.platform else max_rss / 1024
+
+
+_instrument = Instrument()
+
+
+def add_instrument_argument(parser):
+    parser.add_argument('--instrument', type=str, default=None,
+                        help="write the phase timings, peak memory and counts of this run as JSON "
+                             "to this file (appending), directory or - for stderr "
+                             "(by default to ${} if set, otherwise nowhere).".format(INSTRUMENT_ENV))
+
+
+def start(script, output=None):
+    """
+    Starts instrumenting this run of the script (if an output is given, or set in the INSTRUMENT_JSON variable).
+    The record is written at exit.
+    """
+    global _instrument
+    _instrument = Instrument(script, output if output else os.environ.get(INSTRUMENT_ENV, None))
+    if _instrument.enabled:
+        atexit.register(_instrument.write)
+    return _instrument
+
+
+def finish():
+    """
+    Writes the record of the current run (if instrumented) now rather than at exit,
+    and stops instrumenting, so that the next run in the same interpreter (see hivsa.py batch) gets its own record.
+    """
+    global _instrument
+    if _instrument.enabled:
+        atexit.unregister(_instrument.write)
+        _instrument.write()
+    _instrument = Instrument()
+
+
+def phase(name):
+    return _instrument.phase(name)
+
+
+def count(**counts):
+    _instrument.count(**counts)
+
+
+def read_records(paths):
+    """Reads the JSON records (one per line) from the given files and directories."""
+    records = []
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        for file in sorted(glob.glob(os.path.join(path, '*.json'))) if os.path.isdir(path) else [path]:
+            with open(file, 'r') as f:
+                records.extend(json.loads(_) for _ in f if _.strip())
+    return records
+
+
+def summarize(records):
+    """
+    Summarises where the time went: per script and phase, the number of runs, the total and the maximal time,
+    its share of the total time of all the runs, and the maximal peak RSS.
+    The time spent outside of the recorded phases is reported as the phase 'other'.
+
+    :return: list of summary rows (dictionaries), sorted by decreasing total time
+    """
+    total = sum(_['seconds'] for _ in records) or 1
+    stats = {}
+    for record in records:
+        phases = {name: _['seconds'] for name, _ in record['phases'].items()}
+        phases['other'] = max(record['seconds'] - sum(phases.values()), 0)
+        phases['total'] = record['seconds']
+        for name, seconds in phases.items():
+            stat = stats.setdefault((record['script'], name), {'script': record['script'], 'phase': name, 'runs': 0,
+                                                               'seconds': 0., 'max_seconds': 0., 'peak_rss_mb': 0.})
+            stat['runs'] += 1
+            stat['seconds'] += seconds
+            stat['max_seconds'] = max(stat['max_seconds'], seconds)
+            stat['peak_rss_mb'] = max(stat['peak_rss_mb'], record['peak_rss_mb'])
+    for stat in stats.values():
+        stat['%'] = 100 * stat['seconds'] / total
+    return sorted(stats.values(), key=lambda _: (-_['seconds'], _['phase'] != 'total'))
+
+
+def summarize_benchmarks(paths):
+    """
+    Summarises Snakemake benchmark files (benchmarks/{rule}/...): per rule, the number of jobs,
+    the total and the maximal wall time (s), and the maximal max_rss (MB).
+
+    :return: list of summary rows (dictionaries), sorted by decreasing total time
+    """
+    import pandas as pd
+
+    stats = {}
+    for path in paths:
+        rule = os.path.basename(os.path.dirname(path))
+        df = pd.read_csv(path, sep='\t')
+        stat = stats.setdefault(rule, {'rule': rule, 'jobs': 0, 'seconds': 0., 'max_seconds': 0., 'max_rss_mb': 0.})
+        stat['jobs'] += 1
+        stat['seconds'] += df['s'].mean()
+        stat['max_seconds'] = max(stat['max_seconds'], df['s'].max())
+        if 'max_rss' in df.columns:
+            stat['max_rss_mb'] = max(stat['max_rss_mb'], pd.to_numeric(df['max_rss'], errors='coerce').max())
+    return sorted(stats.values(), key=lambda _: -_['seconds'])
+
+
+def main(argv=None):
+    import argparse
+
+    import pandas as pd
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
+                        filename=None)
+
+    parser = argparse.ArgumentParser(description="Summarises where the time went across a pipeline run.")
+    parser.add_argument('--records', type=str, nargs='*', default=[],
+                        help="instrumentation JSON files or directories (see --instrument of the scripts)")
+    parser.add_argument('--benchmarks', type=str, nargs='*', default=[],
+                        help="Snakemake benchmark files")
+    parser.add_argument('--output_tab', type=str, default=None, help="per script and phase summary")
+    parser.add_argument('--output_rule_tab', type=str, default=None, help="per rule summary")
+    params = parser.parse_args(argv)
+
+    pd.set_option('display.width', 200)
+    df = pd.DataFrame(summarize_benchmarks(params.benchmarks),
+                      columns=['rule', 'jobs', 'seconds', 'max_seconds', 'max_rss_mb'])
+    logging.info('Time per rule:\n{}'.format(df.to_string(index=False, float_format='%.2f')))
+    if params.output_rule_tab:
+        df.to_csv(params.output_rule_tab, sep='\t', index=False, float_format='%.3f')
+    df = pd.DataFrame(summarize(read_records(params.records)),
+                      columns=['script', 'phase', 'runs', 'seconds', 'max_seconds', '%', 'peak_rss_mb'])
+    logging.info('Time per script and phase:\n{}'.format(df.to_string(index=False, float_format='%.2f')))
+    if params.output_tab:
+        df.to_csv(params.output_tab, sep='\t', index=False, float_format='%.3f')
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,67 @@
+import logging
+import os
+from collections import OrderedDict
+
+# the maximal number of parsed inputs kept in memory by default
+MAX_ENTRIES = 8
+
+_cache = None
+_max_entries = MAX_ENTRIES
+
+
+def enable(max_entries=MAX_ENTRIES):
+    """
+    Starts keeping the parsed inputs (trees, tables) in memory,
+    so that the next invocations in the same interpreter (see hivsa.py batch) reuse them.
+    Only the max_entries most recently used ones are kept, and the ones of the files that have changed since are dropped.
+    """
+    global _cache, _max_entries
+    if _cache is None:
+        _cache = OrderedDict()
+    _max_entries = max_entries
+
+
+def disable():
+    global _cache
+    _cache = None
+
+
+def is_enabled():
+    return _cache is not None
+
+
+def get(path, key, load):
+    """
+    Loads the given file with load() or, if memoization is enabled and the file has not changed since,
+    returns what was loaded before with the same key.
+    The returned object is shared between the invocations and must not be modified.
+
+    :param path: path to the input file
+    :param key: hashable description of how the file is loaded (e.g. the function name and its arguments)
+    :param load: function without arguments that loads the file
+    """
+    if _cache is None:
+        return load()
+    stat = os.stat(path)
+    path = os.path.abspath(path)
+    memo_key = (path, stat.st_mtime_ns, stat.st_size, key)
+    if memo_key in _cache:
+        logging.debug('Reusing the loaded {}.'.format(path))
+        _cache.move_to_end(memo_key)
+        return _cache[memo_key]
+    value = load()
+    for stale_key in [_ for _ in _cache if _[0] == path and _[3] == key]:
+        del _cache[stale_key]
+    _cache[memo_key] = value
+    while len(_cache) > _max_entries:
+        _cache.popitem(last=False)
+    return value
+
+
+def read_csv(path, **kwargs):
+    """Reads a table with pandas.read_csv, reusing (a copy of) the table read before if memoization is enabled."""
+    import pandas as pd
+
+    key = ('read_csv', tuple(sorted((k, repr(v)) for k, v in kwargs.items())))
+    df = get(path, key, lambda: pd.read_csv(path, **kwargs))
+    return df.copy() if _cache is not None else df
@@ -1,9 +1,89 @@
+import numpy as np
 import pandas as pd
-from pastml.annotation import preannotate_forest
-from pastml.tree import read_tree
-from pastml.acr import _serialize_predicted_states, annotate_dates
 
-if '__main__' == __name__:
+import instrument
+from tree_io import read_tree
+
+CHUNK_SIZE = 10000
+
+
+def read_states(tab):
+    """
+    Reads the predicted states from the first column of a PastML combined_ancestral_states table.
+
+    :return: tuple (names, value_codes, values): parallel arrays of node names and state codes
+        (without duplicates or empty values), and the sorted array of states, indexed by the codes
+    """
+    df = pd.read_csv(tab, sep='\t', header=0, usecols=[0, 1], converters={0: str})
+    df = df[~df.iloc[:, 1].isna()].drop_duplicates()
+    value_codes, values = pd.factorize(df.iloc[:, 1], sort=True)
+    return df.iloc[:, 0].to_numpy(dtype=object), value_codes, values
+
+
+def get_levelorder(tree):
+    """Lists the node indices in the order of a breadth-first traversal (as ete3 traverse() does)."""
+    return np.argsort(tree.depths(), kind='stable')
+
+
+def merge_states(names, tabs):
+    """
+    Joins the predicted states of several tables over the node names.
+
+    :param names: array of node names to keep
+    :param tabs: list of tables (see read_states)
+    :return: tuple (name_index, rows, values, n_rows): name_index is the index of unique node names,
+        rows is a dictionary of parallel arrays (name code, row rank, column) sorted by name code,
+        values is the corresponding array of formatted states,
+        and n_rows is the number of rows each name needs (its maximal number of states in a column).
+        The states of a node in each column are sorted, the k-th one being put into the k-th row of the node.
+    """
+    name_index = pd.Index(pd.unique(names))
+    name_codes, columns, value_codes, values = [], [], [], []
+    for column, tab in enumerate(tabs):
+        tab_names, tab_value_codes, tab_values = read_states(tab)
+        codes = name_index.get_indexer(tab_names)
+        is_kept = codes >= 0
+        name_codes.append(codes[is_kept])
+        columns.append(np.full(np.count_nonzero(is_kept), column, dtype=np.int32))
+        # the codes are ordered as the states, so sorting by codes sorts the states within each column
+        value_codes.append(tab_value_codes[is_kept])
+        values.append(np.array(['{}'.format(_) for _ in tab_values], dtype=object)[tab_value_codes[is_kept]])
+    name_codes, columns, value_codes, values = (np.concatenate(_) for _ in (name_codes, columns, value_codes, values))
+    order = np.lexsort((value_codes, columns, name_codes))
+    name_codes, columns, values = name_codes[order], columns[order], values[order]
+
+    group_starts = np.flatnonzero(np.r_[True, (name_codes[1:] != name_codes[:-1]) | (columns[1:] != columns[:-1])])
+    group_sizes = np.diff(np.append(group_starts, len(name_codes)))
+    ranks = np.arange(len(name_codes)) - np.repeat(group_starts, group_sizes)
+    n_rows = np.zeros(len(name_index), dtype=np.int64)
+    np.maximum.at(n_rows, name_codes, ranks + 1)
+    return name_index, {'name': name_codes, 'rank': ranks, 'column': columns}, values, n_rows
+
+
+def write_merged_states(out_tab, column_names, node_names, name_index, rows, values, n_rows, chunk_size=CHUNK_SIZE):
+    """
+    Writes the merged states (see merge_states) in the given node order, by chunks of nodes,
+    as pastml does: a row per node and state rank, with the node name and its k-th state in each column (if any).
+    """
+    node_codes = name_index.get_indexer(node_names)
+    starts = np.searchsorted(rows['name'], np.arange(len(name_index)), side='left')
+    ends = np.searchsorted(rows['name'], np.arange(len(name_index)), side='right')
+    with open(out_tab, 'w+') as f:
+        f.write('node\t{}\n'.format('\t'.join(column_names)))
+        for chunk_start in range(0, len(node_codes), chunk_size):
+            codes = node_codes[chunk_start: chunk_start + chunk_size]
+            codes = codes[n_rows[codes] > 0]
+            lengths = ends[codes] - starts[codes]
+            entries = np.repeat(starts[codes] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            row_starts = np.cumsum(n_rows[codes]) - n_rows[codes]
+            matrix = np.full((n_rows[codes].sum(), len(column_names) + 1), '', dtype=object)
+            matrix[:, 0] = np.repeat(name_index[codes].to_numpy(dtype=object), n_rows[codes])
+            matrix[np.repeat(row_starts, lengths) + rows['rank'][entries], rows['column'][entries] + 1] = \
+                values[entries]
+            f.write(''.join('{}\n'.format('\t'.join(_)) for _ in matrix))
+
+
+def main(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser()
@@ -12,15 +92,23 @@ if '__main__' == __name__:
     parser.add_argument('--input_names', nargs='+', type=str)
     parser.add_argument('--tree', required=True, type=str)
     parser.add_argument('--output_tab', required=True, type=str)
-    parser.add_argument('--root_date', required=False, type=float, default=0)
-    params = parser.parse_args()
-
-    tree = read_tree(params.tree)
-    annotate_dates([tree], root_dates=[params.root_date])
-    columns = []
-    for tab, name in zip(params.input_tabs, params.input_names):
-        tab_df = pd.read_csv(tab, sep='\t', header=0, index_col=0)
-        tab_df.columns = [name]
-        columns.extend(preannotate_forest(forest=[tree], df=tab_df)[0])
-    _serialize_predicted_states(columns, params.output_tab, [tree])
+    parser.add_argument('--root_date', required=False, type=float, default=0,
+                        help="(ignored, the node dates are not part of the merged table)")
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('merge_tables', params.instrument)
+
+    with instrument.phase('parse'):
+        tree = read_tree(params.tree)
+    instrument.count(nodes=tree.n_nodes, tips=len(tree.tips), columns=len(params.input_tabs))
+    with instrument.phase('annotate'):
+        node_names = tree.names[get_levelorder(tree)]
+    with instrument.phase('compute'):
+        name_index, rows, values, n_rows = merge_states(node_names, params.input_tabs)
+    instrument.count(states=len(values), rows=n_rows.sum())
+    with instrument.phase('write'):
+        write_merged_states(params.output_tab, params.input_names, node_names, name_index, rows, values, n_rows)
 
+
+if '__main__' == __name__:
+    main()
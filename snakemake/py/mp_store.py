@@ -0,0 +1,115 @@
+import logging
+
+import numpy as np
+
+import instrument
+import memo
+
+STORE_SUFFIX = '.npy'
+INDEX_SUFFIX = '.index.npz'
+
+
+def get_index_path(store_path):
+    """:return: path of the node and state index of the store (e.g. mp.index.npz for mp.npy)"""
+    return '{}{}'.format(store_path[:-len(STORE_SUFFIX)] if store_path.endswith(STORE_SUFFIX) else store_path,
+                         INDEX_SUFFIX)
+
+
+def write_store(store_path, nodes, states, mps, dtype=np.float64):
+    """
+    Saves the marginal probabilities in a binary store: a node x state matrix (store_path, in .npy format,
+    that can be memory-mapped) and its node and state index (see get_index_path).
+    """
+    np.save(store_path, np.ascontiguousarray(mps, dtype=dtype))
+    np.savez(get_index_path(store_path), nodes=np.asarray(nodes, dtype=str), states=np.asarray(states, dtype=str))
+
+
+def _read_store(store_path):
+    with np.load(get_index_path(store_path)) as npz:
+        nodes, states = npz['nodes'], npz['states']
+    mps = np.load(store_path, mmap_mode='r')
+    if mps.shape != (len(nodes), len(states)):
+        raise ValueError('The marginal probability store {} ({} x {}) does not match its index ({} nodes, {} states).'
+                         .format(store_path, *mps.shape, len(nodes), len(states)))
+    return nodes, states, mps
+
+
+def _read_tab(mp_path):
+    df = memo.read_csv(mp_path, sep='\t', index_col=0)
+    return df.index.to_numpy(dtype=str), df.columns.to_numpy(dtype=str), df.to_numpy(dtype=np.float64)
+
+
+def read_mps(mp_path):
+    """
+    Reads the marginal probabilities, either from a PastML marginal probability table, or from a binary store
+    (if the path ends with .npy, see write_store), whose matrix is memory-mapped.
+
+    :return: tuple (nodes, states, mps), where mps is a node x state (read-only for a store) array
+    """
+    if mp_path.endswith(STORE_SUFFIX):
+        return memo.get(mp_path, '_read_store', lambda: _read_store(mp_path))
+    return memo.get(mp_path, '_read_tab', lambda: _read_tab(mp_path))
+
+
+def align_mps(tree, nodes, mps):
+    """
+    Aligns the marginal probabilities with the tree nodes.
+    If they are already in the tree node order (e.g. in a store converted with the tree), no copy is made.
+
+    :return: node x state array, whose rows correspond to the tree nodes
+    """
+    if len(nodes) == tree.n_nodes and np.array_equal(nodes, tree.names.astype(str)):
+        return mps
+    import pandas as pd
+
+    indices = pd.Index(nodes).get_indexer(tree.names)
+    if np.any(indices < 0):
+        raise KeyError('Nodes {} are missing from the marginal probability table.'
+                       .format(', '.join(tree.names[indices < 0][:5])))
+    return np.asarray(mps, dtype=np.float64)[indices]
+
+
+def main(argv=None):
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
+                        filename=None)
+
+    parser = argparse.ArgumentParser(description="Converts PastML marginal probability tables into binary stores, "
+                                                 "with the rows in the node order of the corresponding trees.")
+    parser.add_argument('--mps', required=True, type=str, nargs='+', help="the PastML marginal probability files.")
+    parser.add_argument('--trees', required=False, type=str, nargs='*', default=None,
+                        help="(optional) the trees (in the same order as the marginal probability files), "
+                             "to store the rows in their node order.")
+    parser.add_argument('--output', required=True, type=str, nargs='+',
+                        help="output store(s) (.npy, with an .index.npz next to it), one per marginal probability file.")
+    parser.add_argument('--float32', action='store_true', default=False,
+                        help="store the probabilities in single precision.")
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('mp_store', params.instrument)
+
+    if len(params.output) != len(params.mps) or params.trees and len(params.trees) != len(params.mps):
+        raise ValueError('Expected as many outputs (and trees, if given) as marginal probability files ({}).'
+                         .format(len(params.mps)))
+    if any(not _.endswith(STORE_SUFFIX) for _ in params.output):
+        raise ValueError('The output stores should have the {} extension.'.format(STORE_SUFFIX))
+
+    from tree_io import read_tree
+
+    for i, (mp_path, store_path) in enumerate(zip(params.mps, params.output)):
+        with instrument.phase('parse'):
+            nodes, states, mps = _read_tab(mp_path)
+            tree = read_tree(params.trees[i]) if params.trees else None
+        instrument.count(nodes=len(nodes), states=len(states))
+        if tree is not None:
+            with instrument.phase('compute'):
+                mps = align_mps(tree, nodes, mps)
+                nodes = tree.names
+        with instrument.phase('write'):
+            write_store(store_path, nodes, states, mps, dtype=np.float32 if params.float32 else np.float64)
+        logging.info('Converted {} into {}.'.format(mp_path, store_path))
+
+
+if '__main__' == __name__:
+    main()
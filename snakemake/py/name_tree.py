@@ -1,15 +1,30 @@
-from pastml.tree import name_tree, DATE, DATE_CI, read_forest
+import instrument
+from array_tree import ArrayTree, DATE
+from tree_io import DATE_CI, write_newick
 
-if '__main__' == __name__:
+
+def main(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--input_tree', required=True, type=str)
     parser.add_argument('--output_tree', required=True, type=str)
-    params = parser.parse_args()
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('name_tree', params.instrument)
+
+    from pastml.tree import name_tree, read_forest
 
-    tr = read_forest(params.input_tree)[0]
-    name_tree(tr)
+    with instrument.phase('parse'):
+        tr = read_forest(params.input_tree)[0]
+    with instrument.phase('annotate'):
+        name_tree(tr)
 
-    tr.write(outfile=params.output_tree, format_root_node=True, format=3, features=[DATE, DATE_CI])
+    with instrument.phase('write'):
+        write_newick(ArrayTree.from_ete3(tr, features=[DATE_CI]), params.output_tree, format=3,
+                     features=[DATE, DATE_CI])
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,127 @@
+import logging
+import multiprocessing
+import os
+
+import instrument
+
+# the tree and annotations loaded once in the parent process, and inherited by the forked workers
+_roots, _column2states, _age_label, _resolve_polytomies = None, None, None, False
+
+
+def write_named_tree(roots, path, features):
+    """Writes the named tree (and its nexus version) as pastml (1.9.30) pastml_pipeline does."""
+    from io import StringIO
+
+    from Bio.Phylo import NewickIO, write
+
+    nwks = [root.write(format_root_node=True, format=3, features=features) for root in roots]
+    with open(path, 'w+') as f:
+        f.write('\n'.join(nwks))
+    try:
+        nexus = path.replace('.nwk', '.nexus')
+        if '.nexus' not in nexus:
+            nexus = '{}.nexus'.format(nexus)
+        write(NewickIO.parse(StringIO('\n'.join(nwks))), nexus, 'nexus')
+        with open(nexus, 'r') as f:
+            nexus_str = f.read().replace('&&NHX:', '&')
+            for feature in features:
+                nexus_str = nexus_str.replace(':{}='.format(feature), ',{}='.format(feature))
+        with open(nexus, 'w') as f:
+            f.write(nexus_str)
+    except Exception as e:
+        logging.error('Did not manage to save the annotated tree in nexus format due to the following error: {}'
+                      .format(e))
+
+
+def _reconstruct(args):
+    """
+    Reconstructs one character with MPPA/F81 on the inherited tree, and saves the pastml outputs into its work dir.
+    Is run in a fresh worker for each character, as the reconstruction modifies the tree (e.g. resolves polytomies).
+    """
+    column, work_dir, tree_path = args
+    from pastml import CHARACTER
+    # F81 moved from pastml.models.f81_like (pastml 1.9.30) to pastml.models.F81Model, but pastml.acr has it in both
+    from pastml.acr import F81, acr, _serialize_acr, _serialize_predicted_states
+    from pastml.file import get_combined_ancestral_state_file, get_named_tree_file
+    from pastml.ml import MPPA
+    from pastml.tree import DATE, DATE_CI
+    from pastml.visualisation.cytoscape_manager import DATE_LABEL
+
+    os.makedirs(work_dir, exist_ok=True)
+    acr_results = acr(forest=_roots, columns=[column], column2states={column: _column2states[column]},
+                      prediction_method=MPPA, model=F81, force_joint=False, threads=1, tau=0,
+                      resolve_polytomies=_resolve_polytomies)
+    columns = sorted({_[CHARACTER] for _ in acr_results})
+    _serialize_predicted_states(columns, os.path.join(work_dir, get_combined_ancestral_state_file()), _roots,
+                                dates_are_dates=_age_label == DATE_LABEL)
+    write_named_tree(_roots, os.path.join(work_dir, get_named_tree_file(tree_path)), [DATE, DATE_CI] + columns)
+    for acr_result in acr_results:
+        _serialize_acr((acr_result, work_dir))
+    return column, work_dir
+
+
+def reconstruct(tree_path, data, columns, work_dirs, resolve_polytomies=False, threads=1):
+    """
+    Reconstructs the ancestral states of several characters with MPPA/F81, as separate pastml runs would do
+    (one per character), but parsing the tree and the annotations only once.
+    Each character is reconstructed in a worker process forked from the loaded tree, up to threads at a time.
+
+    :param columns: annotation columns (characters) to reconstruct
+    :param work_dirs: pastml work dirs, one per column
+    """
+    global _roots, _column2states, _age_label, _resolve_polytomies
+    from pastml import col_name2cat
+    from pastml.acr import _validate_input
+
+    with instrument.phase('parse'):
+        _roots, _, _column2states, _, _age_label, _, _ = \
+            _validate_input(tree_path, columns, data=data, data_sep='\t', id_index=0)
+    _resolve_polytomies = resolve_polytomies
+    instrument.count(tips=sum(len(_) for _ in _roots), columns=len(columns))
+
+    tasks = [(col_name2cat(column), work_dir, tree_path) for column, work_dir in zip(columns, work_dirs)]
+    with instrument.phase('compute'):
+        with multiprocessing.get_context('fork').Pool(processes=max(1, min(threads, len(tasks))),
+                                                      maxtasksperchild=1) as pool:
+            for column, work_dir in pool.imap_unordered(_reconstruct, tasks):
+                logging.info('Reconstructed {} into {}.'.format(column, work_dir))
+    _roots, _column2states = None, None
+
+
+def main(argv=None):
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
+                        filename=None)
+
+    parser = argparse.ArgumentParser(description="Runs PastML (MPPA, F81) for several columns on one tree, "
+                                                 "loading the tree and the annotations once.")
+    parser.add_argument('--tree', required=True, type=str)
+    parser.add_argument('--data', required=True, type=str, help="the annotation table (tab-separated).")
+    parser.add_argument('--columns', required=True, type=str, nargs='+')
+    parser.add_argument('--work_dir', required=True, type=str, nargs='+',
+                        help="pastml work dir(s): one per column, "
+                             "or a template with {} to be replaced by the column (e.g. acr/pastml/{}/tree).")
+    parser.add_argument('--resolve_polytomies', action='store_true', default=False)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help="print pastml progress.")
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('pastml_columns', params.instrument)
+
+    if len(params.work_dir) == len(params.columns):
+        work_dirs = params.work_dir
+    elif 1 == len(params.work_dir) and '{}' in params.work_dir[0]:
+        work_dirs = [params.work_dir[0].format(_) for _ in params.columns]
+    else:
+        raise ValueError('Expected either {} work dirs or one work dir template containing {{}}.'
+                         .format(len(params.columns)))
+
+    from pastml.acr import _set_up_pastml_logger
+
+    _set_up_pastml_logger(params.verbose)
+    reconstruct(params.tree, params.data, params.columns, work_dirs, params.resolve_polytomies, params.threads)
+
+
+if '__main__' == __name__:
+    main()
@@ -1,20 +1,190 @@
+import logging
+
+import numpy as np
 import pandas as pd
 
+import instrument
 
-if '__main__' == __name__:
+CHUNK_SIZE = 10000
+N_BOOTSTRAP = 1000
+CONFIDENCE = .95
+# the maximal number of bootstrap values to be drawn at once
+BATCH_SIZE = 1 << 22
+
+ALL = 'all'
+RESISTANT = 'resistant'
+
+
+def get_drm_columns(columns):
+    return [col for col in columns if 'RT:' in col or 'PR:' in col or 'IN:' in col]
+
+
+class GroupCounts(object):
+    """Running counts of the sequences and of the resistant ones (per DRM) in each group."""
+
+    def __init__(self, n_drms):
+        self.n_drms = n_drms
+        self.group2index = {}
+        self.sequences = []
+        self.resistant = []
+
+    def update(self, groups, is_resistant):
+        """
+        :param groups: array of the group values of the rows
+        :param is_resistant: boolean matrix row x DRM
+        """
+        codes, values = pd.factorize(groups, sort=True)
+        if not len(values):
+            return
+        order = np.argsort(codes, kind='stable')
+        starts = np.searchsorted(codes[order], np.arange(len(values)))
+        sizes = np.diff(np.append(starts, len(codes)))
+        counts = np.add.reduceat(is_resistant[order].astype(np.int64), starts, axis=0) \
+            if len(order) else np.zeros((0, self.n_drms), dtype=np.int64)
+        for value, size, count in zip(values, sizes, counts):
+            i = self.group2index.setdefault(value, len(self.group2index))
+            if i == len(self.sequences):
+                self.sequences.append(0)
+                self.resistant.append(np.zeros(self.n_drms, dtype=np.int64))
+            self.sequences[i] += int(size)
+            self.resistant[i] += count
+
+    def get_counts(self):
+        """:return: tuple (groups, sequences, resistant): the sorted groups, their sizes and resistant counts"""
+        groups = sorted(self.group2index)
+        indices = [self.group2index[_] for _ in groups]
+        return groups, np.array([self.sequences[_] for _ in indices], dtype=np.int64), \
+            np.array([self.resistant[_] for _ in indices], dtype=np.int64).reshape(len(groups), self.n_drms)
+
+
+def count_resistant(input_tab, subtype=None, subtype_col=None, group_cols=(), chunk_size=CHUNK_SIZE):
+    """
+    Counts the sequences and the resistant ones for each DRM in one pass over the table, reading it by chunks of rows:
+    over the sequences of the given subtype (or all of them), and in the groups of each group column (over all the
+    sequences, the rows with an empty group value are skipped).
+
+    :return: tuple (drms, selected, counters), where selected are the GroupCounts of the selected sequences
+        (with one group: the subtype, or all if no subtype is given), and counters maps the group columns
+        to their GroupCounts
+    """
+    columns = pd.read_csv(input_tab, sep='\t', index_col=0, nrows=0).columns
+    drms = get_drm_columns(columns)
+    group_cols = list(dict.fromkeys(group_cols))
+    for col in ([subtype_col] if subtype else []) + list(group_cols):
+        if col not in columns:
+            raise ValueError('Column {} is not found in {}.'.format(col, input_tab))
+
+    selected, counters = GroupCounts(len(drms)), {_: GroupCounts(len(drms)) for _ in group_cols}
+    usecols = list(dict.fromkeys(drms + ([subtype_col] if subtype else []) + group_cols))
+    reader = pd.read_csv(input_tab, sep='\t', usecols=usecols, dtype=str, chunksize=chunk_size)
+    while True:
+        with instrument.phase('parse'):
+            chunk = next(reader, None)
+        if chunk is None:
+            break
+        with instrument.phase('compute'):
+            is_resistant = chunk[drms].to_numpy() == RESISTANT
+            is_selected = (chunk[subtype_col] == subtype).to_numpy() if subtype else np.ones(len(chunk), dtype=bool)
+            selected.update(np.full(np.count_nonzero(is_selected), subtype if subtype else ALL, dtype=object),
+                            is_resistant[is_selected])
+            for col in group_cols:
+                groups = chunk[col].to_numpy()
+                is_grouped = ~pd.isna(groups)
+                counters[col].update(groups[is_grouped], is_resistant[is_grouped])
+        instrument.count(rows=len(chunk))
+    return drms, selected, counters
+
+
+def bootstrap_ci(sequences, resistant, n_bootstrap=N_BOOTSTRAP, confidence=CONFIDENCE, rng=None,
+                 batch_size=BATCH_SIZE):
+    """
+    Estimates the percentile bootstrap confidence intervals of the prevalences.
+    Resampling the n sequences of a group with replacement makes the number of resistant ones for a DRM
+    Binomial(n, k / n) distributed (where k is the observed number), so the bootstrap replicates are drawn
+    for many groups and DRMs at once, by batches of groups.
+
+    :param sequences: array of group sizes
+    :param resistant: matrix group x DRM of resistant counts
+    :return: tuple (low, high) of matrices group x DRM (NaN for empty groups)
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    n_groups, n_drms = resistant.shape
+    low, high = np.full((n_groups, n_drms), np.nan), np.full((n_groups, n_drms), np.nan)
+    groups = np.flatnonzero(sequences > 0)
+    step = max(1, batch_size // max(1, n_bootstrap * n_drms))
+    for start in range(0, len(groups), step):
+        batch = groups[start: start + step]
+        n = sequences[batch][:, np.newaxis]
+        replicates = rng.binomial(n, resistant[batch] / n, size=(n_bootstrap, len(batch), n_drms)) / n
+        low[batch], high[batch] = np.quantile(replicates, [(1 - confidence) / 2, (1 + confidence) / 2], axis=0)
+    return low, high
+
+
+def main(argv=None):
     import argparse
 
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
+                        filename=None)
+
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--input', required=True, type=str)
     parser.add_argument('--output', required=True, type=str)
     parser.add_argument('--subtype', required=False, type=str, default=None)
     parser.add_argument('--subtype_col', default='Sierra subtype', type=str)
-    params = parser.parse_args()
-
-    df = pd.read_csv(params.input, sep='\t', index_col=0)
-    if params.subtype and params.subtype_col:
-        df = df[df[params.subtype_col] == params.subtype]
-    columns = [col for col in df.columns if 'RT:' in col or 'PR:' in col or 'IN:' in col]
-    df = df[columns]
-    ((df == 'resistant').astype(int).sum().sort_values() / len(df)).to_csv(params.output, header=False, index=True, sep='\t')
+    parser.add_argument('--group_by', required=False, type=str, nargs='*', default=[],
+                        help="column(s) (e.g. Sierra subtype, urbanrural, year) to calculate the prevalence in each "
+                             "of their groups (over all the sequences, whatever the --subtype), "
+                             "saved to --output_tab.")
+    parser.add_argument('--output_tab', required=False, type=str, default=None,
+                        help="(optional) table of the prevalence of each DRM, with its bootstrap confidence interval, "
+                             "over the selected sequences (see --subtype) and in each group (see --group_by).")
+    parser.add_argument('--bootstrap', required=False, type=int, default=N_BOOTSTRAP,
+                        help="number of bootstrap replicates for the confidence intervals in --output_tab.")
+    parser.add_argument('--confidence', required=False, type=float, default=CONFIDENCE)
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for the bootstrap.')
+    parser.add_argument('--chunk_size', type=int, default=CHUNK_SIZE, help='number of rows to read at once.')
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('prevalence', params.instrument)
+
+    drms, selected, counters = count_resistant(params.input, params.subtype, params.subtype_col, params.group_by,
+                                               params.chunk_size)
+    instrument.count(columns=len(drms), groups=sum(len(_.group2index) for _ in counters.values()))
+
+    _, sequences, resistant = selected.get_counts()
+    n = int(sequences.sum())
+    with instrument.phase('compute'):
+        counts = pd.Series(resistant.sum(axis=0), index=drms, dtype=np.int64)
+        prevalence = counts.sort_values() / n
+    with instrument.phase('write'):
+        prevalence.to_csv(params.output, header=False, index=True, sep='\t')
+
+    if params.output_tab:
+        seed_sequence = np.random.SeedSequence(params.seed)
+        logging.info('Bootstrapping the prevalence {} times with seed {}.'.format(params.bootstrap,
+                                                                                 seed_sequence.entropy))
+        rng = np.random.default_rng(seed_sequence)
+        dfs = []
+        groupings = list(counters.items())
+        # the selected subtype is already among the groups of its column if the prevalence is grouped by it
+        if not params.subtype or params.subtype_col not in counters:
+            groupings.insert(0, (params.subtype_col if params.subtype else ALL, selected))
+        for grouping, counter in groupings:
+            groups, sequences, resistant = counter.get_counts()
+            with instrument.phase('compute'):
+                low, high = bootstrap_ci(sequences, resistant, params.bootstrap, params.confidence, rng=rng) \
+                    if params.bootstrap > 0 else (np.full(resistant.shape, np.nan), np.full(resistant.shape, np.nan))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                group_prevalence = resistant / sequences[:, np.newaxis]
+            dfs.append(pd.DataFrame({'grouping': grouping, 'group': np.repeat(groups, len(drms)),
+                                     'DRM': np.tile(drms, len(groups)),
+                                     'sequences': np.repeat(sequences, len(drms)), 'resistant': resistant.ravel(),
+                                     'prevalence': group_prevalence.ravel(),
+                                     'ci_low': low.ravel(), 'ci_high': high.ravel()}))
+        with instrument.phase('write'):
+            pd.concat(dfs).to_csv(params.output_tab, sep='\t', index=False)
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,218 @@
+import logging
+import multiprocessing
+
+import numpy as np
+
+N_DRAWS = 10000
+# draws per shard: each shard has its own random stream, so the result does not depend on the number of processes
+SHARD_SIZE = 500
+# max number of draw x branch items processed at once
+BATCH_ITEMS = 1 << 22
+N_ITERATIONS = 500
+TOLERANCE = 1e-6
+CREDIBILITY = 0.95
+
+# the sampler set up in the parent process, and inherited by the forked workers
+_sampler = None
+
+
+def read_f81_params(params_path, states):
+    """
+    Reads the F81 model parameters from a PastML parameter file.
+
+    :param states: the states, in the order of the marginal probability columns
+    :return: tuple (frequencies, scaling_factor, smoothing_factor), where frequencies is an array in the state order
+    """
+    values = {}
+    with open(params_path, 'r') as f:
+        next(f)
+        for line in f:
+            key, _, value = line.rstrip('\n').partition('\t')
+            values[key] = value
+    if values.get('model', 'F81') != 'F81':
+        raise ValueError('Expected the F81 model parameters in {}, got {}.'.format(params_path, values['model']))
+    missing = [_ for _ in states if _ not in values]
+    if missing:
+        raise KeyError('State frequencies {} are missing from {}.'.format(', '.join(missing), params_path))
+    frequencies = np.array([float(values[_]) for _ in states])
+    return frequencies / frequencies.sum(), float(values['scaling_factor']), \
+        float(values.get('smoothing_factor', 0) or 0)
+
+
+def get_transition_matrices(tree, frequencies, scaling_factor, smoothing_factor=0):
+    """
+    Calculates the F81 transition probability matrices P(t) of the tree branches,
+    with the branch lengths transformed as PastML does.
+
+    :return: node x state x state array, where [c, i, j] is the probability to go from state i at c's parent
+        to state j at c
+    """
+    dists = tree.dists
+    if smoothing_factor:
+        dists = (dists + smoothing_factor) * dists.sum() / (dists.sum() + smoothing_factor * (tree.n_nodes - 1))
+    mu = 1 / (1 - np.power(frequencies, 2).sum())
+    exp_mu_t = np.exp(-mu * dists * scaling_factor)[:, np.newaxis, np.newaxis]
+    return (1 - exp_mu_t) * frequencies + exp_mu_t * np.eye(len(frequencies))
+
+
+def get_conditionals(tree, mps, transitions, n_iterations=N_ITERATIONS, tolerance=TOLERANCE):
+    """
+    Calculates the probabilities of each node's states given its parent's state:
+    Q[c, i, j] = P[c, i, j] L[c, j] / sum_k P[c, i, k] L[c, k], where L[c] is the likelihood of c's subtree.
+    The (unknown) subtree likelihoods are recovered from the marginal probabilities, which satisfy
+    mps[c] = mps[parent(c)] Q[c], by iterative proportional fitting of L[c] (for all the nodes at once).
+    The top-down draws from Q therefore reproduce the marginal probabilities.
+
+    :param mps: node x state array of marginal probabilities
+    :param transitions: node x state x state array of branch transition probabilities
+    :return: node x state x state array of conditional probabilities (the root rows contain its marginal)
+    """
+    mps = np.asarray(mps, dtype=np.float64)
+    parent_mps, child_mps, transitions = mps[tree.parents[1:]], mps[1:], transitions[1:]
+    likelihoods = child_mps.copy()
+    for i in range(n_iterations):
+        weights = transitions * likelihoods[:, np.newaxis, :]
+        totals = weights.sum(axis=2, keepdims=True)
+        conditionals = np.divide(weights, totals, out=np.zeros_like(weights), where=totals > 0)
+        fitted_mps = np.einsum('ni,nij->nj', parent_mps, conditionals)
+        error = np.abs(fitted_mps - child_mps).max() if len(child_mps) else 0
+        if error < tolerance:
+            break
+        likelihoods *= np.divide(child_mps, fitted_mps, out=np.zeros_like(child_mps), where=fitted_mps > 0)
+        likelihoods /= likelihoods.max(axis=1, keepdims=True)
+    else:
+        logging.warning('The conditional state probabilities did not converge in {} iterations '
+                        '(max marginal probability error {:g}).'.format(n_iterations, error))
+    # parent states that are impossible given the child's subtree (e.g. at zero branches): fall back to the marginal
+    impossible = totals[:, :, 0] <= 0
+    conditionals[impossible] = np.repeat(child_mps, impossible.sum(axis=1), axis=0)
+    root_conditionals = np.repeat(mps[:1, np.newaxis, :], mps.shape[1], axis=1)
+    return np.concatenate([root_conditionals, conditionals])
+
+
+class HistorySampler(object):
+    """
+    Draws joint state histories top-down (the root from its marginal, then each level of the tree given the states
+    of the previous one), and counts from->to transmissions along the branches in each draw.
+    """
+
+    def __init__(self, tree, conditionals, parent_ids, child_ids, item_edges=None, item_windows=None, n_windows=0):
+        """
+        :param conditionals: node x state x state array of conditional probabilities (see get_conditionals)
+        :param parent_ids: array of branch parent node indices (the branches to count transmissions on)
+        :param child_ids: array of branch child node indices
+        :param item_edges: (optional) array of branch indices, for the branches to be counted per time window
+        :param item_windows: (optional) array of (0-based) window indices of the item branches
+        :param n_windows: number of time windows
+        """
+        self.n_states = conditionals.shape[1]
+        self.parents = tree.parents
+        cumulative = np.cumsum(conditionals, axis=2)
+        cumulative[:, :, -1] = 1
+        self.cumulative = cumulative[:, :, :-1].astype(np.float32)
+        depths = tree.depths()
+        order = np.argsort(depths, kind='stable')
+        self.levels = np.split(order, np.flatnonzero(np.diff(depths[order])) + 1)[1:]
+
+        # branches sorted by parent, to find the first same-state child of each parent
+        order = np.argsort(parent_ids, kind='stable')
+        self.parent_ids, self.child_ids = parent_ids[order], child_ids[order]
+        starts = np.flatnonzero(np.r_[True, self.parent_ids[1:] != self.parent_ids[:-1]]) \
+            if len(order) else np.zeros(0, dtype=int)
+        self.group_starts = np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+        self.n_windows = n_windows
+        if item_edges is None:
+            item_edges, item_windows = np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        self.item_edges = np.argsort(order)[item_edges]
+        self.item_windows = np.asarray(item_windows)
+
+    def sample_states(self, n_draws, rng):
+        """:return: draw x node array of sampled state indices"""
+        states = np.zeros((n_draws, len(self.parents)), dtype=np.int8)
+        states[:, :1] = self._draw(self.cumulative[:1, 0][np.newaxis], rng.random((n_draws, 1), dtype=np.float32))
+        for nodes in self.levels:
+            thresholds = self.cumulative[nodes, states[:, self.parents[nodes]]]
+            states[:, nodes] = self._draw(thresholds, rng.random((n_draws, len(nodes)), dtype=np.float32))
+        return states
+
+    @staticmethod
+    def _draw(thresholds, uniforms):
+        """Picks the state whose cumulative probability interval contains the uniform, for each uniform."""
+        states = np.zeros(uniforms.shape, dtype=np.int8)
+        for k in range(thresholds.shape[-1]):
+            states += uniforms > thresholds[..., k]
+        return states
+
+    def count(self, states):
+        """
+        Counts the from->to transmissions in each draw. As in the expected counts, one of the children
+        in the parent's state is the parent lineage itself rather than a transmission, and is not counted.
+
+        :param states: draw x node array of sampled state indices
+        :return: tuple (counts, window_counts) of draw x state x state and draw x window x state x state arrays
+        """
+        n_draws, n, s2 = len(states), self.n_states, self.n_states * self.n_states
+        parent_states, child_states = states[:, self.parent_ids], states[:, self.child_ids]
+        same = parent_states == child_states
+        n_same = np.cumsum(same, axis=1, dtype=np.int32)
+        n_same_before = np.where(self.group_starts > 0, n_same[:, self.group_starts - 1], 0)
+        counted = ~(same & (n_same - n_same_before == 1))
+        pairs = parent_states.astype(np.int64) * n + child_states
+
+        offsets = np.arange(n_draws)[:, np.newaxis] * s2
+        counts = np.bincount((offsets + pairs)[counted], minlength=n_draws * s2).reshape(n_draws, n, n)
+        offsets = np.arange(n_draws)[:, np.newaxis] * (self.n_windows * s2)
+        window_pairs = offsets + self.item_windows * s2 + pairs[:, self.item_edges]
+        window_counts = np.bincount(window_pairs[counted[:, self.item_edges]],
+                                    minlength=n_draws * self.n_windows * s2).reshape(n_draws, self.n_windows, n, n)
+        return counts, window_counts
+
+    def sample(self, n_draws, seed=None):
+        """
+        Draws state histories (in batches) and counts their transmissions.
+
+        :return: tuple (counts, window_counts) of draw x state x state and draw x window x state x state arrays
+        """
+        rng = np.random.default_rng(seed)
+        batch_size = max(1, min(n_draws, BATCH_ITEMS // max(1, len(self.parents), len(self.item_edges))))
+        results = [self.count(self.sample_states(min(batch_size, n_draws - start), rng))
+                   for start in range(0, n_draws, batch_size)]
+        return tuple(np.concatenate(_) for _ in zip(*results)) if results else \
+            (np.zeros((0, self.n_states, self.n_states), dtype=np.int64),
+             np.zeros((0, self.n_windows, self.n_states, self.n_states), dtype=np.int64))
+
+
+def _sample_shard(args):
+    n_draws, seed = args
+    return _sampler.sample(n_draws, seed)
+
+
+def sample_transmissions(sampler, n_draws=N_DRAWS, seed=None, threads=1):
+    """
+    Draws state histories in shards of SHARD_SIZE draws, each with its own random stream (spawned from the seed),
+    optionally in a pool of worker processes forked from the sampler.
+
+    :return: tuple (counts, window_counts) of draw x state x state and draw x window x state x state arrays
+    """
+    global _sampler
+    sizes = [min(SHARD_SIZE, n_draws - start) for start in range(0, n_draws, SHARD_SIZE)]
+    tasks = list(zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes))))
+    if threads <= 1 or len(tasks) <= 1:
+        results = [sampler.sample(*task) for task in tasks]
+    else:
+        _sampler = sampler
+        with multiprocessing.get_context('fork').Pool(processes=min(threads, len(tasks))) as pool:
+            results = pool.map(_sample_shard, tasks)
+        _sampler = None
+    return tuple(np.concatenate(_) for _ in zip(*results)) if results else sampler.sample(0)
+
+
+def summarize(counts, credibility=CREDIBILITY):
+    """
+    :param counts: draw x ... array of sampled counts
+    :return: tuple (mean, ci_low, ci_high) of arrays of the shape of one draw,
+        where [ci_low, ci_high] is the equal-tailed credible interval
+    """
+    tail = (1 - credibility) / 2
+    ci_low, ci_high = np.quantile(counts, [tail, 1 - tail], axis=0)
+    return counts.mean(axis=0), ci_low, ci_high
@@ -1,8 +1,11 @@
-from collections import defaultdict
+import logging
+from multiprocessing import Pool
 
 import numpy as np
-import pandas as pd
-from pastml.tree import read_tree, remove_certain_leaves, annotate_dates, DATE, DATE_CI
+
+import instrument
+from array_tree import DATE, read_array_tree
+from tree_io import DATE_CI, write_newick
 
 EXT_COLOR = '#4daf4a'
 HIGH_COLOR = '#e41a1c'
@@ -12,78 +15,142 @@ state2colour = {'High': HIGH_COLOR, 'Low': LOW_COLOR, 'External': EXT_COLOR}
 column = 'highlow_prevalence'
 
 
-if '__main__' == __name__:
-    import argparse
+def get_strata(tree):
+    """
+    Groups the tips with a unique predicted state by (state, sampling year).
 
-    parser = argparse.ArgumentParser()
+    :return: tuple (states, strata, tips), where strata is a dict of parallel arrays
+        (state index, year, start, n) describing the (state, year) strata, sorted by state and year,
+        and tips is the array of tip indices, ordered by stratum: stratum k is tips[start[k]: start[k] + n[k]].
+    """
+    tips = tree.tips
+    tip_states = tree.features[column][tips]
+    is_resolved = np.array([len(_) == 1 for _ in tip_states], dtype=bool)
+    tips = tips[is_resolved]
+    states, state_ids = np.unique([next(iter(_)) for _ in tip_states[is_resolved]], return_inverse=True)
+    years = tree.dates[tips].astype(int)
+    order = np.lexsort((years, state_ids))
+    tips, state_ids, years = tips[order], state_ids[order], years[order]
+    starts = np.flatnonzero(np.r_[True, (state_ids[1:] != state_ids[:-1]) | (years[1:] != years[:-1])])
+    strata = {'state': state_ids[starts], 'year': years[starts], 'start': starts,
+              'n': np.diff(np.append(starts, len(tips)))}
+    return states, strata, tips
 
-    parser.add_argument('--tree', required=True, type=str,
-                        help='Input tree with tip annotated with states and dates')
-    parser.add_argument('--subtree', type=str, required=True)
-    params = parser.parse_args()
-
-    tree = read_tree(params.tree, columns=[column])
-    annotate_dates([tree])
-    state2tips = defaultdict(list)
-    state2year2tips = defaultdict(lambda: defaultdict(list))
-    tip2date = {}
-
-    min_year, max_year = np.inf, -np.inf
-    for tip in tree:
-        states = getattr(tip, column)
-        date = getattr(tip, DATE)
-        tip2date[tip.name] = date
-        if len(states) == 1:
-            state = next(iter(states))
-            state2tips[state].append(tip.name)
-            year = int(date)
-            if year < min_year:
-                min_year = year
-            if year > max_year:
-                max_year = year
-            state2year2tips[state][year].append(tip.name)
-    total = len(tree)
-
-    size = min(len(_) for _ in state2tips.values())
-    min_ac_year = min(min(state2year2tips[_].keys()) for _ in ['Low', 'High'])
 
-    print('Gonna subsample {} sequences of each state'.format(size))
-    print('Sampling in AC started in {}'.format(min_ac_year))
+def get_stratum_sizes(states, strata):
+    """
+    Calculates how many tips to sample from each (state, year) stratum, so that each state gets the same number of tips,
+    spread as evenly as possible over the years. For the external state the years starting from the first sampling year
+    of the other states are preferred.
 
-    subsampled_ids = set()
-    for state, year2tips in state2year2tips.items():
-        total_tips = len(state2tips[state])
-        df = pd.DataFrame(index=list(year2tips.keys()),
-                          data=[[len(v)] for v in year2tips.values()],
-                          columns=['n'])
-        df.sort_values(by=['n'], inplace=True, ascending=True)
-        left = size
+    :return: tuple (size, min_ac_year, stratum_sizes)
+    """
+    n_per_state = np.bincount(strata['state'], weights=strata['n'], minlength=len(states)).astype(int)
+    size = n_per_state.min()
+    min_ac_year = min(strata['year'][strata['state'] == i].min()
+                      for i, state in enumerate(states) if state in ('Low', 'High'))
 
+    stratum_sizes = np.zeros(len(strata['n']), dtype=int)
+    for state_id, state in enumerate(states):
+        strata_ids = np.flatnonzero(strata['state'] == state_id)
+        left = size
         if state == 'External':
-            sampled_not_before_ac = sum(df.loc[df.index >= min_ac_year, 'n'])
+            is_ac = strata['year'][strata_ids] >= min_ac_year
+            sampled_not_before_ac = strata['n'][strata_ids[is_ac]].sum()
             if sampled_not_before_ac >= size:
-                years = [y for y in df.index if y >= min_ac_year]
-                df = df.loc[years, :]
+                strata_ids = strata_ids[is_ac]
             else:
-                for y, tips in year2tips.items():
-                    if y >= min_ac_year:
-                        subsampled_ids |= set(tips)
-                years = [y for y in df.index if y < min_ac_year]
-                df = df.loc[years, :]
+                stratum_sizes[strata_ids[is_ac]] = strata['n'][strata_ids[is_ac]]
+                strata_ids = strata_ids[~is_ac]
                 left -= sampled_not_before_ac
 
         # if there are not enough sequences sampled (less than we want to keep),
         # we are going to take a bit more of other years to compensate for it
-        n = len(df)
-        for i, (year, row) in enumerate(df.iterrows()):
-            avail = row['n']
-            like_to_take = int(np.round(left / (n - i), 0))
-            can_take = min(like_to_take, avail)
-            if can_take:
-                left -= can_take
-                newly_added_tips = set(np.random.choice(year2tips[year], size=can_take, replace=False))
-                subsampled_ids |= newly_added_tips
-
-    tree = remove_certain_leaves(tree, lambda _: _.name not in subsampled_ids)
-    tree.dist = 0
-    tree.write(outfile=params.subtree, format=3, format_root_node=True, features=[DATE, DATE_CI])
\ No newline at end of file
+        strata_ids = strata_ids[np.argsort(strata['n'][strata_ids], kind='stable')]
+        n = len(strata_ids)
+        for i, stratum_id in enumerate(strata_ids):
+            can_take = min(int(np.round(left / (n - i), 0)), strata['n'][stratum_id])
+            left -= can_take
+            stratum_sizes[stratum_id] = can_take
+    return size, min_ac_year, stratum_sizes
+
+
+def subsample(strata, tips, stratum_sizes, rng):
+    """
+    Samples (without replacement) the given number of tips from each stratum at once,
+    by taking the tips with the smallest random keys within each stratum.
+
+    :return: sorted array of sampled tip indices
+    """
+    keys = rng.random(len(tips))
+    tip_strata = np.repeat(np.arange(len(strata['n'])), strata['n'])
+    order = np.lexsort((keys, tip_strata))
+    rank = np.arange(len(tips)) - strata['start'][tip_strata]
+    return np.sort(tips[order][rank < stratum_sizes[tip_strata]])
+
+
+_tree, _strata, _tips, _stratum_sizes = None, None, None, None
+
+
+def _init_worker(tree, strata, tips, stratum_sizes):
+    global _tree, _strata, _tips, _stratum_sizes
+    _tree, _strata, _tips, _stratum_sizes = tree, strata, tips, stratum_sizes
+
+
+def _write_subtree(args):
+    seed, subtree_path = args
+    subtree = _tree.prune(subsample(_strata, _tips, _stratum_sizes, np.random.default_rng(seed)))
+    subtree.dists[0] = 0
+    write_newick(subtree, subtree_path, format=3, features=[DATE, DATE_CI])
+    return subtree_path
+
+
+def main(argv=None):
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
+                        filename=None)
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--tree', required=True, type=str,
+                        help='Input tree with tip annotated with states and dates')
+    parser.add_argument('--subtree', type=str, required=True, nargs='+',
+                        help='Output subtree(s), one per replicate.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed, the replicate seeds are spawned from it.')
+    parser.add_argument('--threads', type=int, default=1)
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('subsampling', params.instrument)
+
+    with instrument.phase('parse'):
+        tree = read_array_tree(params.tree, columns=[column], features=[DATE_CI])
+    instrument.count(nodes=tree.n_nodes, tips=len(tree.tips), replicates=len(params.subtree))
+    with instrument.phase('annotate'):
+        tree.annotate_dates()
+    with instrument.phase('compute'):
+        states, strata, tips = get_strata(tree)
+        size, min_ac_year, stratum_sizes = get_stratum_sizes(states, strata)
+
+    print('Gonna subsample {} sequences of each state'.format(size))
+    print('Sampling in AC started in {}'.format(min_ac_year))
+
+    seed_sequence = np.random.SeedSequence(params.seed)
+    logging.info('Subsampling {} replicates with seed {}.'.format(len(params.subtree), seed_sequence.entropy))
+    tasks = list(zip(seed_sequence.spawn(len(params.subtree)), params.subtree))
+    initargs = (tree, strata, tips, stratum_sizes)
+    # the replicates are subsampled and written in one go (possibly in parallel)
+    with instrument.phase('write'):
+        if params.threads > 1 and len(tasks) > 1:
+            with Pool(processes=min(params.threads, len(tasks)), initializer=_init_worker, initargs=initargs) as pool:
+                for subtree_path in pool.imap_unordered(_write_subtree, tasks):
+                    logging.info('Saved {}.'.format(subtree_path))
+        else:
+            _init_worker(*initargs)
+            for subtree_path in map(_write_subtree, tasks):
+                logging.info('Saved {}.'.format(subtree_path))
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,326 @@
+import hashlib
+import logging
+import os
+import re
+
+import numpy as np
+
+import memo
+from array_tree import ArrayTree, DATE
+
+DATE_CI = 'date_CI'
+
+# bump it when the parsing changes, to invalidate the cached trees
+PARSER_VERSION = '1'
+CACHE_DIR_ENV = 'TREE_CACHE_DIR'
+
+CHUNK_SIZE = 1 << 20
+
+TOKEN_REGEX = re.compile(r"\[[^\]]*\]|'[^']*'|[(),;]|:[^(),:;\[\s]*|[^(),:;\[\]'\s]+")
+NUMBER_REGEX = re.compile(r'[+-]?\d+(?:\.\d*)?(?:[eE][+-]?\d+)?')
+COMMENT_REGEX = re.compile(r'([A-Za-z_][\w.]*)=("[^"]*"|{[^}]*}|[^,:\]]*)')
+NEXUS_TREE_REGEX = re.compile(r'^\s*tree\s+[^=]+=\s*(.*?;)[ \t]*$', re.IGNORECASE | re.MULTILINE | re.DOTALL)
+NEXUS_TRANSLATE_REGEX = re.compile(r'translate\s+(.*?);', re.IGNORECASE | re.DOTALL)
+# the characters ete3 replaces with _ in the names and the feature values it writes
+ILLEGAL_NEWICK_REGEX = re.compile(r'[:;(),\[\]\t\n\r=]')
+NEWICK_FORMATS = (1, 3)
+WRITE_CHUNK_NODES = 1 << 16
+
+
+class _TreeBuilder(object):
+    """Builds ArrayTrees from newick tokens, numbering the nodes in preorder."""
+
+    def __init__(self, translation=None):
+        self.trees = []
+        self.translation = translation
+        self._reset()
+
+    def _reset(self):
+        self.parents, self.dists, self.names, self.dates, self.ends = [], [], [], [], []
+        self.features = {}
+        self.stack = []
+        self.current = None
+        self.expect_node = True
+
+    def _add_node(self):
+        i = len(self.parents)
+        self.parents.append(self.stack[-1] if self.stack else -1)
+        self.dists.append(1. if self.stack else 0.)
+        self.names.append('')
+        self.dates.append(np.nan)
+        self.ends.append(i + 1)
+        self.current = i
+        self.expect_node = False
+        return i
+
+    def _add_comment(self, comment):
+        i = self.current
+        for key, value in COMMENT_REGEX.findall(comment):
+            value = value.strip('"')
+            if DATE == key:
+                try:
+                    self.dates[i] = float(value)
+                except ValueError:
+                    pass
+            else:
+                if 'CI_date' == key:
+                    # LSD2 CIs look like {1990.1,1992.3}, "1990.1 1992.3" or "1991(1990.1,1992.3)"
+                    key, value = DATE_CI, '|'.join(NUMBER_REGEX.findall(value)[-2:])
+                self.features.setdefault(key, {})[i] = value
+
+    def add(self, token):
+        first = token[0]
+        if '(' == first:
+            self.stack.append(self._add_node())
+            self.expect_node = True
+        elif ',' == first:
+            if self.expect_node:
+                self._add_node()
+            self.expect_node = True
+        elif ')' == first:
+            if self.expect_node:
+                self._add_node()
+            self.current = self.stack.pop()
+            self.ends[self.current] = len(self.parents)
+            self.expect_node = False
+        elif ';' == first:
+            if self.parents:
+                self.trees.append(self.build())
+            self._reset()
+        elif '[' == first:
+            # comments before a node (e.g. [&R] for rooted trees) are ignored
+            if not self.expect_node:
+                self._add_comment(token[1:-1])
+        elif ':' == first:
+            if self.expect_node:
+                self._add_node()
+            length = token[1:]
+            if length:
+                self.dists[self.current] = float(length)
+        else:
+            if self.expect_node:
+                self._add_node()
+            self.names[self.current] = token[1:-1] if "'" == first else token
+
+    def build(self):
+        n = len(self.parents)
+        if self.translation:
+            self.names = [self.translation.get(_, _) for _ in self.names]
+        features = {}
+        for feature, i2value in self.features.items():
+            values = np.full(n, None, dtype=object)
+            values[list(i2value.keys())] = list(i2value.values())
+            features[feature] = values
+        return ArrayTree(self.parents, self.dists, self.names, self.dates, features, self.ends)
+
+
+def _read_chunks(f, chunk_size=CHUNK_SIZE):
+    """Reads a newick file by chunks, each cut after a structural character outside of comments."""
+    rest = ''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            if rest:
+                yield rest
+            return
+        text = rest + chunk
+        cut = max(text.rfind(_) for _ in '(),;')
+        comment_start = text.rfind('[', 0, cut)
+        if comment_start > text.rfind(']', 0, cut):
+            cut = max(text.rfind(_, 0, comment_start) for _ in '(),;')
+        if cut >= 0:
+            yield text[: cut + 1]
+        rest = text[cut + 1:]
+
+
+def parse_newick(nwk_path):
+    """
+    Parses all the trees in a newick file in one pass, reading it by chunks.
+    All the node labels are considered to be names (i.e. as ete3 format 1/3),
+    and the comments (e.g. [&&NHX:date=1990.3:date_CI=1989.5|1991.2] or [&date=1990.3]) are parsed into features.
+
+    :return: list of ArrayTrees
+    """
+    builder = _TreeBuilder()
+    with open(nwk_path, 'r') as f:
+        for text in _read_chunks(f):
+            for token in TOKEN_REGEX.findall(text):
+                builder.add(token)
+    if builder.parents:
+        builder.trees.append(builder.build())
+    return builder.trees
+
+
+def parse_nexus(nexus):
+    """
+    Parses all the trees in a nexus string (with an optional translate table).
+
+    :return: list of ArrayTrees
+    """
+    translation = {}
+    translate = NEXUS_TRANSLATE_REGEX.search(nexus)
+    if translate:
+        for pair in translate.group(1).split(','):
+            pair = pair.strip().split(None, 1)
+            if len(pair) == 2:
+                translation[pair[0]] = pair[1].strip("'")
+    builder = _TreeBuilder(translation)
+    for nwk in NEXUS_TREE_REGEX.findall(nexus):
+        for token in TOKEN_REGEX.findall(nwk):
+            builder.add(token)
+    return builder.trees
+
+
+def get_cache_path(tree_path, cache_dir=None, extra_paths=(), key=PARSER_VERSION):
+    """
+    Returns the path of the binary cache file for the given tree file, keyed by its content hash.
+
+    :param extra_paths: other files whose contents the cached data depends on
+    :param key: a string identifying the cached data (and its version)
+    """
+    h = hashlib.sha1(key.encode())
+    for path in (tree_path,) + tuple(extra_paths):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                h.update(chunk)
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV, os.path.join(os.path.dirname(os.path.abspath(tree_path)),
+                                                               '.tree_cache'))
+    return os.path.join(cache_dir, '{}.npz'.format(h.hexdigest()))
+
+
+def _load_forest(tree_path, use_cache=True):
+    cache_path = get_cache_path(tree_path) if use_cache else None
+    if cache_path and os.path.exists(cache_path):
+        with np.load(cache_path) as npz:
+            forest = [ArrayTree.from_arrays(npz, prefix='{}.'.format(i)) for i in range(int(npz['n_trees']))]
+        logging.debug('Loaded the cached tree{} {}.'.format('s' if len(forest) > 1 else '', tree_path))
+    else:
+        with open(tree_path, 'r') as f:
+            is_nexus = f.read(6).upper() == '#NEXUS'
+        if is_nexus:
+            with open(tree_path, 'r') as f:
+                forest = parse_nexus(f.read())
+        else:
+            forest = parse_newick(tree_path)
+        if not forest:
+            raise ValueError('Could not find any trees (in newick or nexus format) in the file {}.'.format(tree_path))
+        if cache_path:
+            arrays = {'n_trees': np.array(len(forest))}
+            for i, tree in enumerate(forest):
+                arrays.update(tree.to_arrays(prefix='{}.'.format(i)))
+            # write to a temporary file first, as several jobs might be caching the same tree at the same time
+            temp = '{}.{}.tmp.npz'.format(cache_path[:-len('.npz')], os.getpid())
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                np.savez(temp, **arrays)
+                os.replace(temp, cache_path)
+            except OSError as e:
+                logging.warning('Could not cache the tree {}: {}'.format(tree_path, e))
+    return forest
+
+
+def read_forest(tree_path, columns=None, use_cache=True):
+    """
+    Reads the trees from a newick or nexus file, detecting the format in one pass.
+    The parsed trees are cached in a binary file (see get_cache_path), and are reloaded from it next time.
+    If memoization is on (see memo.py), the parsed trees are also kept in memory, and copied for each call.
+
+    :param columns: PastML columns, whose values (e.g. High|Low) are parsed into sets of states
+    :return: list of ArrayTrees
+    """
+    forest = memo.get(tree_path, ('read_forest', use_cache), lambda: _load_forest(tree_path, use_cache))
+    if memo.is_enabled():
+        forest = [tree.copy() for tree in forest]
+    if columns:
+        for tree in forest:
+            for column in columns:
+                values = tree.features.get(column, np.full(tree.n_nodes, None, dtype=object))
+                tree.features[column] = np.full(tree.n_nodes, None, dtype=object)
+                tree.features[column][:] = [set(_.split('|')) if _ else None for _ in values]
+    return forest
+
+
+def read_tree(tree_path, columns=None, use_cache=True):
+    """Reads the first tree from a newick or nexus file (see read_forest)."""
+    return read_forest(tree_path, columns=columns, use_cache=use_cache)[0]
+
+
+def _format_feature(value):
+    if isinstance(value, (list, set, tuple, frozenset)):
+        value = '|'.join(map(str, value))
+    return ILLEGAL_NEWICK_REGEX.sub('_', value if isinstance(value, str) else str(value))
+
+
+def iter_newick(tree, i=0, format=1, features=None, format_root_node=True, root_dist=None):
+    """
+    Formats the subtree rooted at node i in newick (without the final ;) as ete3 write_newick does,
+    but iteratively and by chunks of nodes, so that the whole string is never built.
+
+    :param format: 1 (flexible: the empty names stay empty) or 3 (strict: they are written as NoName)
+    :param features: (optional) list of features to be written as NHX comments ('date' for the dates)
+    :param format_root_node: whether to write the name, branch length and features of the subtree root
+    :param root_dist: (optional) branch length to be written for the subtree root instead of its own
+    :return: generator of newick chunks
+    """
+    if format not in NEWICK_FORMATS:
+        raise ValueError('Newick format {} is not supported, choose among {}.'.format(format, NEWICK_FORMATS))
+    empty_name = 'NoName' if 3 == format else ''
+    features = features or []
+    end = int(tree.ends[i])
+    root_label = None
+
+    stack = []
+    for start in range(i, end, WRITE_CHUNK_NODES):
+        stop = min(start + WRITE_CHUNK_NODES, end)
+        # the labels of the chunk nodes
+        names = [ILLEGAL_NEWICK_REGEX.sub('_', _) or empty_name for _ in tree.get_names(start, stop)]
+        dists = tree.dists[start: stop].tolist()
+        if start == i and root_dist is not None:
+            dists[0] = root_dist
+        labels = ['{}:{}'.format(name, '%0.6g' % dist) for name, dist in zip(names, dists)]
+        if features:
+            values = [tree.dates[start: stop].tolist() if DATE == _
+                      else tree.features[_][start: stop] if _ in tree.features else [None] * (stop - start)
+                      for _ in features]
+            for k in range(stop - start):
+                nhx = ':'.join('{}={}'.format(feature, _format_feature(v[k]))
+                               for feature, v in zip(features, values)
+                               if v[k] is not None and not (DATE == feature and np.isnan(v[k])))
+                if nhx:
+                    labels[k] = '{}[&&NHX:{}]'.format(labels[k], nhx)
+        if start == i:
+            root_label = labels[0] if format_root_node else ''
+
+        parents, ends = tree.parents[start: stop].tolist(), tree.ends[start: stop].tolist()
+        chunk = []
+        for k, j in enumerate(range(start, stop)):
+            if j != i and parents[k] != j - 1:
+                chunk.append(',')
+            if ends[k] > j + 1:
+                chunk.append('(')
+                stack.append((ends[k], labels[k] if j != i else root_label))
+                continue
+            chunk.append(labels[k])
+            while stack and stack[-1][0] == j + 1:
+                chunk.append(')')
+                chunk.append(stack.pop()[1])
+        yield ''.join(chunk)
+
+
+def write_newick(tree, out, i=0, format=1, features=None, format_root_node=True, root_dist=None):
+    """
+    Writes the subtree rooted at node i in newick (followed by ;) to a file, as ete3 write does,
+    streaming it by chunks of nodes (see iter_newick).
+
+    :param out: output file path or an open file handle
+    """
+    if isinstance(out, str):
+        with open(out, 'w') as f:
+            write_newick(tree, f, i=i, format=format, features=features, format_root_node=format_root_node,
+                         root_dist=root_dist)
+        return
+    for chunk in iter_newick(tree, i=i, format=format, features=features, format_root_node=format_root_node,
+                             root_dist=root_dist):
+        out.write(chunk)
+    out.write(';')
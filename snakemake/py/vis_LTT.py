@@ -1,13 +1,15 @@
 import logging
 import os
-from collections import Counter, defaultdict
 
 import numpy as np
-from matplotlib.backends.backend_pdf import PdfPages
-from matplotlib.pyplot import plot, xlim, xlabel, ylabel, legend, show, figure, savefig
-from pastml.tree import read_tree, DATE, annotate_dates
+
+import instrument
+from mp_store import STORE_SUFFIX, align_mps, get_index_path, read_mps
+from tree_io import get_cache_path, read_tree
 
 DATE_STEP = 10
+# bump it when the LTT summary calculation changes, to invalidate the cached summaries
+LTT_VERSION = '1'
 
 EXT_COLOR = '#4daf4a'
 HIGH_COLOR = '#e41a1c'
@@ -16,75 +18,137 @@ LOW_COLOR = '#377eb8'
 state2color = {'High': HIGH_COLOR, 'External': EXT_COLOR, 'Low': LOW_COLOR}
 
 
-def plot_proportions_years(tree, col, ax=None, suffix='', linestyle='solid'):
-    high, low, ext = Counter(), Counter(), Counter()
-
-    year2n = defaultdict(set)
-    for n in tree.traverse():
-        year2n[int(getattr(n, DATE))].add(n)
-    years = sorted(year2n.keys())
-
-    for year in years:
-        ns = year2n[year]
-        for n in ns:
-            states = getattr(n, col)
-            if 'High' in states:
-                high[year] += 1 / len(states)
-            if 'Low' in states:
-                low[year] += 1 / len(states)
-            if 'External' in states:
-                ext[year] += 1 / len(states)
-
-    xs = np.array(sorted(set(high.keys()) | set(low.keys()) | set(ext.keys())))
-    high = np.array([high[x] for x in xs])
-    low = np.array([low[x] for x in xs])
-    ext = np.array([ext[x] for x in xs])
-
+def get_lineage_weights(tree, col, mp_path=None):
+    """
+    Calculates the state weights of the lineage (branch) leading to each node:
+    the node marginal probabilities if given (as a table or a binary store, see mp_store.py),
+    otherwise 1 / number of its predicted states for each of them.
+
+    :return: tuple (states, weights), where weights is a node x state array
+    """
+    if mp_path is not None:
+        nodes, states, mps = read_mps(mp_path)
+        return np.array(states, dtype=str), align_mps(tree, nodes, mps)
+    node_states = tree.features[col]
+    states = np.array(sorted(set().union(*(_ for _ in node_states if _))), dtype=str)
+    state2index = {s: i for i, s in enumerate(states)}
+    weights = np.zeros((tree.n_nodes, len(states)), dtype=float)
+    for i, ss in enumerate(node_states):
+        if ss:
+            weights[i, [state2index[_] for _ in ss]] = 1 / len(ss)
+    return states, weights
+
+
+def get_ltt(starts, ends, weights):
+    """
+    Calculates the exact number of lineages through time in each state, sweeping over the sorted branch start (+)
+    and end (-) events: a branch is alive on [start, end) and contributes its state weights.
+
+    :param starts: array of branch start dates
+    :param ends: array of branch end dates
+    :param weights: branch x state array of state weights
+    :return: tuple (times, counts) describing a step function:
+        there are counts[i] (a state array) lineages between times[i] and times[i + 1]
+    """
+    times = np.concatenate([starts, ends])
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    counts = np.cumsum(np.concatenate([weights, -weights])[order], axis=0)
+    # only keep the counts after the last event at each time
+    last = np.flatnonzero(np.r_[times[1:] != times[:-1], True])
+    # remove the rounding errors accumulated by the cumulative sum (e.g. -1e-13 instead of 0)
+    return times[last], np.round(counts[last], 10)
+
+
+def get_ltt_at(times, counts, ts):
+    """Evaluates the lineages-through-time step function (see get_ltt) at the given times."""
+    indices = np.searchsorted(times, ts, side='right') - 1
+    return np.where((indices >= 0)[:, np.newaxis], counts[np.maximum(indices, 0)], 0)
+
+
+def get_ltt_summary(tree_path, col, mp_path=None, use_cache=True):
+    """
+    Calculates (or loads from the cache) the lineages-through-time and the sampling summary of a tree.
+
+    :return: dictionary of arrays: states, times and counts (see get_ltt),
+        and tip_dates and tip_states (the state index of each tip, or -1 if several states were predicted)
+    """
+    # a store keeps its node and state names in a separate index file
+    extra_paths = ([mp_path, get_index_path(mp_path)] if mp_path.endswith(STORE_SUFFIX) else [mp_path]) \
+        if mp_path else []
+    cache_path = get_cache_path(tree_path, extra_paths=extra_paths,
+                                key='ltt{}:{}'.format(LTT_VERSION, col)) if use_cache else None
+    if cache_path and os.path.exists(cache_path):
+        instrument.count(cached_summaries=1)
+        with np.load(cache_path) as npz:
+            return dict(npz)
+
+    with instrument.phase('parse'):
+        tree = read_tree(tree_path, columns=[col])
+    instrument.count(nodes=tree.n_nodes)
+    with instrument.phase('annotate'):
+        tree.annotate_dates()
+        states, weights = get_lineage_weights(tree, col, mp_path)
+    with instrument.phase('compute'):
+        times, counts = get_ltt(tree.dates[tree.parents[1:]], tree.dates[1:], weights[1:])
+    tips = tree.tips
+    state2index = {s: i for i, s in enumerate(states)}
+    tip_states = np.array([state2index[next(iter(_))] if _ and len(_) == 1 else -1
+                           for _ in tree.features[col][tips]], dtype=np.int32)
+    summary = {'states': states, 'times': times, 'counts': counts, 'tip_dates': tree.dates[tips],
+               'tip_states': tip_states}
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp = '{}.{}.tmp.npz'.format(cache_path[:-len('.npz')], os.getpid())
+        np.savez(temp, **summary)
+        os.replace(temp, cache_path)
+    return summary
+
+
+def plot_ltt(summary, ax=None, suffix='', linestyle='solid', time_step=None):
+    """
+    Plots the number of lineages through time in each state,
+    either exactly (as a step function), or evaluated every time_step years.
+    """
+    from matplotlib.pyplot import gca
+
+    times, counts = summary['times'], summary['counts']
+    if time_step:
+        xs = np.arange(np.floor(times[0] / time_step) * time_step, times[-1] + time_step, time_step)
+        counts = get_ltt_at(times, counts, xs)
+    else:
+        xs = times
+    states = list(summary['states'])
+
+    axis = ax if ax else gca()
+    for state in ('Low', 'High', 'External'):
+        if state in states:
+            ys = counts[:, states.index(state)]
+            label = '{}{}'.format(state, suffix)
+            if time_step:
+                axis.plot(xs, ys, color=state2color[state], label=label, linestyle=linestyle)
+            else:
+                axis.step(xs, ys, where='post', color=state2color[state], label=label, linestyle=linestyle)
+    axis.set_xlim(min(xs) - .6, max(xs) + .6)
+    axis.set_xlabel('Year')
+    axis.set_ylabel('Number of infected individuals')
+    axis.legend()
     if ax:
-        ax.plot(xs, low, color=LOW_COLOR, label='Low{}'.format(suffix), linestyle=linestyle)
-        ax.plot(xs, high, color=HIGH_COLOR, label='High{}'.format(suffix), linestyle=linestyle)
-        ax.plot(xs, ext, color=EXT_COLOR, label='External{}'.format(suffix), linestyle=linestyle)
-        ax.set_xlim(min(xs) - .6, max(xs) + .6)
-        ax.set_xlabel('Year')
-        ax.set_ylabel('Number of infected individuals')
-        ax.legend()
         ax.spines['right'].set_visible(False)
         ax.spines['top'].set_visible(False)
-    else:
-        plot(xs, low, color=LOW_COLOR, label='Low')
-        plot(xs, high, color=HIGH_COLOR, label='High')
-        plot(xs, ext, color=EXT_COLOR, label='External')
-        xlim(min(xs) - .6, max(xs) + .6)
-        xlabel('Year')
-        ylabel('Number of infected individuals')
-        legend()
-
-
-def plot_sampling(tree, col, ax=None, suffix='', linestyle='solid'):
-    state2tips = defaultdict(list)
-    state2year2tips = defaultdict(lambda: defaultdict(list))
-
-    min_year, max_year = np.inf, -np.inf
-    for tip in tree:
-        states = getattr(tip, col)
-        date = getattr(tip, DATE)
-        if len(states) == 1:
-            state = next(iter(states))
-            state2tips[state].append(tip.name)
-            year = int(date)
-            if year < min_year:
-                min_year = year
-            if year > max_year:
-                max_year = year
-            state2year2tips[state][year].append(tip.name)
+
+
+def plot_sampling(summary, ax=None, suffix='', linestyle='solid'):
+    tip_states = summary['tip_states']
+    years = summary['tip_dates'][tip_states >= 0].astype(int)
+    tip_states = tip_states[tip_states >= 0]
+    min_year, max_year = years.min(), years.max()
 
     for state in ['Low', 'High', 'External']:
-        year2tips = state2year2tips[state]
-        xs = sorted(year2tips.keys())
-        ys = [len(year2tips[_]) for _ in xs]
-        for i in range(1, len(ys)):
-            ys[i] += ys[i - 1]
-        ax.plot(xs, ys, color=state2color[state], label=state + suffix, linestyle=linestyle)
+        state_years = years[tip_states == list(summary['states']).index(state)] \
+            if state in summary['states'] else years[:0]
+        xs, ys = np.unique(state_years, return_counts=True)
+        ax.plot(xs, np.cumsum(ys), color=state2color[state], label=state + suffix, linestyle=linestyle)
 
     ax.set_xlabel('Year')
     ax.set_ylabel('Accumulated sampled cases')
@@ -96,8 +160,7 @@ def plot_sampling(tree, col, ax=None, suffix='', linestyle='solid'):
     # ax.set_yticks(np.arange(0, max(len(_) for _ in state2tips.values()) + 50, step=50))
 
 
-if '__main__' == __name__:
-
+def main(argv=None):
     logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
                         filename=None)
     import argparse
@@ -115,31 +178,40 @@ if '__main__' == __name__:
                         help="the number of infected individuals in each state vs time.")
     parser.add_argument('--png', default=os.path.join(data_dir, "infections.png"), type=str, required=True,
                         help="LTT plot for the full and subsampled tree 1")
+    parser.add_argument('--mps', type=str, nargs='*', default=None,
+                        help="the PASTML marginal probability files (in the same order as the trees): "
+                             "if given, the lineages are weighted by their state probabilities, "
+                             "otherwise by their predicted states.")
+    parser.add_argument('--time_step', type=float, default=None,
+                        help="if given, the lineages are counted every time_step years, otherwise exactly.")
+
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('vis_LTT', params.instrument)
 
-    params = parser.parse_args()
+    from matplotlib.backends.backend_pdf import PdfPages
+    from matplotlib.pyplot import figure, savefig
 
-    forest = []
-    for nwk in params.trees:
-        tree = read_tree(nwk, columns=[params.column])
-        annotate_dates([tree])
-        forest.append(tree)
+    summaries = [get_ltt_summary(nwk, params.column, mp_path=mp)
+                 for nwk, mp in zip(params.trees, params.mps if params.mps else [None] * len(params.trees))]
+    instrument.count(trees=len(summaries), tips=sum(len(_['tip_dates']) for _ in summaries))
 
     # Infection plots
-    with PdfPages(params.time_pdf) as pdf_pages:
-            for label, tree in zip(params.labels, forest):
-                fig = figure(figsize=(10, 10), dpi=100)
-                plot_proportions_years(tree, params.column)
-                pdf_pages.savefig(fig)
+    with instrument.phase('write'), PdfPages(params.time_pdf) as pdf_pages:
+        for label, summary in zip(params.labels, summaries):
+            fig = figure(figsize=(10, 10), dpi=100)
+            plot_ltt(summary, time_step=params.time_step)
+            pdf_pages.savefig(fig)
 
-                # Done with the page
-                logging.info('Analysed infections {}'.format(label))
+            # Done with the page
+            logging.info('Analysed infections {}'.format(label))
 
     fig = figure(figsize=(12, 6), dpi=300)
     ax2, ax1 = fig.subplots(1, 2)
-    plot_proportions_years(forest[0], params.column, ax=ax1)
-    plot_proportions_years(forest[1], params.column, ax=ax1, suffix=' (subsampled)', linestyle='dashed')
-    plot_sampling(forest[0], params.column, ax=ax2)
-    plot_sampling(forest[1], params.column, ax=ax2, suffix=' (subsampled)', linestyle='dashed')
+    plot_ltt(summaries[0], ax=ax1, time_step=params.time_step)
+    plot_ltt(summaries[1], ax=ax1, suffix=' (subsampled)', linestyle='dashed', time_step=params.time_step)
+    plot_sampling(summaries[0], ax=ax2)
+    plot_sampling(summaries[1], ax=ax2, suffix=' (subsampled)', linestyle='dashed')
 
     x_m, x_M = min(ax1.get_xlim()[0], ax2.get_xlim()[0]), max(ax1.get_xlim()[1], ax2.get_xlim()[1])
     for ax in (ax1, ax2):
@@ -147,4 +219,9 @@ if '__main__' == __name__:
     ax1.set_title('Infected individuals')
     ax2.set_title('Sampled individuals')
 
-    savefig(params.png, bbox_inches='tight')
+    with instrument.phase('write'):
+        savefig(params.png, bbox_inches='tight')
+
+
+if '__main__' == __name__:
+    main()
@@ -1,15 +1,19 @@
 import logging
 import os
-from collections import Counter, defaultdict
+from collections import Counter
 
 import numpy as np
 import pandas as pd
-from matplotlib.backends.backend_pdf import PdfPages
-from matplotlib.pyplot import bar, plot, xlim, xlabel, ylabel, legend, show, ylim, figure, savefig
-from pastml.tree import read_tree, DATE, annotate_dates
-from pastml.visualisation.cytoscape_manager import save_as_transition_html
+
+import instrument
+from array_tree import read_array_tree
+from mp_store import align_mps, read_mps
+from state_histories import CREDIBILITY, N_DRAWS, HistorySampler, get_conditionals, get_transition_matrices, \
+    read_f81_params, sample_transmissions, summarize
 
 DATE_STEP = 10
+# same-state transmission counts down to -TOLERANCE are float noise, and are set to 0
+TOLERANCE = 1e-9
 
 EXT_COLOR = '#4daf4a'
 HIGH_COLOR = '#e41a1c'
@@ -18,29 +22,139 @@ LOW_COLOR = '#377eb8'
 state2color = {'High': HIGH_COLOR, 'External': EXT_COLOR, 'Low': LOW_COLOR}
 
 
-def count_transmissions(tree, mp_df, filter=lambda _: True):
-    states = mp_df.columns
-    from_to2count = Counter()
-    for n in tree.traverse():
-        if not filter(n):
-            continue
-        for n_state in states:
-            same_state_count = 0
-            for c in n.children:
-                for c_state in states:
-                    prob = mp_df.loc[n.name, n_state] * mp_df.loc[c.name, c_state]
-                    from_to2count[(n_state, c_state)] += prob
-                    if n_state == c_state:
-                        same_state_count += prob
-            old_v = from_to2count[(n_state, n_state)]
-            from_to2count[(n_state, n_state)] -= min(mp_df.loc[n.name, n_state], same_state_count)
-            if from_to2count[(n_state, n_state)] < 0:
-                print(old_v, from_to2count[(n_state, n_state)], mp_df.loc[n.name, n_state], same_state_count)
-    return from_to2count
+def get_edges(tree, mask=None):
+    """
+    Lists the tree branches as parallel arrays of parent and child node indices.
 
+    :param tree: ArrayTree
+    :param mask: (optional) boolean node mask: if given, only the branches whose parent node is masked are listed.
+    """
+    child_ids = np.arange(1, tree.n_nodes)
+    parent_ids = tree.parents[1:]
+    if mask is not None:
+        edge_mask = mask[parent_ids]
+        parent_ids, child_ids = parent_ids[edge_mask], child_ids[edge_mask]
+    return parent_ids, child_ids
+
+
+def count_transmission_matrix(mps, parent_ids, child_ids):
+    """
+    Calculates the expected number of from->to transmissions along the given branches.
+
+    :param mps: node x state array of marginal probabilities
+    :param parent_ids: array of branch parent row indices in mps
+    :param child_ids: array of branch child row indices in mps
+    :return: state x state array of expected counts
+    """
+    n_states = mps.shape[1]
+    counts = np.zeros((n_states, n_states), dtype=float)
+    if not len(parent_ids):
+        return counts
+    parent_mps, child_mps = mps[parent_ids], mps[child_ids]
+    counts += parent_mps.T @ child_mps
+
+    # One of the children in the parent's state is the parent lineage itself rather than a transmission:
+    # remove it from the same-state counts (but never more than the parent's probability to be in this state).
+    order = np.argsort(parent_ids, kind='stable')
+    sorted_parent_ids = parent_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_parent_ids[1:] != sorted_parent_ids[:-1]])
+    same_state = np.add.reduceat((parent_mps * child_mps)[order], starts, axis=0)
+    correction = np.minimum(mps[sorted_parent_ids[starts]], same_state).sum(axis=0)
+    diagonal = np.diag_indices(n_states)
+    counts[diagonal] -= correction
+    if np.any(counts[diagonal] < -TOLERANCE):
+        logging.warning('Got negative same-state transmission counts: {}'.format(counts[diagonal]))
+    counts[diagonal] = np.where((counts[diagonal] < 0) & (counts[diagonal] >= -TOLERANCE), 0, counts[diagonal])
+    return counts
+
+
+def assign_time_windows(dates, step=DATE_STEP, width=None):
+    """
+    Assigns dates to time windows [k * step, k * step + width),
+    which overlap (i.e. slide) if the width is larger than the step.
+
+    :param dates: array of dates
+    :param step: window step
+    :param width: window width (by default equal to the step, i.e. non-overlapping windows)
+    :return: tuple (item_ids, windows) of parallel arrays, where each date index appears once per window k containing it
+    """
+    width = width if width else step
+    dates = np.asarray(dates, dtype=float)
+    ids = np.flatnonzero(~np.isnan(dates))
+    last_window = np.floor(dates[ids] / step).astype(int)
+    item_ids, windows = [], []
+    for shift in range(int(np.ceil(width / step))):
+        window = last_window - shift
+        mask = dates[ids] < window * step + width
+        item_ids.append(ids[mask])
+        windows.append(window[mask])
+    return np.concatenate(item_ids), np.concatenate(windows)
+
+
+def count_windowed_transmissions(mps, parent_ids, child_ids, parent_dates, tip_ids, tip_dates,
+                                 step=DATE_STEP, width=None):
+    """
+    Sends each branch (by its parent date) and each tip to its time window(s) in one pass,
+    and calculates the expected from->to transmission counts within each window.
+
+    :return: tuple (window_starts, tip_counts, transmissions), where tip_counts is a window x state array
+        of expected tip numbers, and transmissions is a sparse block-diagonal matrix
+        with one state x state block of expected transmission counts per window.
+    """
+    from scipy.sparse import bsr_matrix
+
+    n_states = mps.shape[1]
+    edge_ids, edge_windows = assign_time_windows(parent_dates, step, width)
+    tip_item_ids, tip_windows = assign_time_windows(tip_dates, step, width)
+    windows = np.union1d(edge_windows, tip_windows)
+
+    tip_counts = np.zeros((len(windows), n_states), dtype=float)
+    np.add.at(tip_counts, np.searchsorted(windows, tip_windows), mps[tip_ids[tip_item_ids]])
+
+    order = np.argsort(edge_windows, kind='stable')
+    edge_ids, edge_windows = edge_ids[order], edge_windows[order]
+    bounds = np.searchsorted(edge_windows, np.append(windows, windows[-1] + 1) if len(windows) else windows)
+    blocks = np.zeros((len(windows), n_states, n_states), dtype=float)
+    for i in range(len(windows)):
+        window_edge_ids = edge_ids[bounds[i]: bounds[i + 1]]
+        blocks[i] = count_transmission_matrix(mps, parent_ids[window_edge_ids], child_ids[window_edge_ids])
+    transmissions = bsr_matrix((blocks, np.arange(len(windows)), np.arange(len(windows) + 1)),
+                               shape=(len(windows) * n_states, len(windows) * n_states))
+    return windows * step, tip_counts, transmissions
+
+
+def get_sampled_transmissions(tree, mps, states, params_path, parent_ids, child_ids, window_starts, n_draws=N_DRAWS,
+                              seed=None, threads=1, step=DATE_STEP, width=None):
+    """
+    Draws joint state histories from the marginal probabilities and the PastML F81 model parameters
+    (see state_histories), and counts their from->to transmissions, overall and per time window.
+
+    :param window_starts: starts of the time windows to count the transmissions in (see count_windowed_transmissions)
+    :return: tuple (counts, window_counts) of draw x state x state and draw x window x state x state arrays
+    """
+    frequencies, scaling_factor, smoothing_factor = read_f81_params(params_path, states)
+    conditionals = get_conditionals(tree, mps,
+                                    get_transition_matrices(tree, frequencies, scaling_factor, smoothing_factor))
+    edge_ids, edge_windows = assign_time_windows(tree.dates[parent_ids], step, width)
+    sampler = HistorySampler(tree, conditionals, parent_ids, child_ids, edge_ids,
+                             np.searchsorted(window_starts, edge_windows * step), len(window_starts))
+    return sample_transmissions(sampler, n_draws, seed=seed, threads=threads)
+
+
+def get_window_label(start, step=DATE_STEP, width=None):
+    width = width if width else step
+    return '{:g}s'.format(start) if width == step else '{:g}-{:g}'.format(start, start + width)
 
-if '__main__' == __name__:
 
+def count_transmissions(tree, mp_df, mask=None):
+    states = mp_df.columns
+    mps = align_mps(tree, mp_df.index.to_numpy(dtype=str), mp_df.to_numpy(dtype=float))
+    counts = count_transmission_matrix(mps, *get_edges(tree, mask))
+    return Counter({(from_state, to_state): counts[i, j]
+                    for i, from_state in enumerate(states) for j, to_state in enumerate(states)})
+
+
+def main(argv=None):
     logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s', datefmt="%Y-%m-%d %H:%M:%S",
                         filename=None)
     import argparse
@@ -60,49 +174,63 @@ if '__main__' == __name__:
                         help="Who infected whom table.")
     parser.add_argument('--out_html', default=os.path.join(data_dir, "transitions_{}.html"), type=str, required=True,
                         help="Who infected whom visualisation.")
+    parser.add_argument('--date_step', default=DATE_STEP, type=float,
+                        help="the step (in years) between the starts of consecutive time windows.")
+    parser.add_argument('--date_window', default=None, type=float,
+                        help="the time window width (in years), by default equals to the step. "
+                             "If larger than the step, the windows overlap.")
+    parser.add_argument('--params', type=str, nargs='*', default=None,
+                        help="(optional) the PASTML (F81) parameter files, in the same order as the trees: "
+                             "if given, the transmissions are also counted in joint state histories "
+                             "drawn from the marginal probabilities, and reported with credible intervals.")
+    parser.add_argument('--draws', default=N_DRAWS, type=int, help="the number of state histories to draw per tree.")
+    parser.add_argument('--credibility', default=CREDIBILITY, type=float,
+                        help="the credibility level of the intervals of the drawn transmission counts.")
+    parser.add_argument('--seed', default=None, type=int, help="the random seed for the state history draws.")
+    parser.add_argument('--threads', default=1, type=int, help="the number of processes to draw the histories in.")
+    parser.add_argument('--out_ci_html', default=None, type=str,
+                        help="(optional) the drawn transmission count tables (html), with {} to be replaced by the label.")
+
+    instrument.add_instrument_argument(parser)
+    params = parser.parse_args(argv)
+    instrument.start('vis_transmissions', params.instrument)
+
+    if params.params and len(params.params) != len(params.trees):
+        raise ValueError('Expected as many parameter files as trees ({}).'.format(len(params.trees)))
 
-    params = parser.parse_args()
+    from pastml.visualisation.cytoscape_manager import save_as_transition_html
 
     forest = []
     for nwk in params.trees:
-        tree = read_tree(nwk, columns=[params.column])
-        annotate_dates([tree])
+        with instrument.phase('parse'):
+            tree = read_array_tree(nwk)
+        with instrument.phase('annotate'):
+            tree.annotate_dates()
+        instrument.count(trees=1, nodes=tree.n_nodes, tips=len(tree.tips))
         forest.append(tree)
 
     # Who infected whom
     with pd.ExcelWriter(params.table, engine='xlsxwriter') as writer:
-        workbook = writer.book
-        for label, tree, mp in zip(params.labels, forest, params.mps):
-            mp_df = pd.read_csv(mp, sep='\t', index_col=0)
-            states = mp_df.columns
-
-            min_year, max_year = np.inf, -np.inf
-
-            year2state_counts = defaultdict(Counter)
-            state_counts = Counter()
-            for tip in tree:
-                year = int(getattr(tip, DATE))
-                if min_year > year:
-                    min_year = year
-                if max_year < year:
-                    max_year = year
-                year //= DATE_STEP
-                for state in states:
-                    mp = mp_df.loc[tip.name, state]
-                    state_counts[state] += mp
-                    year2state_counts[year][state] += mp
+        for i, (label, tree, mp) in enumerate(zip(params.labels, forest, params.mps)):
+            with instrument.phase('parse'):
+                nodes, states, mps = read_mps(mp)
+
+            with instrument.phase('annotate'):
+                mps = align_mps(tree, nodes, mps)
+            tip_ids = tree.tips
+            tip_dates = tree.dates[tip_ids]
+            min_year, max_year = int(tip_dates.min()), int(tip_dates.max())
+            state_counts = dict(zip(states, mps[tip_ids].sum(axis=0)))
 
             state_df = pd.DataFrame(index=states, columns=['samples'], data=[[state_counts[s]] for s in states])
             total_counts = state_df['samples'].sum()
             state_df['%'] = 100 * state_df['samples'] / total_counts
             state_df.to_excel(writer, sheet_name='{} tip states'.format(label), startrow=0, startcol=0, float_format='%.0f')
 
-            transmission2counts = count_transmissions(tree, mp_df)
-
-            df = pd.DataFrame(columns=states, index=states)
-
-            for (from_state, to_state), count in transmission2counts.items():
-                df.loc[from_state, to_state] = count
+            with instrument.phase('compute'):
+                parent_ids, child_ids = get_edges(tree)
+                counts = count_transmission_matrix(mps, parent_ids, child_ids)
+            df = pd.DataFrame(columns=states, index=states, data=counts)
 
             total_transitions = df.sum().sum()
             for s in states:
@@ -125,55 +253,79 @@ if '__main__' == __name__:
             transitions = np.round(
                 np.array(df.loc[['% of {}'.format(s) for s in states], ['% of {}'.format(s) for s in states]],
                          dtype=float), 0)
-            save_as_transition_html(params.column, states, counts=counts,
-                                    transitions=transitions,
-                                    out_html=params.out_html.format(label, min_year, max_year),
-                                    state2colour=state2color, work_dir=None,
-                                    local_css_js=False, threshold=0)
-
-            # year2count_array = {}
-            # year2transmission_array = {}
+            with instrument.phase('write'):
+                save_as_transition_html(params.column, states, counts=counts,
+                                        transitions=transitions,
+                                        out_html=params.out_html.format(label, min_year, max_year),
+                                        state2colour=state2color, work_dir=None,
+                                        local_css_js=False, threshold=0)
+
             n = len(states)
-            years = sorted(set((int(getattr(n, DATE))) // DATE_STEP for n in tree.traverse()))
-            n_years = len(years)
-            count_array = np.zeros(n * n_years, dtype=float)
-            transmission_array = np.zeros((n * n_years, n * n_years), dtype=float)
+            with instrument.phase('compute'):
+                window_starts, window_tip_counts, window_transmissions = \
+                    count_windowed_transmissions(mps, parent_ids, child_ids, tree.dates[parent_ids], tip_ids,
+                                                 tip_dates, step=params.date_step, width=params.date_window)
+            window_labels = [get_window_label(_, params.date_step, params.date_window) for _ in window_starts]
             state_labels = []
-            for year_i, year in enumerate(years):
+            for window_label in window_labels:
                 for s in states:
-                    suffixed_s = '{}, {}s'.format(s, year * DATE_STEP)
+                    suffixed_s = '{}, {}'.format(s, window_label)
                     state_labels.append(suffixed_s)
                     state2color[suffixed_s] = state2color[s]
 
-                state_counts = year2state_counts[year]
-                # total_counts = sum(state_counts.values())
-                count_array[year_i * n: (year_i + 1) * n] = [state_counts[s] for s in states]
-                # year2count_array[year] = np.array([state_counts[s] for s in states], dtype=float)
-
-                y_transmission2counts = count_transmissions(tree, mp_df,
-                                                            filter=lambda n: year == (int(getattr(n, DATE))) // DATE_STEP)
-                a = np.zeros((n, n), dtype=float)
-                for i in range(n):
-                    i_state = states[i]
-                    a[i, i] = y_transmission2counts[(i_state, i_state)]
-                    for j in range(0, i):
-                        j_state = states[j]
-                        a[i, j] = y_transmission2counts[(i_state, j_state)]
-                        a[j, i] = y_transmission2counts[(j_state, i_state)]
-                # total_transitions = a.sum()
-                transmission_array[year_i * n: (year_i + 1) * n, year_i * n: (year_i + 1) * n] = a
-                # year2transmission_array[year] = a
-
-            count_array = 100 * count_array / total_counts
-            transmission_array = 100. * transmission_array / total_transitions
-
-            counts = np.round(count_array, 1)
-            transitions = np.round(transmission_array, 0)
+            window_transmissions = window_transmissions.tocoo()
+            window_df = pd.DataFrame(data={'time window': np.array(window_labels)[window_transmissions.row // n],
+                                           'from': states[window_transmissions.row % n],
+                                           'to': states[window_transmissions.col % n],
+                                           'transmissions': window_transmissions.data})
+            window_df['%'] = 100 * window_df['transmissions'] / total_transitions
+
+            sampled_df = None
+            if params.params:
+                with instrument.phase('compute'):
+                    sampled_counts, sampled_window_counts = \
+                        get_sampled_transmissions(tree, mps, states, params.params[i], parent_ids, child_ids,
+                                                  window_starts, n_draws=params.draws, seed=params.seed,
+                                                  threads=params.threads, step=params.date_step,
+                                                  width=params.date_window)
+                instrument.count(draws=params.draws)
+                ci_columns = ['{:g}% CI {}'.format(100 * params.credibility, _) for _ in ('low', 'high')]
+                sampled_df = pd.DataFrame(data={'from': np.repeat(states, n), 'to': np.tile(states, n)})
+                for column, values in zip(['mean'] + ci_columns, summarize(sampled_counts, params.credibility)):
+                    sampled_df[column] = values.ravel()
+                window_ci_df = pd.DataFrame(data={'time window': np.repeat(window_labels, n * n),
+                                                  'from': np.tile(np.repeat(states, n), len(window_labels)),
+                                                  'to': np.tile(states, n * len(window_labels))})
+                for column, values in zip(['mean'] + ci_columns,
+                                          summarize(sampled_window_counts, params.credibility)):
+                    window_ci_df[column] = values.ravel()
+                window_df = window_df.merge(window_ci_df, on=['time window', 'from', 'to'], how='left')
+            window_df.to_excel(writer, sheet_name='{} by time'.format(label), startrow=0, startcol=0, index=False,
+                               float_format='%.1f')
+            if sampled_df is not None:
+                sampled_df.to_excel(writer, sheet_name='{} sampled'.format(label), startrow=0, startcol=0,
+                                    index=False, float_format='%.1f')
+                if params.out_ci_html:
+                    with instrument.phase('write'), open(params.out_ci_html.format(label), 'w+') as f:
+                        f.write('<h2>{} transmissions ({} state histories)</h2>\n'.format(label, params.draws))
+                        f.write(sampled_df.to_html(index=False, float_format='{:.1f}'.format))
+                        f.write('\n<h2>{} transmissions by time</h2>\n'.format(label))
+                        f.write(window_df.to_html(index=False, float_format='{:.1f}'.format))
+
+            counts = np.round(100 * window_tip_counts.ravel() / total_counts, 1)
+            transitions = np.round(100. * window_transmissions.toarray() / total_transitions, 0)
             if np.any(transitions > 0):
-                save_as_transition_html(params.column, state_labels, counts=counts,
-                                        transitions=transitions,
-                                        out_html=params.out_html.format(label, 'by', DATE_STEP),
-                                        state2colour=state2color, work_dir=None,
-                                        local_css_js=False, threshold=0)
+                with instrument.phase('write'):
+                    save_as_transition_html(params.column, state_labels, counts=counts,
+                                            transitions=transitions,
+                                            out_html=params.out_html.format(
+                                                label, 'by', '{:g}'.format(params.date_step) if not params.date_window
+                                                else '{:g}w{:g}'.format(params.date_step, params.date_window)),
+                                            state2colour=state2color, work_dir=None,
+                                            local_css_js=False, threshold=0)
+
+            logging.info('Analysed who infected whom in {}'.format(label))
 
-            logging.info('Analysed who infected whom in {}'.format(label))
\ No newline at end of file
+
+if '__main__' == __name__:
+    main()